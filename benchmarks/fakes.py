@@ -0,0 +1,394 @@
+"""
+In-process stand-ins for the Athena, Identity Store, S3 and DynamoDB clients
+
+The fakes serve a synthetic CUR data set, sleep for a configurable latency per
+call, can throttle a share of the calls or the calls beyond a number of
+requests per second, and count every call they receive.
+"""
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+
+import requests
+from botocore.exceptions import ClientError
+
+
+class SyntheticCur:
+    """
+    Synthetic Q Developer subscription charges for a number of users
+
+    Every user gets a subscription charge, and tax_rate of the subscription
+    total is added as a separate tax line item.
+    """
+
+    def __init__(self, user_count, billing_period='2025-01', tax_rate=0.1, seed=42):
+        rng = random.Random(seed)
+        self.billing_period = billing_period
+        self.user_ids = [f"{index:08d}-0000-4000-8000-{rng.getrandbits(48):012x}" for index in range(user_count)]
+        self.user_costs = [(f"arn:aws:identitystore:::user/{user_id}", round(rng.choice([19.0, 9.5, 4.75]), 2))
+                           for user_id in self.user_ids]
+        self.subscription_total = sum(cost for _, cost in self.user_costs)
+        self.tax_total = round(self.subscription_total * tax_rate, 2)
+
+        # Result rows are built up front so they do not count towards the
+        # memory of the code under test
+        self.subscription_cost_rows = self._subscription_cost_rows()
+        self.total_cost_rows = self._total_cost_rows()
+        self.cost_breakdown_rows = self._cost_breakdown_rows()
+        self.range_cost_breakdown_rows = [('billing_period',) + self.cost_breakdown_rows[0]] + [
+            (billing_period,) + row for row in self.cost_breakdown_rows[1:]]
+
+    def _subscription_cost_rows(self):
+        return [('line_item_resource_id', 'per_user_cost')] + [
+            (resource_id, str(cost)) for resource_id, cost in self.user_costs]
+
+    def _total_cost_rows(self):
+        return [
+            ('cost_type', 'total_cost', 'user_count'),
+            (None, str(self.subscription_total + self.tax_total), str(len(self.user_costs))),
+            ('Subscription', str(self.subscription_total), str(len(self.user_costs))),
+            ('Others', str(self.tax_total), '0'),
+        ]
+
+    def _cost_breakdown_rows(self):
+        rows = [
+            ('resource_id', 'cost_type', 'cost', 'user_count', 'row_group'),
+            (None, None, str(self.subscription_total + self.tax_total), str(len(self.user_costs)), '3'),
+            (None, 'Subscription', str(self.subscription_total), str(len(self.user_costs)), '2'),
+            (None, 'Others', str(self.tax_total), '0', '2'),
+        ]
+        rows.extend((resource_id, None, str(cost), '1', '1') for resource_id, cost in sorted(self.user_costs))
+        return rows
+
+
+class FakeService:
+    """
+    Base class for fakes with latency, throttling and call counting
+
+    in_flight counts the calls of each operation sleeping out their latency,
+    max_in_flight the most that overlapped.
+    """
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, capacity=0, seed=7):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.capacity = capacity
+        self.calls = Counter()
+        self.in_flight = Counter()
+        self.max_in_flight = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = deque()
+
+    def _call(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+            throttled = self._rng.random() < self.throttle_rate or self._over_capacity()
+            self.in_flight[operation] += 1
+            self.max_in_flight[operation] = max(self.max_in_flight[operation], self.in_flight[operation])
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.in_flight[operation] -= 1
+        return throttled
+
+    def _over_capacity(self):
+        # Requests beyond capacity within the last second are throttled
+        if not self.capacity:
+            return False
+        now = time.monotonic()
+        while self._window and now - self._window[0] >= 1:
+            self._window.popleft()
+        if len(self._window) >= self.capacity:
+            return True
+        self._window.append(now)
+        return False
+
+
+def client_error(code, operation, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class FakeAthenaClient(FakeService):
+    """
+    Athena stand-in that answers the queries of the cost breakdown from a SyntheticCur
+
+    Queries finish after running_polls status checks and results are served
+    page_size rows per GetQueryResults call.
+    """
+
+    def __init__(self, cur, page_size=1000, running_polls=2, **kwargs):
+        super().__init__(**kwargs)
+        self.cur = cur
+        self.page_size = page_size
+        self.running_polls = running_polls
+        self.statements = {}
+        self.executions = {}
+
+    def get_prepared_statement(self, StatementName, WorkGroup):
+        self._call('GetPreparedStatement')
+        if StatementName not in self.statements:
+            raise client_error('ResourceNotFoundException', 'GetPreparedStatement')
+        return {'PreparedStatement': {'StatementName': StatementName,
+                                      'QueryStatement': self.statements[StatementName]}}
+
+    def create_prepared_statement(self, StatementName, WorkGroup, QueryStatement):
+        self._call('CreatePreparedStatement')
+        self.statements[StatementName] = QueryStatement
+        return {}
+
+    def start_query_execution(self, QueryString, **kwargs):
+        self._call('StartQueryExecution')
+        statement_name = QueryString.split()[1]
+        execution_id = f"query-{len(self.executions) + 1}"
+        self.executions[execution_id] = {
+            'rows': self._rows_for(self.statements[statement_name]),
+            'polls': 0,
+            'output_location': f"s3://fake-results/{execution_id}.csv"
+        }
+        return {'QueryExecutionId': execution_id}
+
+    def get_query_execution(self, QueryExecutionId):
+        self._call('GetQueryExecution')
+        execution = self.executions[QueryExecutionId]
+        execution['polls'] += 1
+        state = 'SUCCEEDED' if execution['polls'] > self.running_polls else 'RUNNING'
+        return {'QueryExecution': {
+            'QueryExecutionId': QueryExecutionId,
+            'Status': {'State': state},
+            'ResultConfiguration': {'OutputLocation': execution['output_location']},
+            'Statistics': {
+                'QueryQueueTimeInMillis': 100,
+                'EngineExecutionTimeInMillis': 500 * execution['polls'],
+                'DataScannedInBytes': 1024 * len(execution['rows'])
+            }
+        }}
+
+    def stop_query_execution(self, QueryExecutionId):
+        self._call('StopQueryExecution')
+        return {}
+
+    def get_paginator(self, operation):
+        return FakeResultsPaginator(self)
+
+    def get_query_results(self, QueryExecutionId, NextToken=None, MaxResults=None):
+        self._call('GetQueryResults')
+        rows = self.executions[QueryExecutionId]['rows']
+        start = int(NextToken or 0)
+        end = start + (MaxResults or self.page_size)
+        page = {'ResultSet': {'Rows': [
+            {'Data': [{'VarCharValue': value} if value is not None else {} for value in row]}
+            for row in rows[start:end]
+        ]}}
+        if end < len(rows):
+            page['NextToken'] = str(end)
+        return page
+
+    def _rows_for(self, query_statement):
+        if 'BETWEEN' in query_statement:
+            return self.cur.range_cost_breakdown_rows
+        if 'row_group' in query_statement:
+            return self.cur.cost_breakdown_rows
+        if 'per_user_cost' in query_statement:
+            return self.cur.subscription_cost_rows
+        return self.cur.total_cost_rows
+
+
+class FakeResultsPaginator:
+    """Paginator over FakeAthenaClient.get_query_results"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, QueryExecutionId):
+        token = None
+        while True:
+            page = self.client.get_query_results(QueryExecutionId, NextToken=token)
+            yield page
+            token = page.get('NextToken')
+            if token is None:
+                return
+
+
+class FakeS3Client(FakeService):
+    """S3 stand-in serving the result CSV files of a FakeAthenaClient"""
+
+    def __init__(self, athena_client, **kwargs):
+        super().__init__(**kwargs)
+        self.athena_client = athena_client
+
+    def get_object(self, Bucket, Key):
+        self._call('GetObject')
+        execution_id = Key.rsplit('.', 1)[0]
+        rows = self.athena_client.executions[execution_id]['rows']
+        return {'Body': FakeStreamingBody(rows)}
+
+
+class FakeStreamingBody:
+    """
+    Streams rows as the lines of an Athena result CSV file
+
+    Values are quoted with their quotes doubled and NULL is an empty field, so
+    values with line breaks span several lines.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def iter_lines(self):
+        for row in self.rows:
+            record = ','.join('' if value is None else '"' + value.replace('"', '""') + '"' for value in row)
+            yield from record.encode('utf-8').split(b'\n')
+
+
+class FakeResponse:
+    """Minimal requests.Response stand-in"""
+
+    def __init__(self, payload, status_code=200):
+        self.text = json.dumps(payload)
+        self.status_code = status_code
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Client Error", response=self)
+
+
+class FakeIdentityStoreHttp(FakeService):
+    """
+    Stand-in for the requests.Session of query_idc.IdentityStoreHttpClient
+
+    Answers signed DescribeUsers and SearchUsers requests for the users of a
+    SyntheticCur and extra_users users without a subscription, listed in a
+    shuffled order. Throttled requests get the HTTP 400 ThrottlingException
+    response of the real endpoint.
+    """
+
+    def __init__(self, cur, attribute_name, extra_users=0, directory_seed=11, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = cur.user_ids + [f"{index:08d}-0000-4000-8000-000000000000"
+                                         for index in range(len(cur.user_ids), len(cur.user_ids) + extra_users)]
+        # SearchUsers pages do not list the subscribers first
+        random.Random(directory_seed).shuffle(self.directory)
+        self.user_ids = set(self.directory)
+        self.attribute_name = attribute_name
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        operation = headers['X-Amz-Target'].split('.')[-1]
+        if self._call(operation):
+            return FakeResponse({'__type': 'ThrottlingException', 'Message': 'Rate exceeded'}, 400)
+
+        request_data = json.loads(data)
+        if operation == 'SearchUsers':
+            start = int(request_data.get('NextToken', 0))
+            end = start + request_data['MaxResults']
+            page = {'Users': [self.user(user_id) for user_id in self.directory[start:end]]}
+            if end < len(self.directory):
+                page['NextToken'] = str(end)
+            return FakeResponse(page)
+
+        users = [self.user(user_id) for user_id in request_data.get('UserIds', []) if user_id in self.user_ids]
+        return FakeResponse({'Users': users})
+
+    def user(self, user_id):
+        return {
+            'UserId': user_id,
+            'UserAttributes': {
+                'emails': {'ComplexListValue': [{'ComplexValue': {
+                    'value': {'StringValue': f"{user_id[:8]}@example.com"},
+                    'primary': {'BooleanValue': True}
+                }}]},
+                'enterprise': {'ComplexValue': {
+                    self.attribute_name: {'StringValue': f"CC-{int(user_id[:8]) % 50:03d}"}
+                }}
+            }
+        }
+
+
+class FakeIdentityStoreClient(FakeService):
+    """Stand-in for the boto3 identitystore client answering DescribeUser"""
+
+    def __init__(self, http, **kwargs):
+        super().__init__(**kwargs)
+        self.http = http
+
+    def describe_user(self, IdentityStoreId, UserId):
+        if self._call('DescribeUser'):
+            raise client_error('ThrottlingException', 'DescribeUser', 'Rate exceeded')
+        if UserId not in self.http.user_ids:
+            raise client_error('ResourceNotFoundException', 'DescribeUser', f"User {UserId} not found")
+        return {'UserId': UserId, 'Emails': [{'Value': f"{UserId[:8]}@example.com", 'Primary': True}]}
+
+
+class FakeDynamoDBClient(FakeService):
+    """
+    DynamoDB stand-in storing items in memory
+
+    All requests of a throttled BatchWriteItem call are returned as
+    UnprocessedItems. With store_items off only the keys are kept, so the fake
+    table does not dominate memory measurements. Tables keyed on the partition
+    key alone have sort_key None. Queries of an index not in
+    indexes fail like on a table without that index, indexes None has them all.
+    """
+
+    def __init__(self, partition_key, sort_key, store_items=True, indexes=None, **kwargs):
+        super().__init__(**kwargs)
+        self.partition_key = partition_key
+        self.sort_key = sort_key
+        self.store_items = store_items
+        self.indexes = indexes
+        self.items = {}
+
+    def batch_write_item(self, RequestItems):
+        if self._call('BatchWriteItem'):
+            return {'UnprocessedItems': RequestItems}
+        for table_name, requests in RequestItems.items():
+            for request in requests:
+                if 'PutRequest' in request:
+                    item = request['PutRequest']['Item']
+                    self.items[self._key(item)] = item if self.store_items else None
+                else:
+                    self.items.pop(self._key(request['DeleteRequest']['Key']), None)
+        return {'UnprocessedItems': {}}
+
+    def batch_get_item(self, RequestItems):
+        if self._call('BatchGetItem'):
+            return {'Responses': {}, 'UnprocessedKeys': RequestItems}
+        return {'Responses': {table_name: [self.items[self._key(key)] for key in request['Keys']
+                                           if self.items.get(self._key(key))]
+                              for table_name, request in RequestItems.items()}}
+
+    def get_item(self, TableName, Key, **kwargs):
+        self._call('GetItem')
+        item = self.items.get(self._key(Key))
+        return {'Item': item} if item else {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, **kwargs):
+        self._call('PutItem')
+        # Conditional puts only succeed for new items
+        if ConditionExpression and self._key(Item) in self.items:
+            raise client_error('ConditionalCheckFailedException', 'PutItem', 'The conditional request failed')
+        self.items[self._key(Item)] = Item
+
+    def delete_item(self, TableName, Key):
+        self._call('DeleteItem')
+        self.items.pop(self._key(Key), None)
+
+    def query(self, ExpressionAttributeValues, IndexName=None, **kwargs):
+        if self._call('Query'):
+            raise client_error('ProvisionedThroughputExceededException', 'Query', 'Rate exceeded')
+        if self.indexes is not None and IndexName not in self.indexes:
+            raise client_error('ValidationException', 'Query',
+                               f"The table does not have the specified index: {IndexName}")
+        time_period = ExpressionAttributeValues[':period']['S']
+        prefix = ExpressionAttributeValues.get(':prefix', {}).get('S', '')
+        return {'Items': [item or {self.partition_key: {'S': key}, self.sort_key: {'S': period}}
+                          for (key, period), item in self.items.items()
+                          if period == time_period and key.startswith(prefix)]}
+
+    def _key(self, item):
+        return item[self.partition_key]['S'], item[self.sort_key]['S'] if self.sort_key else None
@@ -0,0 +1,226 @@
+"""
+Offline end-to-end benchmarks of the Q Developer cost breakdown
+
+Runs get_q_dev_cost_per_month against the in-process fakes in fakes.py for
+synthetic organizations of different sizes and prints one JSON document with
+the wall time, throughput, peak memory and API calls of every scenario.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--users 1000 10000 100000] [--latency-ms 5]
+        [--throttle-rate 0.0] [--page-size 1000] [--pipeline sequential concurrent]
+        [--query-mode combined separate] [--result-reader api s3] [--skip-memory]
+        [--idc-rps 1000] [--ddb-rps 1000] [--idc-capacity 0] [--ddb-capacity 0]
+        [--resolution-mode point snapshot auto] [--directory-extra-users 0]
+        [--output results.json]
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_ROOT, 'src')
+
+# The modules under src create their clients at import time
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ.setdefault('METRICS_ENABLED', 'false')
+sys.path.insert(0, SRC_DIR)
+
+import fakes  # noqa: E402
+import metrics  # noqa: E402
+import query_athena  # noqa: E402
+import query_idc  # noqa: E402
+import rate_limiter  # noqa: E402
+import settings  # noqa: E402
+from ddb_writer import ROLLUP_PREFIX  # noqa: E402
+from identity_cache import IdentityCache  # noqa: E402
+
+
+def load_main_module():
+    """
+    Import the main script, whose file name is not a valid module name
+    """
+    path = os.path.join(SRC_DIR, 'q-dev-subscription-cost-using-athena.py')
+    spec = importlib.util.spec_from_file_location('q_dev_subscription_cost', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def configure():
+    settings.DATABASE_NAME = 'benchmark'
+    settings.ATHENA_TABLE_NAME = 'cur'
+    settings.WORK_GROUP = 'primary'
+    settings.RESULT_LOCATION = 's3://fake-results/'
+    settings.IDC_STORE_ID = 'd-0000000000'
+    settings.IDC_COST_CENTER_ATTRIBUTE = 'costCenter'
+    settings.DDB_TABLE_NAME = 'benchmark'
+    settings.DDB_PARTITION_KEY = 'user-guid'
+    settings.DDB_SORT_KEY = 'time-period'
+    settings.ATHENA_POLL_MIN_INTERVAL = 0.001
+    settings.ATHENA_POLL_MAX_INTERVAL = 0.001
+    settings.QUERY_CACHE_DIR = None
+    query_athena.query_cache = None
+
+
+def run_scenario(main_module, users, latency, throttle_rate, page_size, pipeline, query_mode, result_reader,
+                 trace_memory=True, idc_capacity=0, ddb_capacity=0, resolution_mode='point',
+                 directory_extra_users=0):
+    """
+    Run one month end to end against fresh fakes
+
+    Tracing memory slows Python code down considerably, so timings taken with
+    trace_memory are only comparable with other traced runs.
+
+    Returns:
+        Dict with the scenario parameters and measurements
+    """
+    cur = fakes.SyntheticCur(users)
+    fake_kwargs = {'latency': latency, 'throttle_rate': throttle_rate}
+    athena = fakes.FakeAthenaClient(cur, page_size=page_size, latency=latency)
+    s3 = fakes.FakeS3Client(athena, latency=latency)
+    idc_http = fakes.FakeIdentityStoreHttp(cur, settings.IDC_COST_CENTER_ATTRIBUTE, extra_users=directory_extra_users,
+                                           capacity=idc_capacity, **fake_kwargs)
+    idc = fakes.FakeIdentityStoreClient(idc_http, **fake_kwargs)
+    ddb = fakes.FakeDynamoDBClient(settings.DDB_PARTITION_KEY, settings.DDB_SORT_KEY,
+                                   store_items=False, capacity=ddb_capacity, **fake_kwargs)
+
+    query_athena.athena_client = athena
+    query_athena.s3_client = s3
+    query_athena.prepared_statements.clear()
+    query_idc.idc_client = idc
+    query_idc.identity_cache = IdentityCache()
+    query_idc.directory_snapshot = None
+    query_idc._snapshot_attempted = False
+    query_idc._expected_subscribers = 0
+    query_idc.get_identity_store_client(settings.IDC_REGION)._http = idc_http
+    main_module.ddb_client = ddb
+
+    settings.PIPELINE_MODE = pipeline
+    settings.ATHENA_QUERY_MODE = query_mode
+    settings.ATHENA_RESULT_READER = result_reader
+    settings.IDC_RESOLUTION_MODE = resolution_mode
+    metrics.reset()
+    rate_limiter.reset()
+
+    year, month = cur.billing_period.split('-')
+    peak_memory = None
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    main_module.get_q_dev_cost_per_month(year, month)
+    elapsed = time.perf_counter() - start
+    if trace_memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    user_items = sum(not key.startswith(ROLLUP_PREFIX) for key, _ in ddb.items)
+    if user_items != users:
+        raise RuntimeError(f"Expected {users} items, found {user_items}")
+
+    return {
+        'name': f"{query_mode}-{result_reader}-{resolution_mode}-{pipeline}-{users}",
+        'users': users,
+        'pipeline': pipeline,
+        'query_mode': query_mode,
+        'result_reader': result_reader,
+        'resolution_mode': resolution_mode,
+        'directory_extra_users': directory_extra_users,
+        'latency_seconds': latency,
+        'throttle_rate': throttle_rate,
+        'idc_capacity': idc_capacity,
+        'ddb_capacity': ddb_capacity,
+        'page_size': page_size,
+        'seconds': round(elapsed, 4),
+        'users_per_second': round(users / elapsed, 1) if elapsed else None,
+        'peak_memory_bytes': peak_memory,
+        'calls': {
+            'athena': dict(athena.calls),
+            's3': dict(s3.calls),
+            'identity_store': dict(idc_http.calls + idc.calls),
+            'dynamodb': dict(ddb.calls)
+        },
+        'rate_limits': rate_limiter.summary(),
+        'metrics': metrics.snapshot()
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the Q Developer cost breakdown")
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--latency-ms', type=float, default=5.0, help="Latency of every fake API call")
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help="Share of IDC and DynamoDB calls that are throttled")
+    parser.add_argument('--page-size', type=int, default=1000, help="Rows per GetQueryResults page")
+    parser.add_argument('--pipeline', nargs='+', default=['sequential', 'concurrent'],
+                        choices=['sequential', 'concurrent'])
+    parser.add_argument('--query-mode', nargs='+', default=['combined'], choices=['combined', 'separate'])
+    parser.add_argument('--result-reader', nargs='+', default=['api'], choices=['api', 's3'])
+    parser.add_argument('--resolution-mode', nargs='+', default=['point'], choices=['point', 'snapshot', 'auto'])
+    parser.add_argument('--directory-extra-users', type=int, default=0,
+                        help="Users in the fake directory without a subscription")
+    parser.add_argument('--skip-memory', action='store_true',
+                        help="Do not trace peak memory, which slows the code under test down")
+    parser.add_argument('--idc-rps', type=float, default=1000.0,
+                        help="Client side Identity Store requests per second")
+    parser.add_argument('--ddb-rps', type=float, default=1000.0, help="Client side DynamoDB requests per second")
+    parser.add_argument('--idc-capacity', type=int, default=0,
+                        help="Identity Store requests per second beyond which the fake throttles, 0 for no limit")
+    parser.add_argument('--ddb-capacity', type=int, default=0,
+                        help="DynamoDB requests per second beyond which the fake throttles, 0 for no limit")
+    parser.add_argument('--output', help="Write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    configure()
+    settings.IDC_MAX_RPS = args.idc_rps
+    settings.DDB_MAX_RPS = args.ddb_rps
+    main_module = load_main_module()
+    # Keep the benchmark output readable
+    logging.getLogger().setLevel(logging.WARNING)
+
+    scenarios = []
+    for users in args.users:
+        for query_mode in args.query_mode:
+            for result_reader in args.result_reader:
+                for resolution_mode in args.resolution_mode:
+                    for pipeline in args.pipeline:
+                        scenarios.append(run_scenario(
+                            main_module, users, args.latency_ms / 1000, args.throttle_rate,
+                            args.page_size, pipeline, query_mode, result_reader,
+                            trace_memory=not args.skip_memory,
+                            idc_capacity=args.idc_capacity, ddb_capacity=args.ddb_capacity,
+                            resolution_mode=resolution_mode,
+                            directory_extra_users=args.directory_extra_users))
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'timestamp': int(time.time()),
+        'scenarios': scenarios
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
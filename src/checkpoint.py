@@ -0,0 +1,434 @@
+import hashlib
+import json
+import os
+import time
+import logging
+
+from botocore.exceptions import ClientError
+
+import settings
+import sharding
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# Failed users are saved in parts of this many users next to the checkpoint.
+# A resource ARN and its cost take about 120 bytes, so a part stays well below
+# the 400 KB limit of a DynamoDB item.
+FAILED_USERS_PER_PART = 1000
+
+
+class Checkpoint:
+    """
+    Progress of a run that a restarted run can pick up
+
+    Holds the execution IDs of the finished Athena queries and, per billing
+    period, the watermark (last resource ID written to DynamoDB, in result
+    order), the users that could not be resolved with their cost, and the cost
+    center rollups of the users up to the watermark. Progress is saved every
+    settings.CHECKPOINT_INTERVAL chunks and whenever a query finishes. The
+    failed users are saved in separate parts of FAILED_USERS_PER_PART users,
+    so the checkpoint does not grow with them, and only the parts that changed
+    are written again.
+
+    The shards of a sharded run each have their own checkpoint, and share
+    their Athena queries through the store under shared_run_key.
+    """
+
+    def __init__(self, store, run_key, state=None, shared_run_key=None):
+        self.store = store
+        self.run_key = run_key
+        self.shared_run_key = shared_run_key
+        state = state or {}
+        self.query_ids = state.get('query_ids', {})
+        self.periods = state.get('periods', {})
+        self._unsaved_chunks = 0
+        # Failed users parts of each billing period as last saved
+        self._saved_parts = {}
+        for time_period, progress in list(self.periods.items()):
+            parts = [self.store.load(self._part_key(time_period, index))
+                     for index in range(progress.pop('failed_user_parts', 0))]
+            if None in parts:
+                # Expired with the TTL of the store, the users that failed before the watermark are not known
+                logger.warning(f"Failed users of {time_period} are missing from checkpoint {run_key}, "
+                               f"starting the billing period over")
+                del self.periods[time_period]
+                continue
+            self._saved_parts[time_period] = [part['failed_users'] for part in parts]
+            progress.setdefault('failed_users', {})
+            for part in self._saved_parts[time_period]:
+                progress['failed_users'].update(part)
+
+    def period(self, time_period):
+        """
+        Get the progress of a billing period
+
+        Args:
+            time_period: Billing period (YYYY-MM)
+
+        Returns:
+            Dict with 'watermark', 'failed_users' (resource ID to cost) and
+            'rollups' (cost center to totals), updated in place by the run
+        """
+        return self.periods.setdefault(time_period, {'watermark': None, 'failed_users': {}, 'rollups': {}})
+
+    def record_query(self, query_key, query_execution_id):
+        """
+        Record a finished Athena query and save the checkpoint
+
+        Args:
+            query_key: Prepared statement and parameters of the query
+            query_execution_id: Query execution ID
+        """
+        self.query_ids[query_key] = query_execution_id
+        self.save()
+
+    def shared_query(self, query_key, start_query):
+        """
+        Start a query once for all shards of a run
+
+        The first shard to claim the query starts it and publishes its
+        execution ID, the other shards wait for the ID. Claims older than
+        settings.CHECKPOINT_MAX_AGE are taken over.
+
+        Args:
+            query_key: Prepared statement and parameters of the query
+            start_query: Function starting the query and returning its execution ID
+
+        Returns:
+            Query execution ID, or what start_query returned in the shard that ran it
+
+        Raises:
+            TimeoutError: If no execution ID is published within settings.ATHENA_QUERY_TIMEOUT
+        """
+        if self.shared_run_key is None:
+            return start_query()
+
+        key = f"{self.shared_run_key}:{query_key}"
+        if self.store.claim(key):
+            try:
+                query_execution_id = start_query()
+            except Exception:
+                self.store.release(key)
+                raise
+            self.store.publish(key, query_execution_id)
+            return query_execution_id
+
+        logger.info(f"Waiting for another shard to start query {query_key}")
+        deadline = time.monotonic() + settings.ATHENA_QUERY_TIMEOUT
+        while True:
+            query_execution_id = self.store.lookup(key)
+            if query_execution_id:
+                logger.info(f"Using query {query_execution_id} started by another shard")
+                return query_execution_id
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"No shard started query {query_key} within {settings.ATHENA_QUERY_TIMEOUT} seconds")
+            time.sleep(settings.ATHENA_POLL_MAX_INTERVAL)
+
+    def release_shared_query(self, query_key):
+        """
+        Drop the shared execution of a failed query, so the next attempt starts it again
+
+        Args:
+            query_key: Prepared statement and parameters of the query
+        """
+        if self.shared_run_key is not None:
+            self.store.release(f"{self.shared_run_key}:{query_key}")
+
+    def advance(self, time_period, resource_id):
+        """
+        Move the watermark of a billing period after its users were written
+
+        Args:
+            time_period: Billing period (YYYY-MM)
+            resource_id: Last resource ID written
+        """
+        progress = self.period(time_period)
+        # Retried users come after the watermark was already past them
+        if progress['watermark'] is None or resource_id > progress['watermark']:
+            progress['watermark'] = resource_id
+        self._unsaved_chunks += 1
+        if self._unsaved_chunks >= settings.CHECKPOINT_INTERVAL:
+            self.save()
+
+    def save(self):
+        """
+        Write the checkpoint to its store
+
+        The failed users parts are written first, so a saved checkpoint never
+        refers to parts that are missing.
+        """
+        periods = {}
+        stale_parts = []
+        for time_period, progress in self.periods.items():
+            failed_users = sorted(progress['failed_users'].items())
+            parts = [dict(failed_users[start:start + FAILED_USERS_PER_PART])
+                     for start in range(0, len(failed_users), FAILED_USERS_PER_PART)]
+            saved_parts = self._saved_parts.get(time_period, [])
+            for index, part in enumerate(parts):
+                if index >= len(saved_parts) or saved_parts[index] != part:
+                    self.store.save(self._part_key(time_period, index), {'failed_users': part})
+            stale_parts += [(time_period, index) for index in range(len(parts), len(saved_parts))]
+            self._saved_parts[time_period] = parts
+
+            periods[time_period] = {key: value for key, value in progress.items() if key != 'failed_users'}
+            periods[time_period]['failed_user_parts'] = len(parts)
+
+        self.store.save(self.run_key, {
+            'created': time.time(),
+            'query_ids': self.query_ids,
+            'periods': periods
+        })
+        for time_period, index in stale_parts:
+            self.store.delete(self._part_key(time_period, index))
+        self._unsaved_chunks = 0
+        logger.debug(f"Saved checkpoint {self.run_key}")
+
+    def clear(self):
+        """
+        Remove the checkpoint and its failed users from the store once the run has completed
+        """
+        self.store.delete(self.run_key)
+        for time_period, parts in self._saved_parts.items():
+            for index in range(len(parts)):
+                self.store.delete(self._part_key(time_period, index))
+        self._saved_parts = {}
+        logger.info(f"Removed checkpoint {self.run_key}")
+
+    def _part_key(self, time_period, index):
+        return f"{self.run_key}#FAILED#{time_period}#{index}"
+
+
+class FileCheckpointStore:
+    """
+    Checkpoints as JSON files in a local directory, and queries shared by the
+    shards of a run and locks as files created exclusively. Shared query files
+    older than settings.CHECKPOINT_MAX_AGE are removed when the store is opened.
+
+    Claims older than max_age, settings.CHECKPOINT_MAX_AGE by default, are taken over.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._remove_expired_queries()
+
+    def load(self, run_key):
+        try:
+            with open(self._path(run_key)) as checkpoint_file:
+                return json.load(checkpoint_file)
+        except FileNotFoundError:
+            return None
+
+    def save(self, run_key, state):
+        path = self._path(run_key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.replace(temp_path, path)
+
+    def delete(self, run_key):
+        try:
+            os.remove(self._path(run_key))
+        except FileNotFoundError:
+            pass
+
+    def claim(self, key, max_age=None):
+        path = self._shared_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > (max_age or settings.CHECKPOINT_MAX_AGE):
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        return True
+
+    def publish(self, key, value):
+        path = self._shared_path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as shared_file:
+            shared_file.write(value)
+        os.replace(temp_path, path)
+
+    def lookup(self, key):
+        try:
+            with open(self._shared_path(key)) as shared_file:
+                return shared_file.read() or None
+        except FileNotFoundError:
+            return None
+
+    def release(self, key):
+        try:
+            os.remove(self._shared_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _remove_expired_queries(self):
+        stale = time.time() - settings.CHECKPOINT_MAX_AGE
+        for name in os.listdir(self.directory):
+            if not name.startswith('query-'):
+                continue
+            try:
+                if os.path.getmtime(os.path.join(self.directory, name)) < stale:
+                    os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def _path(self, run_key):
+        return os.path.join(self.directory, f"{run_key}.json")
+
+    def _shared_path(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f"query-{digest}")
+
+
+class DynamoDBCheckpointStore:
+    """
+    Checkpoints as items of the state table, keyed on CHECKPOINT#<run key>,
+    and queries shared by the shards of a run and locks, keyed on
+    QUERY#<run key>:<query> and QUERY#<lock>. Claims older than max_age,
+    settings.CHECKPOINT_MAX_AGE by default, are taken over with a conditional put.
+
+    The items get an expires_at attribute settings.CHECKPOINT_MAX_AGE after
+    they were written, so the TTL of the table removes the items of abandoned
+    runs and the shared queries, which no shard knows when to delete.
+    """
+
+    def __init__(self, ddb_client, table_name):
+        self.ddb_client = ddb_client
+        self.table_name = table_name
+
+    def load(self, run_key):
+        response = self.ddb_client.get_item(TableName=self.table_name, Key=self._key(run_key),
+                                            ConsistentRead=True)
+        item = response.get('Item')
+        return json.loads(item['state']['S']) if item else None
+
+    def save(self, run_key, state):
+        item = self._key(run_key)
+        item['state'] = {'S': json.dumps(state)}
+        item['expires_at'] = self._expires_at()
+        self.ddb_client.put_item(TableName=self.table_name, Item=item)
+
+    def delete(self, run_key):
+        self.ddb_client.delete_item(TableName=self.table_name, Key=self._key(run_key))
+
+    def claim(self, key, max_age=None):
+        item = self._shared_key(key)
+        item['created'] = {'N': str(time.time())}
+        item['expires_at'] = self._expires_at()
+        stale = time.time() - (max_age or settings.CHECKPOINT_MAX_AGE)
+        try:
+            self.ddb_client.put_item(
+                TableName=self.table_name,
+                Item=item,
+                ConditionExpression='attribute_not_exists(#key) OR created < :stale',
+                ExpressionAttributeNames={'#key': settings.DDB_STATE_PARTITION_KEY},
+                ExpressionAttributeValues={':stale': {'N': str(stale)}}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def publish(self, key, value):
+        item = self._shared_key(key)
+        item['created'] = {'N': str(time.time())}
+        item['expires_at'] = self._expires_at()
+        item['value'] = {'S': value}
+        self.ddb_client.put_item(TableName=self.table_name, Item=item)
+
+    def lookup(self, key):
+        response = self.ddb_client.get_item(TableName=self.table_name, Key=self._shared_key(key),
+                                            ConsistentRead=True)
+        return response.get('Item', {}).get('value', {}).get('S')
+
+    def release(self, key):
+        self.ddb_client.delete_item(TableName=self.table_name, Key=self._shared_key(key))
+
+    def _key(self, run_key):
+        return {settings.DDB_STATE_PARTITION_KEY: {'S': f"CHECKPOINT#{run_key}"}}
+
+    def _shared_key(self, key):
+        return {settings.DDB_STATE_PARTITION_KEY: {'S': f"QUERY#{key}"}}
+
+    def _expires_at(self):
+        # Epoch seconds, as the TTL of the table expects
+        return {'N': str(int(time.time() + settings.CHECKPOINT_MAX_AGE))}
+
+
+def open_checkpoint(run_key, ddb_client):
+    """
+    Load the checkpoint of a run, or start a new one
+
+    The store is chosen with settings.CHECKPOINT_STORE. Checkpoints older than
+    settings.CHECKPOINT_MAX_AGE seconds are ignored, since the CUR data of an
+    open billing period may have changed since. In a sharded run each shard
+    gets its own checkpoint and the shards share their queries.
+
+    Args:
+        run_key: Name of the run, e.g. month-2025-01
+        ddb_client: DynamoDB client for the 'dynamodb' store
+
+    Returns:
+        Checkpoint, or None if checkpointing is disabled
+
+    Raises:
+        ValueError: If settings.CHECKPOINT_STORE is not 'none', 'file' or 'dynamodb',
+            is 'dynamodb' without settings.DDB_STATE_TABLE_NAME, or is 'none' in
+            a sharded run, whose shards would each run the queries
+    """
+    if settings.CHECKPOINT_STORE == 'none':
+        if sharding.is_sharded():
+            raise ValueError(f"A run of {settings.SHARD_COUNT} shards needs CHECKPOINT_STORE 'file' or 'dynamodb' "
+                             f"to share its queries")
+        return None
+    store = open_lock_store(ddb_client)
+
+    shared_run_key = sharding.shared_run_key(run_key)
+    run_key += sharding.run_suffix()
+    state = store.load(run_key)
+    if state is not None and time.time() - state.get('created', 0) > settings.CHECKPOINT_MAX_AGE:
+        logger.info(f"Ignoring expired checkpoint {run_key}")
+        state = None
+    if state is not None:
+        logger.info(f"Resuming from checkpoint {run_key}")
+    return Checkpoint(store, run_key, state, shared_run_key)
+
+
+def open_lock_store(ddb_client):
+    """
+    Open the store that runs claim their locks in
+
+    The locks keep overlapping runs, sharded or not, from doing the same work
+    at the same time. They are taken in the checkpoint store. When
+    checkpointing is disabled they are taken in settings.DDB_STATE_TABLE_NAME,
+    or in files of settings.CHECKPOINT_DIR without a state table, which only
+    keeps out overlapping runs on the same host.
+
+    Args:
+        ddb_client: DynamoDB client for the 'dynamodb' and 'none' stores
+
+    Returns:
+        FileCheckpointStore or DynamoDBCheckpointStore
+
+    Raises:
+        ValueError: If settings.CHECKPOINT_STORE is not 'none', 'file' or 'dynamodb',
+            or is 'dynamodb' without settings.DDB_STATE_TABLE_NAME
+    """
+    if settings.CHECKPOINT_STORE == 'file':
+        return FileCheckpointStore(settings.CHECKPOINT_DIR)
+    if settings.CHECKPOINT_STORE == 'dynamodb':
+        if not settings.DDB_STATE_TABLE_NAME:
+            raise ValueError("DDB_STATE_TABLE_NAME is required for the dynamodb checkpoint store")
+        return DynamoDBCheckpointStore(ddb_client, settings.DDB_STATE_TABLE_NAME)
+    if settings.CHECKPOINT_STORE == 'none':
+        if settings.DDB_STATE_TABLE_NAME:
+            return DynamoDBCheckpointStore(ddb_client, settings.DDB_STATE_TABLE_NAME)
+        logger.info(f"No DDB_STATE_TABLE_NAME, taking locks in {settings.CHECKPOINT_DIR}")
+        return FileCheckpointStore(settings.CHECKPOINT_DIR)
+    raise ValueError(f"Unknown checkpoint store: {settings.CHECKPOINT_STORE}")
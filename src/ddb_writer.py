@@ -0,0 +1,253 @@
+import random
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+import metrics
+import rate_limiter
+import settings
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# BatchWriteItem accepts at most 25 put/delete requests per call
+MAX_BATCH_SIZE = 25
+
+# Partition key prefix of the cost center rollup items, which share the table
+# with the per-user items
+ROLLUP_PREFIX = 'COST_CENTER#'
+
+
+class BatchWriter:
+    """
+    Buffered DynamoDB writer that sends items in BatchWriteItem requests
+
+    Items are buffered and flushed 25 at a time. Items returned as
+    UnprocessedItems are re-driven with jittered exponential backoff until
+    settings.DDB_MAX_RETRIES is exhausted, after which they are counted as failed.
+    Requests share the DynamoDB rate limiter, and both throttled requests and
+    UnprocessedItems lower its rate.
+    Deletes go through the same batches, and items the caller found unchanged
+    are only counted.
+
+    With concurrency above 1, up to concurrency batches are buffered and sent
+    in parallel, and flush returns once all of them are written. The writer
+    itself must still be used from one thread at a time.
+    """
+
+    def __init__(self, ddb_client, table_name, concurrency=1):
+        self.ddb_client = ddb_client
+        self.table_name = table_name
+        self.concurrency = max(1, concurrency)
+        self.buffer = []
+        self.written = 0
+        self.removed = 0
+        self.unchanged = 0
+        self.retried = 0
+        self.failed = 0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        """
+        Queue an item for writing, flushing when a full batch is buffered
+
+        Args:
+            item: DynamoDB item in low-level attribute value format
+        """
+        self.buffer.append({'PutRequest': {'Item': item}})
+        if len(self.buffer) >= MAX_BATCH_SIZE * self.concurrency:
+            self.flush()
+
+    def delete(self, key):
+        """
+        Queue an item for deletion, flushing when a full batch is buffered
+
+        Args:
+            key: DynamoDB key in low-level attribute value format
+        """
+        self.buffer.append({'DeleteRequest': {'Key': key}})
+        if len(self.buffer) >= MAX_BATCH_SIZE * self.concurrency:
+            self.flush()
+
+    def skip(self):
+        """
+        Count an item that is already stored with the same values
+        """
+        self.unchanged += 1
+
+    def flush(self):
+        """
+        Write all buffered items
+
+        Raises:
+            botocore.exceptions.ClientError: If BatchWriteItem fails with a non-retryable error
+        """
+        batches = [self.buffer[start:start + MAX_BATCH_SIZE] for start in range(0, len(self.buffer), MAX_BATCH_SIZE)]
+        self.buffer = []
+        if self.concurrency == 1 or len(batches) <= 1:
+            for batch in batches:
+                self._write_batch(batch)
+            return
+
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='ddb-batch')
+        futures = [self._pool.submit(self._write_batch, batch) for batch in batches]
+        # Wait for every batch before raising, so no write is still in flight when flush returns
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def close(self):
+        """
+        Flush remaining items and log the write summary
+
+        Returns:
+            Dict with the written, unchanged, removed, retried and failed item counts
+        """
+        try:
+            self.flush()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+        stats = {
+            'written': self.written,
+            'unchanged': self.unchanged,
+            'removed': self.removed,
+            'retried': self.retried,
+            'failed': self.failed
+        }
+        logger.info(f"DynamoDB batch writes - written: {self.written}, unchanged: {self.unchanged}, "
+                    f"removed: {self.removed}, retried: {self.retried}, failed: {self.failed}")
+        return stats
+
+    def _write_batch(self, requests):
+        attempt = 0
+        while requests:
+            limiter = rate_limiter.get_limiter('Ddb')
+            with metrics.timer('DdbWriteTime'):
+                response = rate_limiter.call_with_retry(
+                    limiter,
+                    self.ddb_client.batch_write_item,
+                    RequestItems={self.table_name: requests}
+                )
+            metrics.increment('DdbApiCalls')
+            unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            deletes = (sum('DeleteRequest' in request for request in requests)
+                       - sum('DeleteRequest' in request for request in unprocessed))
+            with self._lock:
+                self.removed += deletes
+                self.written += len(requests) - len(unprocessed) - deletes
+            if not unprocessed:
+                return
+
+            # Unprocessed items are DynamoDB's way of throttling part of a batch
+            limiter.on_throttle()
+            attempt += 1
+            if attempt > settings.DDB_MAX_RETRIES:
+                logger.error(f"Giving up on {len(unprocessed)} unprocessed items after {settings.DDB_MAX_RETRIES} retries")
+                with self._lock:
+                    self.failed += len(unprocessed)
+                metrics.increment('DdbFailedItems', len(unprocessed))
+                return
+
+            with self._lock:
+                self.retried += len(unprocessed)
+            metrics.increment('DdbRetriedItems', len(unprocessed))
+            delay = random.uniform(0, min(settings.DDB_MAX_BACKOFF, settings.DDB_BASE_BACKOFF * 2 ** attempt))
+            logger.debug(f"Retrying {len(unprocessed)} unprocessed items in {delay:.2f} seconds")
+            time.sleep(delay)
+            requests = unprocessed
+
+
+def load_period_items(ddb_client, table_name, time_period):
+    """
+    Read the stored chargeback items of a billing period
+
+    Uses the settings.DDB_PERIOD_INDEX_NAME index, which is keyed on the sort key
+    of the table, so only the items of the billing period are read. Pages are
+    requested through the DynamoDB rate limiter. Cost center rollup items are
+    left out.
+
+    Args:
+        ddb_client: DynamoDB client
+        table_name: Name of the table
+        time_period: Billing period (YYYY-MM)
+
+    Returns:
+        Dict mapping user ID to a dict with 'email', 'cost_center' and 'cost' (Decimal)
+    """
+    items = {}
+    for item in _query_period(ddb_client, table_name, time_period):
+        user_id = item[settings.DDB_PARTITION_KEY]['S']
+        if user_id.startswith(ROLLUP_PREFIX):
+            continue
+        items[user_id] = {
+            'email': item.get('email', {}).get('S', ''),
+            'cost_center': item.get('cost_center', {}).get('S', ''),
+            'cost': Decimal(item.get('cost', {}).get('N', '0'))
+        }
+
+    logger.info(f"Loaded {len(items)} stored items for {time_period}")
+    return items
+
+
+def load_period_rollups(ddb_client, table_name, time_period):
+    """
+    Read the partition keys of the stored cost center rollup items of a billing period
+
+    Only the rollup items are read from the settings.DDB_PERIOD_INDEX_NAME index,
+    with a begins_with condition on the partition key of the table. Tables
+    created before the index was added reject the query, in which case no keys
+    are returned and stale rollup items are left in place.
+
+    Args:
+        ddb_client: DynamoDB client
+        table_name: Name of the table
+        time_period: Billing period (YYYY-MM)
+
+    Returns:
+        Set of partition keys of the rollup items
+    """
+    try:
+        return {item[settings.DDB_PARTITION_KEY]['S']
+                for item in _query_period(ddb_client, table_name, time_period, ROLLUP_PREFIX)}
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ValidationException':
+            raise
+        logger.warning(f"Cannot read the rollups of {time_period} from index {settings.DDB_PERIOD_INDEX_NAME}, "
+                       f"stale rollup items are not removed: {str(e)}")
+        return set()
+
+
+def _query_period(ddb_client, table_name, time_period, key_prefix=None):
+    request = {
+        'TableName': table_name,
+        'IndexName': settings.DDB_PERIOD_INDEX_NAME,
+        'KeyConditionExpression': '#period = :period',
+        'ExpressionAttributeNames': {'#period': settings.DDB_SORT_KEY},
+        'ExpressionAttributeValues': {':period': {'S': time_period}}
+    }
+    if key_prefix:
+        request['KeyConditionExpression'] += ' AND begins_with(#key, :prefix)'
+        request['ExpressionAttributeNames']['#key'] = settings.DDB_PARTITION_KEY
+        request['ExpressionAttributeValues'][':prefix'] = {'S': key_prefix}
+
+    while True:
+        page = rate_limiter.call_with_retry(rate_limiter.get_limiter('Ddb'), ddb_client.query, **request)
+        metrics.increment('DdbApiCalls')
+        yield from page.get('Items', [])
+        if 'LastEvaluatedKey' not in page:
+            return
+        request['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+class DynamoDBWriteError(Exception):
+    """Custom exception for DynamoDB write errors"""
+    pass
@@ -0,0 +1,110 @@
+import json
+import os
+import time
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+
+class DirectorySnapshot:
+    """
+    In-memory index of the users of an identity store
+
+    Maps user ID to email and cost center, so subscribers can be resolved
+    without a request per user. A snapshot is complete when the whole
+    directory was listed. Complete snapshots can be saved to a JSON file and
+    loaded again by later runs until they are older than a maximum age.
+    """
+
+    def __init__(self, identity_store_id, attribute_name, created=None):
+        self.identity_store_id = identity_store_id
+        self.attribute_name = attribute_name
+        self.created = created or time.time()
+        self.complete = False
+        self._users = {}
+
+    def add(self, user_id, email, cost_center):
+        """
+        Add a user to the index
+
+        Args:
+            user_id: User ID
+            email: Primary email
+            cost_center: Value of the cost center attribute
+        """
+        self._users[user_id] = (email, cost_center)
+
+    def get(self, user_id):
+        """
+        Get the email and cost center of a user
+
+        Args:
+            user_id: User ID
+
+        Returns:
+            Dict with 'email' and 'cost_center', or None if the user is not in the snapshot
+        """
+        entry = self._users.get(user_id)
+        if entry is None:
+            return None
+        return {'email': entry[0], 'cost_center': entry[1]}
+
+    def __len__(self):
+        return len(self._users)
+
+    def save(self, path):
+        """
+        Write the snapshot to a JSON file, replacing it atomically
+
+        Args:
+            path: File path
+        """
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as snapshot_file:
+            json.dump({
+                'identity_store_id': self.identity_store_id,
+                'attribute_name': self.attribute_name,
+                'created': self.created,
+                'users': self._users
+            }, snapshot_file, separators=(',', ':'))
+        os.replace(temp_path, path)
+        logger.info(f"Saved directory snapshot of {len(self)} users: {path}")
+
+    @classmethod
+    def load(cls, path, identity_store_id, attribute_name, max_age):
+        """
+        Read a snapshot saved by save
+
+        Args:
+            path: File path
+            identity_store_id: Identity store the snapshot must be of
+            attribute_name: Cost center attribute the snapshot must be built with
+            max_age: Maximum age of the snapshot in seconds
+
+        Returns:
+            Complete DirectorySnapshot, or None if the file is missing, invalid,
+            of another identity store or attribute, or too old
+        """
+        try:
+            with open(path) as snapshot_file:
+                data = json.load(snapshot_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable directory snapshot {path}: {str(e)}")
+            return None
+
+        if data.get('identity_store_id') != identity_store_id or data.get('attribute_name') != attribute_name:
+            logger.info(f"Ignoring directory snapshot of another identity store or attribute: {path}")
+            return None
+        if time.time() - data.get('created', 0) > max_age:
+            logger.info(f"Directory snapshot expired: {path}")
+            return None
+
+        snapshot = cls(identity_store_id, attribute_name, created=data['created'])
+        for user_id, (email, cost_center) in data.get('users', {}).items():
+            snapshot.add(user_id, email, cost_center)
+        snapshot.complete = True
+        logger.info(f"Loaded directory snapshot of {len(snapshot)} users: {path}")
+        return snapshot
@@ -0,0 +1,294 @@
+import json
+import sqlite3
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+import metrics
+import rate_limiter
+import settings
+from ddb_writer import BatchWriter
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# BatchGetItem reads at most 100 keys per call
+MAX_BATCH_GET_SIZE = 100
+
+
+class IdentityCache:
+    """
+    Two-tier cache for identity attributes looked up in IAM Identity Center
+
+    An in-process LRU tier sits in front of an optional persistent store, a
+    SQLiteIdentityStore or DynamoDBIdentityStore, so values survive across runs.
+    Entries expire after ttl seconds. With refresh set, every read is a miss and
+    the values looked up again replace the cached ones. The cache is safe to use
+    from several threads.
+    """
+
+    def __init__(self, store=None, ttl=604800, max_size=50000, refresh=False):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.refresh = refresh
+        self.memory_hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._store = store
+
+    def get(self, key):
+        """
+        Get a cached value
+
+        Args:
+            key: Cache key
+
+        Returns:
+            Cached value or None if missing or expired
+        """
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """
+        Get several cached values
+
+        Args:
+            keys: Cache keys
+
+        Returns:
+            Dict of key to value for the keys that are cached and not expired
+        """
+        found = {}
+        with self._lock:
+            if self.refresh:
+                self.misses += len(keys)
+                return found
+
+            now = time.time()
+            persistent_keys = []
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(key)
+                    found[key] = entry[0]
+                    self.memory_hits += 1
+                else:
+                    persistent_keys.append(key)
+            store = self._store
+
+        # The persistent store is read without holding the lock, so lookups of
+        # other threads are not held up by its round trips
+        persistent_entries = []
+        if store is not None and persistent_keys:
+            persistent_entries = store.get_many(persistent_keys, now)
+
+        with self._lock:
+            for key, value, expires_at in persistent_entries:
+                found[key] = value
+                self._remember(key, value, expires_at)
+                self.persistent_hits += 1
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key, value):
+        """
+        Cache a value
+
+        Args:
+            key: Cache key
+            value: JSON serializable value
+        """
+        self.set_many({key: value})
+
+    def set_many(self, values):
+        """
+        Cache several values
+
+        Args:
+            values: Dict of key to JSON serializable value
+        """
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            for key, value in values.items():
+                self._remember(key, value, expires_at)
+            store = self._store
+
+        if store is not None and values:
+            store.set_many(values, expires_at)
+
+    def close(self):
+        """
+        Log the hit/miss counters and close the persistent tier
+
+        Returns:
+            Dict with the memory_hits, persistent_hits and misses counts
+        """
+        stats = {
+            'memory_hits': self.memory_hits,
+            'persistent_hits': self.persistent_hits,
+            'misses': self.misses
+        }
+        logger.info(f"Identity cache - memory hits: {self.memory_hits}, "
+                    f"persistent hits: {self.persistent_hits}, misses: {self.misses}")
+
+        with self._lock:
+            store, self._store = self._store, None
+        if store is not None:
+            store.close()
+        return stats
+
+    def _remember(self, key, value, expires_at):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class SQLiteIdentityStore:
+    """
+    Persistent identity cache tier in a local SQLite file
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS identity_cache '
+            '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self._db.commit()
+        logger.info(f"Using persistent identity cache: {path}")
+
+    def get_many(self, keys, now):
+        rows = []
+        with self._lock:
+            # Stay below SQLite's limit on the number of bound parameters
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                rows.extend(self._db.execute(
+                    f'SELECT key, value, expires_at FROM identity_cache '
+                    f'WHERE key IN ({placeholders}) AND expires_at > ?',
+                    chunk + [now]
+                ))
+        return [(key, json.loads(value), expires_at) for key, value, expires_at in rows]
+
+    def set_many(self, values, expires_at):
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO identity_cache (key, value, expires_at) VALUES (?, ?, ?)',
+                [(key, json.dumps(value), expires_at) for key, value in values.items()]
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.execute('DELETE FROM identity_cache WHERE expires_at <= ?', (time.time(),))
+            self._db.commit()
+            self._db.close()
+
+
+class DynamoDBIdentityStore:
+    """
+    Persistent identity cache tier as items of the state table, keyed on IDENTITY#<cache key>
+
+    Items carry their expiry in the expires_at attribute, the TTL attribute of
+    the table. Requests share the DynamoDB rate limiter. A cache
+    that cannot be read or written only costs lookups, so failures are logged
+    and read as misses.
+    """
+
+    def __init__(self, ddb_client, table_name):
+        self.ddb_client = ddb_client
+        self.table_name = table_name
+        logger.info(f"Using persistent identity cache in DynamoDB table {table_name}")
+
+    def get_many(self, keys, now):
+        entries = []
+        try:
+            for start in range(0, len(keys), MAX_BATCH_GET_SIZE):
+                for item in self._batch_get(keys[start:start + MAX_BATCH_GET_SIZE]):
+                    expires_at = float(item['expires_at']['N'])
+                    if expires_at > now:
+                        key = item[settings.DDB_STATE_PARTITION_KEY]['S'][len('IDENTITY#'):]
+                        entries.append((key, json.loads(item['value']['S']), expires_at))
+        except ClientError as e:
+            logger.warning(f"Cannot read the identity cache: {e.response['Error']['Message']}")
+        return entries
+
+    def set_many(self, values, expires_at):
+        writer = BatchWriter(self.ddb_client, self.table_name)
+        try:
+            for key, value in values.items():
+                item = self._key(key)
+                item['value'] = {'S': json.dumps(value)}
+                item['expires_at'] = {'N': str(int(expires_at))}
+                writer.put(item)
+            writer.flush()
+        except ClientError as e:
+            logger.warning(f"Cannot write the identity cache: {e.response['Error']['Message']}")
+        if writer.failed:
+            logger.warning(f"Could not cache {writer.failed} identity values")
+
+    def close(self):
+        pass
+
+    def _batch_get(self, keys):
+        request = {self.table_name: {'Keys': [self._key(key) for key in keys]}}
+        attempt = 0
+        while request:
+            limiter = rate_limiter.get_limiter('Ddb')
+            response = rate_limiter.call_with_retry(limiter, self.ddb_client.batch_get_item, RequestItems=request)
+            metrics.increment('DdbApiCalls')
+            yield from response.get('Responses', {}).get(self.table_name, [])
+
+            request = response.get('UnprocessedKeys')
+            if not request:
+                return
+            # Unprocessed keys are DynamoDB's way of throttling part of a batch
+            limiter.on_throttle()
+            attempt += 1
+            if attempt > settings.DDB_MAX_RETRIES:
+                logger.warning("Giving up on unprocessed identity cache keys, they are looked up again")
+                return
+            time.sleep(min(settings.DDB_MAX_BACKOFF, settings.DDB_BASE_BACKOFF * 2 ** attempt))
+
+    def _key(self, key):
+        return {settings.DDB_STATE_PARTITION_KEY: {'S': f"IDENTITY#{key}"}}
+
+
+def open_identity_store(ddb_client):
+    """
+    Open the persistent tier of the identity cache
+
+    The store is chosen with settings.IDENTITY_CACHE_STORE: 'none', 'sqlite'
+    (the file settings.IDENTITY_CACHE_PATH) or 'dynamodb' (items in
+    settings.DDB_STATE_TABLE_NAME, which outlive the containers of AWS Batch jobs).
+
+    Args:
+        ddb_client: DynamoDB client for the 'dynamodb' store
+
+    Returns:
+        SQLiteIdentityStore, DynamoDBIdentityStore, or None for 'none'
+
+    Raises:
+        ValueError: If settings.IDENTITY_CACHE_STORE is unknown, 'sqlite'
+            without settings.IDENTITY_CACHE_PATH or 'dynamodb' without
+            settings.DDB_STATE_TABLE_NAME
+    """
+    if settings.IDENTITY_CACHE_STORE == 'none':
+        return None
+    if settings.IDENTITY_CACHE_STORE == 'sqlite':
+        if not settings.IDENTITY_CACHE_PATH:
+            raise ValueError("IDENTITY_CACHE_PATH is required for the sqlite identity cache")
+        return SQLiteIdentityStore(settings.IDENTITY_CACHE_PATH)
+    if settings.IDENTITY_CACHE_STORE == 'dynamodb':
+        if not settings.DDB_STATE_TABLE_NAME:
+            raise ValueError("DDB_STATE_TABLE_NAME is required for the dynamodb identity cache")
+        return DynamoDBIdentityStore(ddb_client, settings.DDB_STATE_TABLE_NAME)
+    raise ValueError(f"Unknown identity cache store: {settings.IDENTITY_CACHE_STORE}")
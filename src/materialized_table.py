@@ -0,0 +1,339 @@
+import re
+import time
+import boto3
+import logging
+from datetime import datetime
+from urllib.parse import urlparse
+
+from botocore.exceptions import ClientError
+
+import metrics
+import query_athena
+import settings
+
+session = boto3.Session()
+glue_client = session.client('glue')
+s3_client = session.client('s3')
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# Keeps the CUR column names the cost queries use, with one row per user, line
+# item type and billing period instead of one per line item
+CREATE_TABLE_STATEMENT = '''
+    CREATE EXTERNAL TABLE IF NOT EXISTS {0} (
+        line_item_product_code string,
+        line_item_operation string,
+        line_item_resource_id string,
+        line_item_line_item_type string,
+        line_item_unblended_cost double
+    )
+    PARTITIONED BY (billing_period string)
+    STORED AS PARQUET
+    LOCATION '{1}'
+    TBLPROPERTIES ('parquet.compression'='SNAPPY')
+    '''
+
+# The partition column goes last in INSERT INTO
+REFRESH_STATEMENT = '''
+    INSERT INTO {0}
+    SELECT line_item_product_code, line_item_operation, line_item_resource_id, line_item_line_item_type,
+    sum(line_item_unblended_cost) AS line_item_unblended_cost, billing_period
+    FROM {1}
+    WHERE billing_period IN ({2})
+    AND line_item_product_code='AmazonQ'
+    AND line_item_operation='number-q-dev-subscriptions'
+    GROUP BY billing_period, line_item_product_code, line_item_operation, line_item_resource_id,
+    line_item_line_item_type
+    '''
+
+BILLING_PERIOD_PATTERN = re.compile(r'^\d{4}-\d{2}$')
+
+# Written to the partition of a billing period after it is refreshed, so a billing
+# period without Q Developer rows is known to be materialized. Athena skips files
+# whose names start with an underscore.
+REFRESHED_MARKER = '_refreshed'
+
+# Set once the table is known to exist in this run
+table_created = False
+
+
+def refresh(start_period, end_period, lock_store):
+    """
+    Bring the billing periods of a run up to date in the materialized table
+
+    The billing periods are locked in lock_store while they are checked and
+    refreshed, so overlapping runs and the shards of a sharded run never
+    delete and insert a billing period at the same time, or query it while it
+    is refreshed. Runs waiting for a lock find the billing period up to date
+    once they get it. Locks older than settings.MATERIALIZED_LOCK_TIMEOUT,
+    left by a run that died, are taken over.
+
+    Args:
+        start_period: First billing period (YYYY-MM)
+        end_period: Last billing period (YYYY-MM)
+        lock_store: FileCheckpointStore or DynamoDBCheckpointStore holding the locks
+
+    Raises:
+        ValueError: If a billing period is not YYYY-MM
+        TimeoutError: If a billing period stays locked longer than settings.MATERIALIZED_LOCK_TIMEOUT
+    """
+    periods = billing_periods(start_period, end_period)
+    locked = []
+    try:
+        # Locks are taken in billing period order, so overlapping ranges cannot deadlock
+        for period in periods:
+            acquire_lock(lock_store, period)
+            locked.append(period)
+        refresh_periods(periods)
+    finally:
+        for period in locked:
+            lock_store.release(_lock_key(period))
+
+
+def acquire_lock(lock_store, period):
+    """
+    Wait until a billing period of the materialized table is locked for this run
+
+    Args:
+        lock_store: FileCheckpointStore or DynamoDBCheckpointStore holding the locks
+        period: Billing period (YYYY-MM)
+
+    Raises:
+        TimeoutError: If the lock is not acquired within settings.MATERIALIZED_LOCK_TIMEOUT
+    """
+    key = _lock_key(period)
+    if lock_store.claim(key, max_age=settings.MATERIALIZED_LOCK_TIMEOUT):
+        return
+
+    logger.info(f"Waiting for another run to refresh billing period {period}")
+    # The lock becomes stale, and is taken over, within the timeout at the latest
+    deadline = time.monotonic() + settings.MATERIALIZED_LOCK_TIMEOUT + settings.ATHENA_POLL_MAX_INTERVAL
+    while not lock_store.claim(key, max_age=settings.MATERIALIZED_LOCK_TIMEOUT):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Billing period {period} stayed locked for "
+                               f"{settings.MATERIALIZED_LOCK_TIMEOUT} seconds")
+        time.sleep(settings.ATHENA_POLL_MAX_INTERVAL)
+
+
+def refresh_periods(periods):
+    """
+    Materialize the billing periods that are new or restated
+
+    A billing period is refreshed when it is not in the table yet, or when its
+    CUR data in S3 was modified after it was last materialized, e.g. because
+    the billing period was restated. Its objects are removed and it is inserted
+    again with INSERT INTO, in one statement for all stale billing periods.
+    Each refreshed billing period then gets a REFRESHED_MARKER object, which
+    also dates the billing periods the statement wrote no rows for.
+
+    Args:
+        periods: List of billing periods (YYYY-MM)
+
+    Returns:
+        List of the billing periods that were refreshed
+    """
+    create_table()
+
+    source_location = get_source_location()
+    stale_periods = [period for period in periods if is_stale(period, source_location)]
+    if not stale_periods:
+        logger.info(f"Materialized table {settings.MATERIALIZED_TABLE_NAME} is up to date")
+        return []
+
+    logger.info(f"Refreshing billing periods {', '.join(stale_periods)} in {settings.MATERIALIZED_TABLE_NAME}")
+    for period in stale_periods:
+        delete_partition(period)
+    query_athena.run_statement(REFRESH_STATEMENT.format(
+        settings.MATERIALIZED_TABLE_NAME,
+        settings.ATHENA_TABLE_NAME,
+        ', '.join(f"'{period}'" for period in stale_periods)
+    ))
+    for period in stale_periods:
+        mark_refreshed(period)
+
+    metrics.increment('MaterializedPeriodsRefreshed', len(stale_periods))
+    return stale_periods
+
+
+def billing_periods(start_period, end_period):
+    """
+    List the billing periods of a range
+
+    Args:
+        start_period: First billing period (YYYY-MM)
+        end_period: Last billing period (YYYY-MM)
+
+    Returns:
+        List of billing periods (YYYY-MM), in order
+
+    Raises:
+        ValueError: If a billing period is not YYYY-MM
+    """
+    for period in (start_period, end_period):
+        if not BILLING_PERIOD_PATTERN.match(period):
+            raise ValueError(f"Invalid billing period: {period}")
+
+    start = datetime.strptime(start_period, '%Y-%m')
+    end = datetime.strptime(end_period, '%Y-%m')
+    periods = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        periods.append(f"{year}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return periods
+
+
+def create_table():
+    """
+    Create the materialized table unless it exists
+    """
+    global table_created
+    if table_created:
+        return
+
+    query_athena.run_statement(CREATE_TABLE_STATEMENT.format(settings.MATERIALIZED_TABLE_NAME, get_table_location()))
+    table_created = True
+
+
+def get_table_location():
+    """
+    Get the S3 location of the materialized table
+
+    Returns:
+        settings.MATERIALIZED_TABLE_LOCATION, or a prefix named after the table
+        in settings.RESULT_LOCATION, ending with a slash
+    """
+    location = settings.MATERIALIZED_TABLE_LOCATION
+    if not location:
+        location = f"{settings.RESULT_LOCATION.rstrip('/')}/{settings.MATERIALIZED_TABLE_NAME}"
+    return location.rstrip('/') + '/'
+
+
+def get_source_location():
+    """
+    Get the S3 location of the CUR table from the Glue Data Catalog
+
+    Returns:
+        Location ending with a slash, or None if it cannot be read
+    """
+    try:
+        table = glue_client.get_table(DatabaseName=settings.DATABASE_NAME, Name=settings.ATHENA_TABLE_NAME)['Table']
+    except ClientError as e:
+        logger.warning(f"Cannot read the location of {settings.ATHENA_TABLE_NAME}: {e.response['Error']['Message']}")
+        return None
+    location = table.get('StorageDescriptor', {}).get('Location')
+    return location.rstrip('/') + '/' if location else None
+
+
+def is_stale(period, source_location):
+    """
+    Check whether a billing period must be materialized again
+
+    Args:
+        period: Billing period (YYYY-MM)
+        source_location: S3 location of the CUR table, or None if unknown
+
+    Returns:
+        True if the billing period was never refreshed, or its CUR data was
+        modified after it was refreshed or cannot be checked
+    """
+    materialized = last_modified(get_table_location(), period)
+    if materialized is None:
+        logger.info(f"Billing period {period} is not materialized yet")
+        return True
+    if source_location is None:
+        logger.warning(f"Cannot check billing period {period} for restatements, refreshing it")
+        return True
+
+    source = last_modified(source_location, period)
+    if source is None:
+        logger.warning(f"No CUR data found for billing period {period} in {source_location}, refreshing it")
+        return True
+    if source > materialized:
+        logger.info(f"Billing period {period} was restated at {source.isoformat()}")
+        return True
+    return False
+
+
+def last_modified(location, period):
+    """
+    Get when the data of a billing period under a table location last changed
+
+    The partition prefix is matched without regard to case, since CUR data
+    exports write BILLING_PERIOD=YYYY-MM and tables created by Athena
+    billing_period=YYYY-MM.
+
+    Args:
+        location: S3 location of a table, ending with a slash
+        period: Billing period (YYYY-MM)
+
+    Returns:
+        Latest LastModified of the objects of the billing period, or None if there are none
+    """
+    bucket, prefix = _split_location(location)
+    latest = None
+    for partition_prefix in _partition_prefixes(bucket, prefix, period):
+        for s3_object in _list_objects(bucket, partition_prefix):
+            if latest is None or s3_object['LastModified'] > latest:
+                latest = s3_object['LastModified']
+    return latest
+
+
+def delete_partition(period):
+    """
+    Remove the objects of a billing period from the materialized table
+
+    Args:
+        period: Billing period (YYYY-MM)
+    """
+    bucket, prefix = _split_location(get_table_location())
+    deleted = 0
+    for partition_prefix in _partition_prefixes(bucket, prefix, period):
+        keys = [{'Key': s3_object['Key']} for s3_object in _list_objects(bucket, partition_prefix)]
+        # DeleteObjects takes at most 1000 keys
+        for start in range(0, len(keys), 1000):
+            s3_client.delete_objects(Bucket=bucket, Delete={'Objects': keys[start:start + 1000], 'Quiet': True})
+        deleted += len(keys)
+    logger.info(f"Removed {deleted} materialized objects of billing period {period}")
+
+
+def mark_refreshed(period):
+    """
+    Record in the materialized table that a billing period was refreshed
+
+    Args:
+        period: Billing period (YYYY-MM)
+    """
+    bucket, prefix = _split_location(get_table_location())
+    s3_client.put_object(Bucket=bucket, Key=f"{prefix}billing_period={period}/{REFRESHED_MARKER}", Body=b'')
+
+
+def _lock_key(period):
+    """Key of the lock of a billing period of the materialized table"""
+    return f"materialize#{settings.DATABASE_NAME}.{settings.MATERIALIZED_TABLE_NAME}#{period}"
+
+
+def _partition_prefixes(bucket, prefix, period):
+    """List the prefixes of a billing period partition under a table prefix"""
+    partition = f"billing_period={period}/"
+    paginator = s3_client.get_paginator('list_objects_v2')
+    prefixes = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            if common_prefix['Prefix'][len(prefix):].lower() == partition:
+                prefixes.append(common_prefix['Prefix'])
+    return prefixes
+
+
+def _list_objects(bucket, prefix):
+    """Iterate over the objects under a prefix"""
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        yield from page.get('Contents', [])
+
+
+def _split_location(location):
+    """Split an s3:// location into bucket and key prefix"""
+    parsed = urlparse(location)
+    return parsed.netloc, parsed.path.lstrip('/')
@@ -0,0 +1,120 @@
+import json
+import sys
+import threading
+import time
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+
+import settings
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# CloudWatch accepts at most 100 metrics per Embedded Metric Format document
+MAX_METRICS_PER_DOCUMENT = 100
+
+_lock = threading.Lock()
+_values = defaultdict(float)
+_units = {}
+
+
+@contextmanager
+def timer(name):
+    """
+    Record the wall time of a block as a metric in seconds
+
+    Time recorded from several threads adds up, so stages that run in
+    parallel can report more time than the run took.
+
+    Args:
+        name: Metric name
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record(name, time.monotonic() - start, 'Seconds')
+
+
+def increment(name, value=1):
+    """
+    Add to a count metric
+
+    Args:
+        name: Metric name
+        value: Amount to add
+    """
+    record(name, value, 'Count')
+
+
+def record(name, value, unit):
+    """
+    Add to a metric
+
+    Args:
+        name: Metric name
+        value: Amount to add
+        unit: CloudWatch unit of the metric, e.g. Seconds, Count or Bytes
+    """
+    with _lock:
+        _values[name] += value
+        _units[name] = unit
+
+
+def snapshot():
+    """
+    Get the current metric values
+
+    Returns:
+        Dict of metric name to value
+    """
+    with _lock:
+        return dict(_values)
+
+
+def reset():
+    """
+    Clear all recorded metrics
+    """
+    with _lock:
+        _values.clear()
+        _units.clear()
+
+
+def emit(stream=None):
+    """
+    Write the recorded metrics as CloudWatch Embedded Metric Format JSON
+
+    AWS Batch sends stdout to CloudWatch Logs, which turns the documents into
+    metrics in settings.METRICS_NAMESPACE with a Service dimension.
+
+    Args:
+        stream: File to write to (default: stdout)
+    """
+    if not settings.METRICS_ENABLED:
+        return
+
+    with _lock:
+        values = dict(_values)
+        units = dict(_units)
+
+    names = sorted(values)
+    for start in range(0, len(names), MAX_METRICS_PER_DOCUMENT):
+        chunk = names[start:start + MAX_METRICS_PER_DOCUMENT]
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': settings.METRICS_NAMESPACE,
+                    'Dimensions': [['Service']],
+                    'Metrics': [{'Name': name, 'Unit': units[name]} for name in chunk]
+                }]
+            },
+            'Service': settings.METRICS_SERVICE_NAME
+        }
+        for name in chunk:
+            document[name] = values[name]
+        print(json.dumps(document), file=stream or sys.stdout, flush=True)
+
+    logger.info(f"Emitted {len(names)} metrics")
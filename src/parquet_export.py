@@ -0,0 +1,188 @@
+import os
+import tempfile
+import boto3
+import logging
+from urllib.parse import urlparse
+
+import metrics
+import settings
+import sharding
+
+session = boto3.Session()
+s3_client = session.client('s3')
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# Columns of the exported files, the billing period is the partition directory
+COLUMNS = ['user_id', 'email', 'cost_center', 'cost']
+
+
+class ParquetExport:
+    """
+    Export of the per-user chargeback rows of a billing period as a Parquet file
+
+    Rows are written to a local temporary file in row groups of
+    settings.PARQUET_EXPORT_ROW_GROUP_SIZE rows as they are added, so memory
+    use does not grow with the number of users. On publish the file becomes
+    <location>/billing_period=<YYYY-MM>/part.parquet, in S3 or a local
+    directory, and replaces the files of earlier runs of the billing period.
+    Each shard of a sharded run publishes its own part.
+    """
+
+    def __init__(self, location, time_period, track_users=False):
+        self.location = location.rstrip('/')
+        self.time_period = time_period
+        # Users added so far, only kept for billing periods resumed from a checkpoint
+        self.user_ids = set() if track_users else None
+        self._pyarrow, self._parquet = _import_pyarrow()
+        self._schema = self._pyarrow.schema([
+            ('user_id', self._pyarrow.string()),
+            ('email', self._pyarrow.string()),
+            ('cost_center', self._pyarrow.string()),
+            ('cost', self._pyarrow.float64())
+        ])
+        self.rows = 0
+        self._buffer = {column: [] for column in COLUMNS}
+        temp_file = tempfile.NamedTemporaryFile(suffix='.parquet', delete=False)
+        temp_file.close()
+        self._temp_path = temp_file.name
+        self._writer = self._parquet.ParquetWriter(self._temp_path, self._schema,
+                                                   compression=settings.PARQUET_EXPORT_COMPRESSION)
+
+    def add(self, user_id, email, cost_center, cost):
+        """
+        Add the row of a user, writing a row group when enough rows are buffered
+
+        Args:
+            user_id: User ID
+            email: Email of the user
+            cost_center: Cost center of the user
+            cost: Allocated cost, including the tax/refund share
+        """
+        self._buffer['user_id'].append(user_id)
+        self._buffer['email'].append(email)
+        self._buffer['cost_center'].append(cost_center)
+        self._buffer['cost'].append(float(cost))
+        self.rows += 1
+        if self.user_ids is not None:
+            self.user_ids.add(user_id)
+        if len(self._buffer['user_id']) >= settings.PARQUET_EXPORT_ROW_GROUP_SIZE:
+            self._write_row_group()
+
+    def add_stored(self, items):
+        """
+        Add the stored items of the users not added in this run
+
+        Used for billing periods resumed from a checkpoint, whose users written
+        before the restart were skipped. Requires track_users.
+
+        Args:
+            items: Dict mapping user ID to a dict with 'email', 'cost_center' and 'cost'
+        """
+        for user_id, item in sorted(items.items()):
+            if user_id not in self.user_ids:
+                self.add(user_id, item['email'], item['cost_center'], item['cost'])
+
+    def publish(self):
+        """
+        Write the remaining rows and move the file to its partition
+
+        Files of earlier runs in the partition that this run replaces are removed.
+        """
+        self._write_row_group()
+        self._writer.close()
+        name = f"part{sharding.run_suffix()}.parquet"
+        try:
+            if self.location.startswith('s3://'):
+                self._publish_s3(name)
+            else:
+                self._publish_local(name)
+        finally:
+            _remove(self._temp_path)
+
+        metrics.increment('ParquetRowsExported', self.rows)
+        logger.info(f"Exported {self.rows} rows of {self.time_period} to {self._partition()}")
+
+    def discard(self):
+        """
+        Drop the export without publishing it
+        """
+        self._writer.close()
+        _remove(self._temp_path)
+
+    def _write_row_group(self):
+        if not self._buffer['user_id']:
+            return
+        self._writer.write_table(self._pyarrow.table(self._buffer, schema=self._schema))
+        self._buffer = {column: [] for column in COLUMNS}
+
+    def _partition(self):
+        return f"{self.location}/billing_period={self.time_period}"
+
+    def _publish_local(self, name):
+        directory = self._partition()
+        os.makedirs(directory, exist_ok=True)
+        os.replace(self._temp_path, os.path.join(directory, name))
+        for existing in os.listdir(directory):
+            if existing != name and owns_file(existing):
+                os.remove(os.path.join(directory, existing))
+
+    def _publish_s3(self, name):
+        parsed = urlparse(self._partition())
+        bucket, prefix = parsed.netloc, parsed.path.lstrip('/') + '/'
+        key = prefix + name
+        s3_client.upload_file(self._temp_path, bucket, key)
+
+        paginator = s3_client.get_paginator('list_objects_v2')
+        stale_keys = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            stale_keys.extend({'Key': s3_object['Key']} for s3_object in page.get('Contents', [])
+                              if s3_object['Key'] != key and owns_file(s3_object['Key'][len(prefix):]))
+        # DeleteObjects takes at most 1000 keys
+        for start in range(0, len(stale_keys), 1000):
+            s3_client.delete_objects(Bucket=bucket, Delete={'Objects': stale_keys[start:start + 1000], 'Quiet': True})
+
+
+def owns_file(name):
+    """
+    Check whether this run replaces an exported file of a billing period
+
+    An unsharded run replaces all files. A shard replaces its own part, and
+    shard 0 also the parts of unsharded runs and of runs with a different
+    number of shards.
+
+    Args:
+        name: File name in the partition
+
+    Returns:
+        True if this run may remove the file
+    """
+    if not sharding.is_sharded():
+        return True
+    if name == f"part{sharding.run_suffix()}.parquet":
+        return True
+    return settings.SHARD_INDEX == 0 and not name.endswith(f"-of-{settings.SHARD_COUNT}.parquet")
+
+
+def _remove(path):
+    """Remove a file if it exists"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _import_pyarrow():
+    """Import pyarrow, which is only needed for the Parquet export"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ParquetExportError("The Parquet export needs pyarrow: pip install pyarrow")
+    return pyarrow, pyarrow.parquet
+
+
+class ParquetExportError(Exception):
+    """Custom exception for Parquet export errors"""
+    pass
@@ -1,12 +1,29 @@
+import argparse
 import boto3
+import cProfile
+import multiprocessing
 import sys
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from decimal import Decimal
+from itertools import chain, groupby, islice
 import logging
 from logging_config import setup_logging
 
+import metrics
 import settings
-import query_athena
+import query_backend
 import query_idc
+import rate_limiter
+import materialized_table
+import sharding
+from checkpoint import open_checkpoint, open_lock_store
+from parquet_export import ParquetExport
+from ddb_writer import ROLLUP_PREFIX, BatchWriter, DynamoDBWriteError, load_period_items, load_period_rollups
 
 # Setup logging at application startup
 setup_logging(level=logging.INFO)
@@ -21,129 +38,934 @@ SUBSCRIPTION_COST_QUERY='''
     WHERE billing_period=? 
     AND line_item_product_code='AmazonQ' 
     AND line_item_operation='number-q-dev-subscriptions'
-    GROUP BY line_item_resource_id;
+    GROUP BY line_item_resource_id
+    ORDER BY line_item_resource_id;
     '''
 
+# The grand total row (cost_type is NULL) carries the number of subscribed users,
+# which is needed to spread tax/refunds when there is no subscription cost
 TOTAL_COST_QUERY='''
     SELECT CASE WHEN line_item_line_item_type = 'Usage' THEN 'Subscription'
-    ELSE 'Others' END AS cost_type, sum(line_item_unblended_cost) as total_cost 
+    ELSE 'Others' END AS cost_type, sum(line_item_unblended_cost) as total_cost,
+    count(DISTINCT line_item_resource_id) as user_count
     FROM {0} 
     where line_item_product_code ='AmazonQ' and billing_period=? 
     and line_item_operation='number-q-dev-subscriptions'
-    GROUP BY CASE WHEN line_item_line_item_type = 'Usage' THEN 'Subscription'
-    ELSE 'Others' END 
+    GROUP BY GROUPING SETS ((CASE WHEN line_item_line_item_type = 'Usage' THEN 'Subscription'
+    ELSE 'Others' END), ())
     '''
 
+# Per-user costs and the Subscription/Others totals from a single scan of the CUR table.
+# row_group is grouping(resource_id, cost_type): 1 for per-user rows, 2 for the
+# per cost type totals and 3 for the grand total. Totals are sorted first so they
+# are known before the per-user rows are streamed.
+COST_BREAKDOWN_QUERY='''
+    SELECT resource_id, cost_type, sum(cost) as cost,
+    count(DISTINCT resource_id) as user_count,
+    grouping(resource_id, cost_type) as row_group
+    FROM (
+        SELECT line_item_resource_id as resource_id,
+        CASE WHEN line_item_line_item_type = 'Usage' THEN 'Subscription'
+        ELSE 'Others' END AS cost_type, line_item_unblended_cost as cost
+        FROM {0}
+        WHERE billing_period=? 
+        AND line_item_product_code='AmazonQ' 
+        AND line_item_operation='number-q-dev-subscriptions'
+    )
+    GROUP BY GROUPING SETS ((resource_id), (cost_type), ())
+    ORDER BY row_group DESC, resource_id
+    '''
+
+# Same breakdown as COST_BREAKDOWN_QUERY for every billing period in a range,
+# used to backfill several months with a single scan
+RANGE_COST_BREAKDOWN_QUERY='''
+    SELECT billing_period, resource_id, cost_type, sum(cost) as cost,
+    count(DISTINCT resource_id) as user_count,
+    grouping(resource_id, cost_type) as row_group
+    FROM (
+        SELECT billing_period, line_item_resource_id as resource_id,
+        CASE WHEN line_item_line_item_type = 'Usage' THEN 'Subscription'
+        ELSE 'Others' END AS cost_type, line_item_unblended_cost as cost
+        FROM {0}
+        WHERE billing_period BETWEEN ? AND ?
+        AND line_item_product_code='AmazonQ' 
+        AND line_item_operation='number-q-dev-subscriptions'
+    )
+    GROUP BY GROUPING SETS ((billing_period, resource_id), (billing_period, cost_type), (billing_period))
+    ORDER BY row_group DESC, billing_period, resource_id
+    '''
+
+USER_ROW_GROUP = '1'
+
 session = boto3.Session()
 ddb_client = session.client('dynamodb')
 
 def get_q_dev_cost_per_month(year, month):
     """
     Get Q Developer subscription costs for a specific month
+
+    With checkpointing enabled, a restarted run reuses the finished queries and
+    skips the users written before. In a sharded run only the users of the
+    shard are saved, and the shards share the queries through the checkpoint store.
+    With settings.MATERIALIZED_TABLE_NAME set, the billing period is refreshed
+    in the materialized table if needed and queried there. The queries run on
+    the backend selected with settings.QUERY_BACKEND.
+
+    Raises:
+        UserResolutionError: If users could not be resolved, after all other users were saved
     """
     logger.info(f"Getting Q Developer costs for year={year}, month={month}")
     try:
-        subscription_cost_results = query_athena.run_query(SUBSCRIPTION_COST_QUERY, year, month)
-        total_cost_results = query_athena.run_query(TOTAL_COST_QUERY, year, month)
-        save_cost_per_user(subscription_cost_results, total_cost_results, year, month)
+        checkpoint = open_checkpoint(f"month-{year}-{month}", ddb_client)
+        if settings.MATERIALIZED_TABLE_NAME and settings.QUERY_BACKEND == 'athena':
+            billing_period = f"{year}-{int(month):02d}"
+            materialized_table.refresh(billing_period, billing_period, open_lock_store(ddb_client))
+        backend = query_backend.get_backend()
+        if settings.ATHENA_QUERY_MODE == 'separate':
+            subscription_cost_results = backend.run_query(SUBSCRIPTION_COST_QUERY, year, month, checkpoint)
+            total_cost_results = backend.run_query(TOTAL_COST_QUERY, year, month, checkpoint)
+            totals = parse_total_cost_results(total_cost_results)
+            user_costs = parse_subscription_cost_results(subscription_cost_results)
+        else:
+            cost_breakdown_results = backend.run_query(COST_BREAKDOWN_QUERY, year, month, checkpoint)
+            totals, user_costs = split_cost_breakdown_results(cost_breakdown_results)
+
+        failed_users = save_cost_per_user(user_costs, totals, year, month, checkpoint=checkpoint)
+        finish_run(checkpoint, failed_users)
         logger.info("Successfully processed Q Developer costs for the month")
     except Exception as e:
         logger.error(f"Failed to get Q Developer costs: {str(e)}", exc_info=True)
         raise
 
-def save_cost_per_user(subscription_cost_results, total_cost_results, year, month):
+def get_q_dev_cost_for_range(start_period, end_period):
     """
-    Save cost data per user to DynamoDB
+    Get Q Developer subscription costs for every month in a range of billing periods
+
+    All months come from one Athena query. Each user is looked up in IDC once for
+    the whole range and all items go through one DynamoDB writer. With
+    settings.MATERIALIZED_TABLE_NAME set, the new and restated billing periods
+    are refreshed in the materialized table first.
+
+    The months are saved one after the other. Their users arrive as one result
+    stream ordered by billing period, most users of a month were already
+    resolved for the months before it, and the writer is used from one thread.
+    Saving months in parallel would buffer the results and look up the same
+    users several times. Within a month, settings.PIPELINE_MODE 'concurrent'
+    resolves and writes the users in parallel.
+
+    Args:
+        start_period: First billing period (YYYY-MM)
+        end_period: Last billing period (YYYY-MM)
+
+    Raises:
+        UserResolutionError: If users could not be resolved, after all other users were saved
     """
-    logger.info("Starting to save cost data per user")
+    logger.info(f"Getting Q Developer costs for billing periods {start_period} to {end_period}")
+    try:
+        checkpoint = open_checkpoint(f"range-{start_period}-{end_period}", ddb_client)
+        if settings.MATERIALIZED_TABLE_NAME and settings.QUERY_BACKEND == 'athena':
+            materialized_table.refresh(start_period, end_period, open_lock_store(ddb_client))
+        cost_breakdown_results = query_backend.get_backend().run_range_query(
+            RANGE_COST_BREAKDOWN_QUERY, start_period, end_period, checkpoint)
+        totals_by_period, user_costs_by_period = split_range_cost_breakdown_results(cost_breakdown_results)
+
+        writer = new_writer()
+        identities = {}
+        query_idc.plan_user_resolution(shard_user_count(max((totals[2] for totals in totals_by_period.values()),
+                                                            default=0)))
+        failed_users = 0
+        for billing_period, user_costs in user_costs_by_period:
+            year, month = billing_period.split('-')
+            failed_users += save_cost_per_user(user_costs, totals_by_period[billing_period], year, month,
+                                               writer=writer, identities=identities, checkpoint=checkpoint)
+
+        stats = writer.close()
+        if stats['failed']:
+            raise DynamoDBWriteError(f"Failed to save {stats['failed']} items")
+        finish_run(checkpoint, failed_users)
+
+        logger.info(f"Successfully processed Q Developer costs for {len(totals_by_period)} months")
+    except Exception as e:
+        logger.error(f"Failed to get Q Developer costs: {str(e)}", exc_info=True)
+        raise
 
-    #Get the Total Subscription cost and Total Tax/Refund
+def finish_run(checkpoint, failed_users):
+    """
+    Remove the checkpoint of a completed run, or fail the run if users are left
+
+    Args:
+        checkpoint: Checkpoint of the run or None
+        failed_users: Number of users that could not be resolved
+
+    Raises:
+        UserResolutionError: If failed_users is not 0, the checkpoint is kept so
+            a restarted run only retries these users
+    """
+    if failed_users:
+        raise UserResolutionError(f"{failed_users} users could not be resolved"
+                                  + (", they are kept in the checkpoint for the next run" if checkpoint else ""))
+    if checkpoint is not None:
+        checkpoint.clear()
+
+def new_writer():
+    """
+    Create the DynamoDB writer of a run
+
+    Returns:
+        BatchWriter sending settings.DDB_WRITE_CONCURRENCY batches in parallel in
+        the concurrent pipeline, and one batch at a time in the sequential one
+    """
+    concurrency = settings.DDB_WRITE_CONCURRENCY if settings.PIPELINE_MODE == 'concurrent' else 1
+    return BatchWriter(ddb_client, settings.DDB_TABLE_NAME, concurrency=concurrency)
+
+def shard_user_count(user_count):
+    """
+    Get the number of users a run resolves
+
+    Args:
+        user_count: Number of users in the billing period
+
+    Returns:
+        Number of users in the shard of this run, rounded up
+    """
+    return -(-user_count // settings.SHARD_COUNT)
+
+def parse_total_cost_results(total_cost_results):
+    """
+    Parse the rows of TOTAL_COST_QUERY
+
+    Args:
+        total_cost_results: Iterable of (cost_type, total_cost, user_count) rows
+
+    Returns:
+        Tuple of total subscription cost, total tax/refund cost and user count
+    """
     total_subscription_cost = 0
     total_other_cost = 0
+    user_count = 0
+
+    for row in total_cost_results:
+        if len(row) != 3:
+            continue
+
+        cost_type, total_cost, count = row
+        if cost_type == 'Subscription':
+            total_subscription_cost = float(total_cost)
+        elif cost_type == 'Others':
+            total_other_cost = float(total_cost)
+        elif not cost_type:
+            user_count = int(count)
+
+    return total_subscription_cost, total_other_cost, user_count
+
+def parse_subscription_cost_results(subscription_cost_results):
+    """
+    Parse the rows of SUBSCRIPTION_COST_QUERY as they are read
+
+    Args:
+        subscription_cost_results: Iterable of (line_item_resource_id, per_user_cost) rows
+
+    Yields:
+        Tuple of resource ID and cost
+    """
+    for row in subscription_cost_results:
+        if len(row) == 2:
+            yield row[0] or '', float(row[1])
+
+def split_cost_breakdown_results(cost_breakdown_results):
+    """
+    Split the rows of COST_BREAKDOWN_QUERY into totals and per-user costs
+
+    The totals rows are read eagerly, the per-user rows stay lazy.
+
+    Args:
+        cost_breakdown_results: Iterable of (resource_id, cost_type, cost, user_count, row_group) rows
+
+    Returns:
+        Tuple of the parsed totals (see parse_total_cost_results) and a generator
+        of (resource_id, cost) tuples
+    """
+    rows = iter(cost_breakdown_results)
+    total_cost_rows = []
+    user_cost_rows = iter(())
+
+    for resource_id, cost_type, cost, user_count, row_group in rows:
+        if row_group == USER_ROW_GROUP:
+            user_cost_rows = chain([(resource_id, cost)], ((row[0], row[2]) for row in rows))
+            break
+        total_cost_rows.append((cost_type, cost, user_count))
+
+    return parse_total_cost_results(total_cost_rows), parse_subscription_cost_results(user_cost_rows)
+
+def split_range_cost_breakdown_results(cost_breakdown_results):
+    """
+    Split the rows of RANGE_COST_BREAKDOWN_QUERY into totals and per-user costs by billing period
+
+    Args:
+        cost_breakdown_results: Iterable of (billing_period, resource_id, cost_type, cost, user_count, row_group) rows
+
+    Returns:
+        Tuple of a dict mapping billing period to its parsed totals, and a generator
+        of (billing_period, user_costs) pairs in billing period order, where
+        user_costs is a generator of (resource_id, cost) tuples
+    """
+    rows = iter(cost_breakdown_results)
+    total_cost_rows = defaultdict(list)
+    user_cost_rows = iter(())
+
+    for row in rows:
+        billing_period, resource_id, cost_type, cost, user_count, row_group = row
+        if row_group == USER_ROW_GROUP:
+            user_cost_rows = chain([row], rows)
+            break
+        total_cost_rows[billing_period].append((cost_type, cost, user_count))
+
+    totals_by_period = {
+        billing_period: parse_total_cost_results(total_cost_rows[billing_period])
+        for billing_period in total_cost_rows
+    }
+    user_costs_by_period = (
+        (billing_period, parse_subscription_cost_results((row[1], row[3]) for row in period_rows))
+        for billing_period, period_rows in groupby(user_cost_rows, key=lambda row: row[0])
+    )
+    return totals_by_period, user_costs_by_period
+
+def save_cost_per_user(user_costs, totals, year, month, writer=None, identities=None, checkpoint=None):
+    """
+    Save cost data per user to DynamoDB
 
+    User costs are consumed as they arrive, IDC_BATCH_SIZE users at a time,
+    so memory use does not grow with the number of users. With
+    settings.PIPELINE_MODE set to 'concurrent', up to IDC_CONCURRENCY chunks are
+    resolved in IDC in parallel while a separate stage writes the resolved
+    chunks to DynamoDB, in the same order as the sequential mode. With
+    settings.DDB_WRITE_MODE set to 'incremental', only items that differ from the
+    stored ones are written and, with DDB_DELETE_MISSING, users that no longer
+    appear in the billing period are removed. With settings.DDB_ROLLUP_ENABLED,
+    the costs are also summed up per cost center and written as rollup items.
+
+    Users that cannot be resolved do not stop the run. They are retried one at a
+    time once all other users are written, and the ones still failing are counted
+    and, with a checkpoint, kept in it. The checkpoint also records the last user
+    written, so a restarted run skips the users up to it. This relies on the
+    user costs being sorted by resource ID.
+
+    With settings.PARQUET_EXPORT_LOCATION set, the rows of the users are also
+    exported as a Parquet file of the billing period once all of them are
+    saved. For a resumed billing period the users written before the restart
+    are read back from DynamoDB for the export.
+
+    In a sharded run (settings.SHARD_COUNT above 1) only the users whose hashed
+    resource ID falls in settings.SHARD_INDEX are saved, with the totals of all
+    users, and the rollups of the shard are written as partial rollup items.
+
+    Args:
+        user_costs: Iterable of (resource_id, cost) tuples
+        totals: Tuple of total subscription cost, total tax/refund cost and user count
+        year: Year of the billing period
+        month: Month of the billing period
+        writer: Shared BatchWriter owned by the caller (default: one for this month)
+        identities: Dict of user ID to resolved email and cost center shared across
+            months, so each user is looked up only once (default: one for this month)
+        checkpoint: Checkpoint of the run, or None to start from the first user
+
+    Returns:
+        Number of users that could not be resolved
+    """
+    logger.info("Starting to save cost data per user")
+
+    export = None
     try:
-        for item in total_cost_results:
-            if 'Data' in item:
-                data = item['Data']
-                if len(data) == 2:
-                    cost_type = data[0]['VarCharValue']
-
-                    if cost_type =='Subscription':
-                        total_subscription_cost = float(data[1]['VarCharValue'])
-                    elif cost_type =='Others':
-                        total_other_cost = float(data[1]['VarCharValue'])
-                    
-        logger.info(f"Total costs - Subscription: {total_subscription_cost}, Other: {total_other_cost}")
-
-        # Get the user GUID and the corresponding cost
-        processed_users = 0
-        for item in subscription_cost_results:
-            if 'Data' in item:
-                data = item['Data']
-                if len(data) == 2:
-                    resource_id = data[0]['VarCharValue']
-                    # Ignore the first row with headers
-                    if resource_id == 'line_item_resource_id':
-                        continue
-
-                    cost = float(data[1]['VarCharValue'])
-                    email = query_idc.look_up_user_email(resource_id)
-                    cost_center = query_idc.look_up_cost_center(resource_id,settings.IDC_COST_CENTER_ATTRIBUTE)
-
-                    #Add any tax/refund to the total cost
-                    if(total_other_cost !=0):
-                        if(total_subscription_cost !=0):
-                            cost = cost + total_other_cost * (cost/total_subscription_cost)
-                        else:
-                            cost = cost + total_other_cost/(len(subscription_cost_results) - 1)
-
-                    try:
-                        ddb_client.put_item(
-                            TableName=settings.DDB_TABLE_NAME,
-                            Item={
-                                settings.DDB_PARTITION_KEY: {'S': resource_id.split("/")[-1]},
-                                settings.DDB_SORT_KEY: {'S': year + '-' + month},
-                                'email': {'S': email},
-                                'cost_center': {'S': cost_center},
-                                'cost': {'N': str(cost)}
-                            }
-                        )
-                        processed_users += 1
-                        logger.info(f"Saved data for user {resource_id}: {email}, {cost_center}, {cost}")
-                    except Exception as e:
-                        logger.error(f"Failed to save data for user {resource_id}: {str(e)}", exc_info=True)
-                        raise
-
-        logger.info(f"Successfully processed and saved data for {processed_users} users")
+        #Get the Total Subscription cost, Total Tax/Refund and number of users
+        total_subscription_cost, total_other_cost, user_count = totals
+        logger.info(f"Total costs - Subscription: {total_subscription_cost}, Other: {total_other_cost}, Users: {user_count}")
+        query_idc.plan_user_resolution(shard_user_count(user_count))
+
+        owns_writer = writer is None
+        if owns_writer:
+            writer = new_writer()
+        if identities is None:
+            identities = {}
+
+        stored_items = None
+        if settings.DDB_WRITE_MODE == 'incremental':
+            stored_items = load_period_items(ddb_client, settings.DDB_TABLE_NAME, year + '-' + month)
+
+        if sharding.is_sharded():
+            # Totals stay those of all users, so the tax/refund allocation is the same in every shard
+            user_costs = sharding.select_shard(user_costs)
+            if stored_items is not None:
+                stored_items = {user_id: item for user_id, item in stored_items.items() if sharding.in_shard(user_id)}
+
+        if checkpoint is not None:
+            progress = checkpoint.period(year + '-' + month)
+            resumed = progress['watermark'] is not None
+            user_costs = skip_written_users(user_costs, progress['watermark'], progress['failed_users'], stored_items)
+        else:
+            progress = {'failed_users': {}, 'rollups': {}}
+            resumed = False
+        failed_users = progress['failed_users']
+        rollups = progress['rollups'] if settings.DDB_ROLLUP_ENABLED else None
+        if settings.PARQUET_EXPORT_LOCATION:
+            export = ParquetExport(settings.PARQUET_EXPORT_LOCATION, year + '-' + month, track_users=resumed)
+
+        chunks = iter_chunks(user_costs, settings.IDC_BATCH_SIZE)
+        if settings.PIPELINE_MODE == 'concurrent':
+            processed_users = save_chunks_concurrently(chunks, totals, year, month, writer, identities,
+                                                       failed_users, stored_items, rollups, checkpoint, export)
+        else:
+            processed_users = 0
+            for chunk in chunks:
+                resolved = resolve_chunk(chunk, identities)
+                identities.update(resolved)
+                processed_users += write_chunk(chunk, resolved, totals, year, month, writer, failed_users,
+                                               stored_items, rollups, checkpoint, export)
+
+        if failed_users:
+            processed_users += retry_failed_users(failed_users, totals, year, month, writer, identities,
+                                                  stored_items, rollups, export)
+
+        if rollups is not None:
+            write_rollups(rollups, year, month, writer)
+
+        if stored_items and settings.DDB_DELETE_MISSING:
+            # Users written in this run were removed from stored_items by write_chunk
+            for user_id in stored_items:
+                logger.debug(f"Removing user {user_id} no longer in {year}-{month}")
+                writer.delete({
+                    settings.DDB_PARTITION_KEY: {'S': user_id},
+                    settings.DDB_SORT_KEY: {'S': year + '-' + month}
+                })
+
+        if owns_writer:
+            stats = writer.close()
+            if stats['failed']:
+                raise DynamoDBWriteError(f"Failed to save {stats['failed']} of {processed_users} users")
+        if checkpoint is not None:
+            writer.flush()
+            # Rollups include the users of items given up on, which a restart writes again
+            if not writer.failed:
+                checkpoint.save()
+
+        if export is not None:
+            if failed_users or writer.failed:
+                # The billing period is exported by the run that saves all of its users
+                export.discard()
+            else:
+                if resumed:
+                    removed = set(stored_items) if stored_items and settings.DDB_DELETE_MISSING else set()
+                    written_before = load_period_items(ddb_client, settings.DDB_TABLE_NAME, year + '-' + month)
+                    export.add_stored({user_id: item for user_id, item in written_before.items()
+                                       if user_id not in removed and sharding.in_shard(user_id)})
+                export.publish()
+            export = None
+
+        if failed_users:
+            logger.error(f"Could not resolve {len(failed_users)} users in {year}-{month}")
+        logger.info(f"Successfully processed and saved data for {processed_users} users in {year}-{month}")
+        return len(failed_users)
 
     except Exception as e:
         logger.error(f"Error in save_cost_per_user: {str(e)}", exc_info=True)
+        if export is not None:
+            export.discard()
         raise
 
+def save_chunks_concurrently(chunks, totals, year, month, writer, identities, failed_users, stored_items=None,
+                             rollups=None, checkpoint=None, export=None):
+    """
+    Resolve chunks in a thread pool and write them in order from a single writer thread
+
+    The writer thread sends the batches of a chunk in parallel through the
+    writer, and they are all written before the checkpoint watermark moves past
+    the chunk.
+
+    Args:
+        chunks: Iterable of lists of (resource_id, cost) tuples
+        totals: Tuple of total subscription cost, total tax/refund cost and user count
+        year: Year of the billing period
+        month: Month of the billing period
+        writer: BatchWriter, only used from the writer thread
+        identities: Dict of already resolved users, only updated from this thread
+        failed_users: Dict of resource ID to cost of the users that could not be
+            resolved, only updated from the writer thread
+        stored_items: Stored items of the billing period in incremental mode, only
+            used from the writer thread
+        rollups: Dict of cost center rollups to add the users to, only used from
+            the writer thread
+        checkpoint: Checkpoint to advance as chunks are written, only used from
+            the writer thread
+        export: ParquetExport to add the users to, only used from the writer thread
+
+    Returns:
+        Number of users written
+    """
+    processed_users = 0
+    resolving = deque()
+    writing = deque()
+    max_resolving = settings.IDC_CONCURRENCY * 2
+
+    resolve_pool = ThreadPoolExecutor(max_workers=settings.IDC_CONCURRENCY, thread_name_prefix='idc')
+    write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ddb')
+    write_failed = threading.Event()
+
+    def write(chunk, resolved):
+        # Chunks queued behind a failed write are not written, so the
+        # checkpoint watermark never passes the users of the failed chunk
+        if write_failed.is_set():
+            return 0
+        try:
+            return write_chunk(chunk, resolved, totals, year, month, writer,
+                               failed_users, stored_items, rollups, checkpoint, export)
+        except Exception:
+            write_failed.set()
+            raise
+
+    def hand_over_oldest():
+        nonlocal processed_users
+        chunk, future = resolving.popleft()
+        resolved = future.result()
+        identities.update(resolved)
+        writing.append(write_pool.submit(write, chunk, resolved))
+        # Keep the writer busy without letting resolved chunks pile up
+        while len(writing) > 2:
+            processed_users += writing.popleft().result()
+
+    try:
+        for chunk in chunks:
+            resolving.append((chunk, resolve_pool.submit(resolve_chunk, chunk, identities)))
+            if len(resolving) >= max_resolving:
+                hand_over_oldest()
+        while resolving:
+            hand_over_oldest()
+        while writing:
+            processed_users += writing.popleft().result()
+    finally:
+        resolve_pool.shutdown(wait=True, cancel_futures=True)
+        write_pool.shutdown(wait=True, cancel_futures=True)
+
+    return processed_users
+
+def iter_chunks(user_costs, size):
+    """
+    Split user costs into lists of at most size items as they are read
+    """
+    user_costs = iter(user_costs)
+    while True:
+        chunk = list(islice(user_costs, size))
+        if not chunk:
+            return
+        yield chunk
+
+def skip_written_users(user_costs, watermark, failed_users, stored_items=None):
+    """
+    Skip the users a previous run of a checkpoint has written
+
+    Args:
+        user_costs: Iterable of (resource_id, cost) tuples sorted by resource ID
+        watermark: Last resource ID written by the previous run, or None
+        failed_users: Dict of resource ID to cost of the users the previous run
+            could not resolve. It is emptied, as these users are passed on again.
+        stored_items: Stored items of the billing period in incremental mode.
+            Skipped users are removed from it, so they are not deleted as missing.
+
+    Returns:
+        Generator of (resource_id, cost) tuples of the users still to write
+    """
+    # Emptied before the writer thread of the concurrent pipeline can add to it
+    retry = set(failed_users)
+    failed_users.clear()
+
+    def users_to_write():
+        skipped = 0
+        for resource_id, cost in user_costs:
+            if watermark is None or resource_id > watermark or resource_id in retry:
+                yield resource_id, cost
+                continue
+            skipped += 1
+            if stored_items is not None:
+                stored_items.pop(resource_id.split("/")[-1], None)
+
+        if skipped:
+            logger.info(f"Skipped {skipped} users written before the checkpoint")
+            metrics.increment('UsersSkipped', skipped)
+
+    return users_to_write()
+
+def retry_failed_users(failed_users, totals, year, month, writer, identities, stored_items=None, rollups=None,
+                       export=None):
+    """
+    Look up the users that could not be resolved again, one at a time
+
+    Users that fail again are put back into failed_users.
+
+    Args:
+        failed_users: Dict of resource ID to cost of the users to retry
+        totals: Tuple of total subscription cost, total tax/refund cost and user count
+        year: Year of the billing period
+        month: Month of the billing period
+        writer: BatchWriter
+        identities: Dict of already resolved users
+        stored_items: Stored items of the billing period in incremental mode
+        rollups: Dict of cost center rollups to add the users to
+        export: ParquetExport to add the users to
+
+    Returns:
+        Number of users processed
+    """
+    logger.info(f"Retrying {len(failed_users)} users that could not be resolved")
+    retry = sorted(failed_users.items())
+    failed_users.clear()
+
+    processed_users = 0
+    for chunk in iter_chunks(retry, 1):
+        resolved = resolve_chunk(chunk, identities)
+        identities.update(resolved)
+        processed_users += write_chunk(chunk, resolved, totals, year, month, writer, failed_users,
+                                       stored_items, rollups, export=export)
+    return processed_users
+
+def resolve_chunk(chunk, identities):
+    """
+    Resolve email and cost center for the users of a chunk
+
+    Users not in identities are looked up in batched IDC requests, with single user
+    lookups for the ones the batch lookup does not return. Users that cannot be
+    resolved one at a time are logged and left out. A failing batch request, an
+    invalid configuration or a request rejected for its permissions fails every
+    user, so these errors are raised and stop the run.
+
+    Args:
+        chunk: List of (resource_id, cost) tuples
+        identities: Dict of already resolved users, not modified
+
+    Returns:
+        Dict of user ID to resolved email and cost center for the users of the chunk
+
+    Raises:
+        ValueError: If the IDC settings are missing
+        query_idc.UserDataFetchError: If a batch request fails, or a single user
+            lookup is rejected with query_idc.IdentityStoreAccessError
+    """
+    with metrics.timer('IdcResolutionTime'):
+        resolved = {}
+        unresolved = []
+        for resource_id, _ in chunk:
+            user_id = resource_id.split("/")[-1]
+            if user_id in identities:
+                resolved[user_id] = identities[user_id]
+            else:
+                unresolved.append(resource_id)
+
+        if unresolved:
+            try:
+                resolved.update(query_idc.look_up_users(unresolved, settings.IDC_COST_CENTER_ATTRIBUTE))
+            except Exception as e:
+                logger.error(f"Failed to look up {len(unresolved)} users: {str(e)}")
+                raise
+
+        for resource_id in unresolved:
+            user_id = resource_id.split("/")[-1]
+            if user_id in resolved:
+                continue
+            # Not returned by the batch lookup, fall back to the single user lookups
+            try:
+                resolved[user_id] = {
+                    'email': query_idc.look_up_user_email(resource_id),
+                    'cost_center': query_idc.look_up_cost_center(resource_id,settings.IDC_COST_CENTER_ATTRIBUTE)
+                }
+            except (ValueError, query_idc.IdentityStoreAccessError):
+                raise
+            except Exception as e:
+                logger.error(f"Failed to look up user {user_id}: {str(e)}")
+
+        return resolved
+
+def write_chunk(chunk, resolved, totals, year, month, writer, failed_users, stored_items=None, rollups=None,
+                checkpoint=None, export=None):
+    """
+    Allocate tax/refunds to the users of a chunk and queue their items for writing
+
+    Users missing from resolved are added to failed_users instead. With a
+    checkpoint, the items are flushed and the watermark is moved to the last
+    user of the chunk.
+
+    Args:
+        chunk: List of (resource_id, cost) tuples
+        resolved: Dict of user ID to resolved email and cost center
+        totals: Tuple of total subscription cost, total tax/refund cost and user count
+        year: Year of the billing period
+        month: Month of the billing period
+        writer: BatchWriter
+        failed_users: Dict of resource ID to cost of the users that could not be resolved
+        stored_items: Stored items of the billing period in incremental mode. Users
+            of the chunk are removed from it, unchanged users are not written.
+        rollups: Dict of cost center to its cost, tax/refund share and user count,
+            which the users of the chunk are added to
+        checkpoint: Checkpoint of the run
+        export: ParquetExport the users of the chunk are added to
+
+    Returns:
+        Number of users processed
+    """
+    total_subscription_cost, total_other_cost, user_count = totals
+    processed_users = 0
+
+    for resource_id, cost in chunk:
+        user_id = resource_id.split("/")[-1]
+        stored_item = stored_items.pop(user_id, None) if stored_items is not None else None
+        if user_id not in resolved:
+            # Keeps a stored item of the user, it is not deleted as missing
+            failed_users[resource_id] = cost
+            metrics.increment('UsersFailed')
+            continue
+        email = resolved[user_id]['email']
+        cost_center = resolved[user_id]['cost_center']
+
+        #Add any tax/refund to the total cost
+        other_cost = 0
+        if(total_other_cost !=0):
+            if(total_subscription_cost !=0):
+                other_cost = total_other_cost * (cost/total_subscription_cost)
+            else:
+                other_cost = total_other_cost/user_count
+            cost = cost + other_cost
+
+        if rollups is not None:
+            rollup = rollups.setdefault(cost_center, {'cost': 0, 'tax_refund_cost': 0, 'user_count': 0})
+            rollup['cost'] += cost
+            rollup['tax_refund_cost'] += other_cost
+            rollup['user_count'] += 1
+
+        if export is not None:
+            export.add(user_id, email, cost_center, cost)
+
+        if (stored_item is not None and stored_item['email'] == email
+                and stored_item['cost_center'] == cost_center
+                and stored_item['cost'] == Decimal(str(cost))):
+            writer.skip()
+            processed_users += 1
+            metrics.increment('UsersUnchanged')
+            continue
+
+        try:
+            writer.put({
+                settings.DDB_PARTITION_KEY: {'S': user_id},
+                settings.DDB_SORT_KEY: {'S': year + '-' + month},
+                'email': {'S': email},
+                'cost_center': {'S': cost_center},
+                'cost': {'N': str(cost)}
+            })
+            processed_users += 1
+            metrics.increment('UsersWritten')
+            logger.debug(f"Queued data for user {resource_id}: {email}, {cost_center}, {cost}")
+        except Exception as e:
+            logger.error(f"Failed to save data for user {resource_id}: {str(e)}", exc_info=True)
+            raise
+
+    if checkpoint is not None:
+        writer.flush()
+        # Items given up on are not written, the watermark must not pass them
+        if not writer.failed:
+            checkpoint.advance(year + '-' + month, chunk[-1][0])
+
+    return processed_users
+
+def write_rollups(rollups, year, month, writer):
+    """
+    Queue the cost center rollup items of a billing period for writing
+
+    Each cost center gets an item keyed on COST_CENTER#<cost center> and the
+    billing period, so its totals can be read with a single GetItem, and all
+    cost centers of a billing period with a single Query of the time period
+    index with begins_with on the partition key. Stored rollup items of cost
+    cost centers without users in this run are removed.
+
+    A sharded run only sees the users of its shard, so each shard writes
+    partial rollups keyed on COST_CENTER#<cost center>#SHARD#<index>-of-<count>
+    that add up to the totals of the cost center. A shard only removes the
+    stale rollup items it owns.
+
+    Args:
+        rollups: Dict of cost center to its cost, tax/refund share and user count
+        year: Year of the billing period
+        month: Month of the billing period
+        writer: BatchWriter
+    """
+    time_period = year + '-' + month
+    stale_keys = load_period_rollups(ddb_client, settings.DDB_TABLE_NAME, time_period)
+
+    for cost_center, rollup in rollups.items():
+        key = ROLLUP_PREFIX + cost_center + sharding.rollup_suffix()
+        stale_keys.discard(key)
+        writer.put({
+            settings.DDB_PARTITION_KEY: {'S': key},
+            settings.DDB_SORT_KEY: {'S': time_period},
+            'cost_center': {'S': cost_center},
+            'cost': {'N': str(rollup['cost'])},
+            'tax_refund_cost': {'N': str(rollup['tax_refund_cost'])},
+            'user_count': {'N': str(rollup['user_count'])}
+        })
+
+    for key in filter(sharding.owns_rollup, stale_keys):
+        logger.debug(f"Removing rollup {key} no longer in {time_period}")
+        writer.delete({
+            settings.DDB_PARTITION_KEY: {'S': key},
+            settings.DDB_SORT_KEY: {'S': time_period}
+        })
+
+    metrics.increment('CostCenterRollupsWritten', len(rollups))
+    logger.info(f"Queued {len(rollups)} cost center rollups for {time_period}")
+
+def parse_arguments(argv):
+    """
+    Parse the command line arguments
+
+    Args:
+        argv: Command line arguments without the program name
+
+    Returns:
+        argparse.Namespace with year, month, start_period and end_period
+    """
+    parser = argparse.ArgumentParser(
+        description="Break down Q Developer subscription cost per user",
+        epilog="If no arguments provided, current year and month will be used")
+    parser.add_argument('year', nargs='?', help="Year of the billing period")
+    parser.add_argument('month', nargs='?', help="Month of the billing period")
+    parser.add_argument('--from', dest='start_period', metavar='YYYY-MM',
+                        help="First billing period of a backfill, requires --to")
+    parser.add_argument('--to', dest='end_period', metavar='YYYY-MM',
+                        help="Last billing period of a backfill, requires --from")
+    parser.add_argument('--refresh-identities', action='store_true',
+                        help="Ignore cached emails and cost centers and look them up again")
+    parser.add_argument('--pipeline', choices=['sequential', 'concurrent'],
+                        help="Resolve users and write items one chunk at a time, or "
+                             "resolve IDC_CONCURRENCY chunks in parallel while writing")
+    parser.add_argument('--query-backend', choices=['athena', 'local'],
+                        help="Run the queries in Athena, or with DuckDB on the CUR Parquet files in LOCAL_CUR_PATH")
+    parser.add_argument('--simulate-shards', type=int, metavar='N',
+                        help="Run N shards in local processes, like the children of an AWS Batch array job")
+    return parser.parse_args(argv)
+
+def simulate_shards(shard_count, function, *args):
+    """
+    Run every shard of a run in a pool of local processes
+
+    Each process runs function for one shard index, the same way the children
+    of an AWS Batch array job of size shard_count would.
+
+    Args:
+        shard_count: Number of shards
+        function: get_q_dev_cost_per_month or get_q_dev_cost_for_range
+        *args: Arguments of function
+
+    Raises:
+        ShardError: If any of the shards failed, after all shards have finished
+    """
+    logger.info(f"Simulating {shard_count} shards in local processes")
+    overrides = {
+        'PIPELINE_MODE': settings.PIPELINE_MODE,
+        'QUERY_BACKEND': settings.QUERY_BACKEND,
+        'SHARD_RUN_ID': settings.SHARD_RUN_ID or uuid.uuid4().hex,
+        'refresh_identities': query_idc.identity_cache.refresh
+    }
+    failed_shards = []
+    # Processes are spawned rather than forked, so they do not share AWS clients or the identity cache
+    with ProcessPoolExecutor(max_workers=shard_count, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(run_shard, shard_index, shard_count, overrides, function, *args)
+                   for shard_index in range(shard_count)]
+        for shard_index, future in enumerate(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Shard {shard_index} failed: {str(e)}")
+                failed_shards.append(shard_index)
+
+    if failed_shards:
+        raise ShardError(f"{len(failed_shards)} of {shard_count} shards failed: {failed_shards}")
+
+def run_shard(shard_index, shard_count, overrides, function, *args):
+    """
+    Run one shard in a process of simulate_shards
+
+    Args:
+        shard_index: Index of the shard
+        shard_count: Number of shards
+        overrides: Settings given on the command line of the parent process
+        function: Function to run
+        *args: Arguments of function
+    """
+    settings.SHARD_INDEX = shard_index
+    settings.SHARD_COUNT = shard_count
+    settings.PIPELINE_MODE = overrides['PIPELINE_MODE']
+    settings.QUERY_BACKEND = overrides['QUERY_BACKEND']
+    settings.SHARD_RUN_ID = overrides['SHARD_RUN_ID']
+    query_idc.identity_cache.refresh = overrides['refresh_identities']
+    try:
+        function(*args)
+    finally:
+        query_idc.identity_cache.close()
+        metrics.emit()
+
 def main():
     """
     Main entry point for the script
     """
     logger.info("Starting Q Developer subscription cost processing")
+    start_time = time.monotonic()
     
     try:
         current_date = datetime.now()
+        args = parse_arguments(sys.argv[1:])
+        if args.refresh_identities:
+            query_idc.identity_cache.refresh = True
+        if args.pipeline:
+            settings.PIPELINE_MODE = args.pipeline
+        if args.query_backend:
+            settings.QUERY_BACKEND = args.query_backend
+
+        if args.start_period or args.end_period:
+            # Backfill a range of billing periods
+            if not (args.start_period and args.end_period) or args.year:
+                logger.error("Invalid arguments provided for a backfill")
+                print("Usage: python script_name.py --from YYYY-MM --to YYYY-MM")
+                sys.exit(1)
+
+            try:
+                start_date = datetime.strptime(args.start_period, '%Y-%m')
+                end_date = datetime.strptime(args.end_period, '%Y-%m')
+            except ValueError as e:
+                logger.error(f"Invalid billing periods provided: {str(e)}")
+                raise ValueError(f"Invalid billing period: {str(e)}")
+            if start_date > end_date:
+                raise ValueError(f"Billing period {args.start_period} is after {args.end_period}")
 
-        if len(sys.argv) == 1:
+            start_period = start_date.strftime('%Y-%m')
+            end_period = end_date.strftime('%Y-%m')
+            logger.info(f"Processing costs for {start_period} to {end_period}")
+            if args.simulate_shards:
+                simulate_shards(args.simulate_shards, get_q_dev_cost_for_range, start_period, end_period)
+            else:
+                get_q_dev_cost_for_range(start_period, end_period)
+            logger.info("Successfully completed cost processing")
+            return
+
+        if args.year is None:
             # No arguments provided, use current year and month
             year = str(current_date.year)
             month = str(current_date.month).zfill(2)  # Pad with zero if needed
             logger.info(f"No date provided, using current year and month: {year}-{month}")
-        elif len(sys.argv) == 3:
+        elif args.month is not None:
             # Both year and month provided
-            year = sys.argv[1]
-            month = sys.argv[2]
+            year = args.year
+            month = args.month
             if(year == 'OPTIONAL'):
                 year = str(current_date.year)
                 month = str(current_date.month).zfill(2)
         else:
             logger.error("Invalid number of arguments provided")
             print("Usage: python script_name.py [year] [month]")
+            print("       python script_name.py --from YYYY-MM --to YYYY-MM")
             print("If no arguments provided, current year and month will be used")
             sys.exit(1)
 
@@ -155,12 +977,41 @@ def main():
             raise ValueError(f"Invalid year or month: {str(e)}")
 
         logger.info(f"Processing costs for {year}-{month}")
-        get_q_dev_cost_per_month(year, month)
+        if args.simulate_shards:
+            simulate_shards(args.simulate_shards, get_q_dev_cost_per_month, year, month)
+        else:
+            get_q_dev_cost_per_month(year, month)
         logger.info("Successfully completed cost processing")
 
     except Exception as e:
         logger.error(f"Application failed: {str(e)}", exc_info=True)
         sys.exit(1)
+    finally:
+        cache_stats = query_idc.identity_cache.close()
+        metrics.increment('IdentityCacheHits', cache_stats['memory_hits'] + cache_stats['persistent_hits'])
+        metrics.increment('IdentityCacheMisses', cache_stats['misses'])
+        rate_limiter.summary()
+        metrics.record('RunTime', time.monotonic() - start_time, 'Seconds')
+        metrics.emit()
+
+class UserResolutionError(Exception):
+    """Custom exception for users whose email or cost center cannot be resolved"""
+    pass
+
+class ShardError(Exception):
+    """Custom exception for simulated shards that failed"""
+    pass
 
 if __name__ == '__main__':
-    main()
+    if settings.PROFILE_OUTPUT:
+        # Opt-in profile of the whole run, readable with pstats or snakeviz
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            main()
+        finally:
+            profiler.disable()
+            profiler.dump_stats(settings.PROFILE_OUTPUT)
+            logger.info(f"Saved profile to {settings.PROFILE_OUTPUT}")
+    else:
+        main()
@@ -1,18 +1,41 @@
 import boto3
+import codecs
+import hashlib
+import re
 import time
 import logging
+from urllib.parse import urlparse
 from botocore.exceptions import ClientError, ParamValidationError
 
+import metrics
 import settings
+from query_cache import QueryResultCache
 
 session = boto3.Session()
 athena_client = session.client('athena')
+s3_client = session.client('s3')
+
+# Prepared statements known to exist in settings.WORK_GROUP
+prepared_statements = set()
+
+# A field of an Athena result CSV file and its delimiter. Athena quotes every
+# value, doubling the quotes in it, and writes NULL as a field with no quotes.
+CSV_FIELD = re.compile(r'(?:"((?:[^"]|"")*)")?(,|\Z)')
+
+# Results of closed billing periods never change, so they are cached locally when configured
+query_cache = None
+if settings.QUERY_CACHE_DIR:
+    query_cache = QueryResultCache(
+        settings.QUERY_CACHE_DIR,
+        open_period_ttl=settings.QUERY_CACHE_OPEN_PERIOD_TTL,
+        close_days=settings.QUERY_CACHE_CLOSE_DAYS
+    )
 
 
 # Get logger for this module
 logger = logging.getLogger(__name__)
 
-def run_query(query_string, year, month):
+def run_query(query_string, year, month, checkpoint=None):
     """
     Run Athena query with prepared statements
     
@@ -20,81 +43,137 @@ def run_query(query_string, year, month):
         query_string: SQL query with named parameters
         year: Year value for query
         month: Month value for query
+        checkpoint: Checkpoint to reuse a finished execution of the query from
         
     Returns:
-        Query results
+        Generator over all result rows as tuples of column values, without
+        the header row. Pages are fetched lazily as the rows are consumed.
         
     Raises:
         AthenaQueryError: For Athena-specific errors
         ValueError: For invalid parameters
-        TimeoutError: If query execution exceeds time limit
+        TimeoutError: If query execution exceeds settings.ATHENA_QUERY_TIMEOUT
     """
-    query_results = ''
-    statement_name = None
-    
     logger.info(f"Starting query execution for year={year}, month={month}")
-    logger.debug(f"Query string: {query_string}")
+
+    #Convert Year and Month to a billing period in CUR 2.0
+    billing_period = f"{year}-{int(month):02d}"
+    return run_prepared_query(query_string, [billing_period], checkpoint)
+
+def run_range_query(query_string, start_period, end_period, checkpoint=None):
+    """
+    Run Athena query with prepared statements over a range of billing periods
     
-    try:
-        # Create prepared statement
-        statement_name = f"stmt_{int(time.time())}"
-        logger.debug(f"Creating prepared statement: {statement_name}")
+    Args:
+        query_string: SQL query with two parameters for the first and last billing period
+        start_period: First billing period (YYYY-MM)
+        end_period: Last billing period (YYYY-MM)
+        checkpoint: Checkpoint to reuse a finished execution of the query from
         
-        create_prepared_statement_response = athena_client.create_prepared_statement(
-            StatementName=statement_name,
-            WorkGroup=settings.WORK_GROUP,
-            QueryStatement=query_string.format(settings.ATHENA_TABLE_NAME)
-        )
-        logger.debug(f"Prepared statement created successfully: {create_prepared_statement_response}")
+    Returns:
+        Generator over all result rows, see run_query
         
-        #Convert Year and Month to a billing period in CUR 2.0
-        billing_period = f"{year}-{int(month):02d}"  
+    Raises:
+        AthenaQueryError: For Athena-specific errors
+        ValueError: For invalid parameters
+        TimeoutError: If query execution exceeds settings.ATHENA_QUERY_TIMEOUT
+    """
+    logger.info(f"Starting query execution for billing periods {start_period} to {end_period}")
+    return run_prepared_query(query_string, [start_period, end_period], checkpoint)
 
-        execute_query = f"EXECUTE {statement_name} USING '{billing_period}'"
+def run_prepared_query(query_string, parameters, checkpoint=None):
+    """
+    Run Athena query as a prepared statement with the given parameters
+    
+    A restarted run reads the results of the execution recorded in the
+    checkpoint instead of running the query again, as long as Athena still
+    reports it as succeeded.
+    
+    Args:
+        query_string: SQL query with positional parameters
+        parameters: List of string values for the parameters
+        checkpoint: Checkpoint to reuse a finished execution from and record
+            the execution in
+        
+    Returns:
+        Generator over all result rows, see run_query
+        
+    Raises:
+        AthenaQueryError: For Athena-specific errors
+        ValueError: For invalid parameters
+        TimeoutError: If query execution exceeds settings.ATHENA_QUERY_TIMEOUT
+    """
+    # The Q Developer cost table has the CUR columns the queries use, see materialized_table
+    rendered_query = query_string.format(settings.MATERIALIZED_TABLE_NAME or settings.ATHENA_TABLE_NAME)
+    
+    logger.debug(f"Query string: {query_string}")
+
+    if query_cache is not None:
+        cached_results = query_cache.get(rendered_query, parameters)
+        if cached_results is not None:
+            metrics.increment('QueryCacheHits')
+            return cached_results
+    
+    try:
+        statement_name = get_prepared_statement(rendered_query)
+        
+        using = ', '.join(f"'{parameter}'" for parameter in parameters)
+        execute_query = f"EXECUTE {statement_name} USING {using}"
         logger.debug(f"Executing query: {execute_query}")
         
-        query_execution = athena_client.start_query_execution(
-            QueryString=execute_query,
-            QueryExecutionContext={
+        start_query_execution_args = {
+            'QueryString': execute_query,
+            'QueryExecutionContext': {
                 'Database': settings.DATABASE_NAME
             },
-            ResultConfiguration={
+            'ResultConfiguration': {
                 'OutputLocation': settings.RESULT_LOCATION
             }
-        )
+        }
+        if settings.ATHENA_RESULT_REUSE_MAX_AGE > 0:
+            start_query_execution_args['ResultReuseConfiguration'] = {
+                'ResultReuseByAgeConfiguration': {
+                    'Enabled': True,
+                    'MaxAgeInMinutes': settings.ATHENA_RESULT_REUSE_MAX_AGE
+                }
+            }
+        
+        query_key = f"{statement_name}:{','.join(parameters)}"
+        query_execution = None
+        if checkpoint is not None and query_key in checkpoint.query_ids:
+            query_execution = get_finished_query(checkpoint.query_ids[query_key])
 
-        query_execution_id = query_execution['QueryExecutionId']
-        logger.info(f"Query execution started with ID: {query_execution_id}")
+        if query_execution is None:
+            def start_query():
+                metrics.increment('AthenaApiCalls')
+                query_execution_id = athena_client.start_query_execution(
+                    **start_query_execution_args)['QueryExecutionId']
+                logger.info(f"Query execution started with ID: {query_execution_id}")
+                return query_execution_id
 
-        # Poll for query completion
-        max_execution_time = 300  # 5 minutes
-        start_time = time.time()
+            if checkpoint is not None:
+                # The shards of a sharded run share one execution of the query
+                query_execution_id = checkpoint.shared_query(query_key, start_query)
+            else:
+                query_execution_id = start_query()
 
-        while True:
-            query_status = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
-            state = query_status['QueryExecution']['Status']['State']
-            logger.debug(f"Query state: {state}")
-
-            if state == 'SUCCEEDED':
-                logger.info(f"Query completed successfully: {query_execution_id}")
-                results = athena_client.get_query_results(QueryExecutionId=query_execution_id)
-                query_results = results['ResultSet']['Rows']
-                logger.debug(f"Retrieved {len(query_results)} rows")
-                break
-            elif state == 'FAILED':
-                error_message = query_status['QueryExecution']['Status']['StateChangeReason']
-                logger.error(f"Query failed: {error_message}")
-                raise AthenaQueryError(f"Query failed: {error_message}")
-            elif state == 'CANCELLED':
-                logger.warning(f"Query was cancelled: {query_execution_id}")
-                raise AthenaQueryError("Query was cancelled")
-
-            if time.time() - start_time > max_execution_time:
-                logger.error(f"Query timeout after {max_execution_time} seconds")
-                athena_client.stop_query_execution(QueryExecutionId=query_execution_id)
-                raise TimeoutError(f"Query execution exceeded maximum time of {max_execution_time} seconds")
+            try:
+                query_execution = wait_for_query(query_execution_id)
+            except (AthenaQueryError, TimeoutError):
+                if checkpoint is not None:
+                    checkpoint.release_shared_query(query_key)
+                raise
+            if checkpoint is not None:
+                checkpoint.record_query(query_key, query_execution_id)
+        query_execution_id = query_execution['QueryExecutionId']
+        if settings.ATHENA_RESULT_READER == 's3':
+            output_location = query_execution['ResultConfiguration']['OutputLocation']
+            query_results = read_query_results_from_s3(output_location)
+        else:
+            query_results = get_query_results(query_execution_id)
 
-            time.sleep(5)
+        if query_cache is not None:
+            query_results = query_cache.store(rendered_query, parameters, query_results)
 
     except ClientError as e:
         error_code = e.response['Error']['Code']
@@ -107,30 +186,204 @@ def run_query(query_string, year, month):
     except Exception as e:
         logger.error(f"Unexpected error occurred: {str(e)}", exc_info=True)
         raise AthenaQueryError(f"Unexpected error: {str(e)}")
-    finally:
-        # Clean up prepared statement
-        if statement_name:
-            try:
-                logger.debug(f"Cleaning up prepared statement: {statement_name}")
-                athena_client.delete_prepared_statement(
-                    StatementName=statement_name,
-                    WorkGroup=settings.WORK_GROUP
-                )
-                logger.debug("Prepared statement cleaned up successfully")
-            except Exception as e:
-                logger.warning(f"Failed to clean up prepared statement: {str(e)}")
     
     return query_results
 
+def run_statement(query_string):
+    """
+    Run a DDL or DML statement that returns no rows, e.g. CREATE TABLE or INSERT INTO
+
+    Args:
+        query_string: SQL statement, with no parameters
+        
+    Returns:
+        The QueryExecution of the succeeded statement
+        
+    Raises:
+        AthenaQueryError: For Athena-specific errors
+        TimeoutError: If the statement does not finish within settings.ATHENA_QUERY_TIMEOUT
+    """
+    logger.debug(f"Statement: {query_string}")
+    try:
+        metrics.increment('AthenaApiCalls')
+        query_execution_id = athena_client.start_query_execution(
+            QueryString=query_string,
+            QueryExecutionContext={'Database': settings.DATABASE_NAME},
+            ResultConfiguration={'OutputLocation': settings.RESULT_LOCATION}
+        )['QueryExecutionId']
+        logger.info(f"Statement execution started with ID: {query_execution_id}")
+        return wait_for_query(query_execution_id)
+    except ClientError as e:
+        error_code = e.response['Error']['Code']
+        error_message = e.response['Error']['Message']
+        logger.error(f"AWS error occurred: {error_code} - {error_message}", exc_info=True)
+        raise AthenaQueryError(f"AWS error: {error_code} - {error_message}")
+
+def get_prepared_statement(query_statement):
+    """
+    Get the name of the prepared statement for a query, creating it if needed
+    
+    The name is derived from a hash of the query text, so a statement is created
+    once per workgroup and reused by later queries, runs and concurrent jobs
+    with the same SQL. Changed SQL gets a new statement, e.g. after an upgrade
+    of the job or a change of ATHENA_TABLE_NAME, and the statements of the old
+    SQL are left in the workgroup. They are not deleted here, since jobs of the
+    old version may still run them. Statements no job uses any more can be
+    deleted with DeletePreparedStatement, see the README.
+    
+    Args:
+        query_statement: Rendered SQL of the query
+        
+    Returns:
+        Name of the prepared statement in settings.WORK_GROUP
+        
+    Raises:
+        ClientError: If the statement can neither be found nor created
+    """
+    digest = hashlib.sha256(query_statement.encode('utf-8')).hexdigest()[:32]
+    statement_name = f"q_dev_cost_{digest}"
+    if statement_name in prepared_statements:
+        return statement_name
+
+    try:
+        metrics.increment('AthenaApiCalls')
+        athena_client.get_prepared_statement(
+            StatementName=statement_name,
+            WorkGroup=settings.WORK_GROUP
+        )
+        logger.debug(f"Reusing prepared statement: {statement_name}")
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+
+        logger.debug(f"Creating prepared statement: {statement_name}")
+        metrics.increment('AthenaApiCalls')
+        try:
+            athena_client.create_prepared_statement(
+                StatementName=statement_name,
+                WorkGroup=settings.WORK_GROUP,
+                QueryStatement=query_statement
+            )
+        except ClientError as e:
+            # Another job may have created the same statement in the meantime
+            if not _is_already_exists(e):
+                raise
+            metrics.increment('AthenaApiCalls')
+            athena_client.get_prepared_statement(
+                StatementName=statement_name,
+                WorkGroup=settings.WORK_GROUP
+            )
+        logger.debug(f"Prepared statement created successfully: {statement_name}")
+
+    prepared_statements.add(statement_name)
+    return statement_name
+
+def _is_already_exists(error):
+    """Check if CreatePreparedStatement failed because the statement exists"""
+    return (error.response['Error']['Code'] == 'InvalidRequestException'
+            and 'already exists' in error.response['Error'].get('Message', '').lower())
+
+def get_finished_query(query_execution_id):
+    """
+    Get a query execution of an earlier run if its results can still be read
+    
+    Args:
+        query_execution_id: Query execution ID
+        
+    Returns:
+        The QueryExecution if the query succeeded, otherwise None
+    """
+    try:
+        metrics.increment('AthenaApiCalls')
+        query_execution = athena_client.get_query_execution(QueryExecutionId=query_execution_id)['QueryExecution']
+    except ClientError as e:
+        logger.warning(f"Cannot reuse query {query_execution_id}: {e.response['Error']['Message']}")
+        return None
+
+    if query_execution['Status']['State'] != 'SUCCEEDED':
+        logger.info(f"Not reusing query {query_execution_id} in state {query_execution['Status']['State']}")
+        return None
+
+    logger.info(f"Reusing results of query {query_execution_id} from the checkpoint")
+    metrics.increment('AthenaQueriesReused')
+    return query_execution
+
+def wait_for_query(query_execution_id):
+    """
+    Poll an Athena query until it reaches a terminal state
+    
+    The first polls are settings.ATHENA_POLL_MIN_INTERVAL apart and the interval
+    grows by settings.ATHENA_POLL_BACKOFF up to settings.ATHENA_POLL_MAX_INTERVAL.
+    The queue and engine execution time reported in QueryExecution.Statistics
+    push the interval up faster for queries that are already known to be slow.
+    
+    Args:
+        query_execution_id: Query execution ID
+        
+    Returns:
+        The QueryExecution of the succeeded query
+        
+    Raises:
+        AthenaQueryError: If the query failed or was cancelled
+        TimeoutError: If the query does not finish within settings.ATHENA_QUERY_TIMEOUT
+    """
+    max_execution_time = settings.ATHENA_QUERY_TIMEOUT
+    interval = settings.ATHENA_POLL_MIN_INTERVAL
+    start_time = time.monotonic()
+    polls = 0
+
+    while True:
+        query_status = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
+        metrics.increment('AthenaApiCalls')
+        polls += 1
+        query_execution = query_status['QueryExecution']
+        state = query_execution['Status']['State']
+        logger.debug(f"Query state: {state}")
+
+        if state == 'SUCCEEDED':
+            logger.info(f"Query completed successfully: {query_execution_id} after {polls} status checks")
+            statistics = query_execution.get('Statistics', {})
+            metrics.record('AthenaQueueTime', statistics.get('QueryQueueTimeInMillis', 0) / 1000, 'Seconds')
+            metrics.record('AthenaExecutionTime', statistics.get('EngineExecutionTimeInMillis', 0) / 1000, 'Seconds')
+            metrics.record('AthenaDataScanned', statistics.get('DataScannedInBytes', 0), 'Bytes')
+            return query_execution
+        elif state == 'FAILED':
+            error_message = query_execution['Status'].get('StateChangeReason', '')
+            logger.error(f"Query failed: {error_message}")
+            raise AthenaQueryError(f"Query failed: {error_message}")
+        elif state == 'CANCELLED':
+            logger.warning(f"Query was cancelled: {query_execution_id}")
+            raise AthenaQueryError("Query was cancelled")
+
+        elapsed = time.monotonic() - start_time
+        if elapsed > max_execution_time:
+            logger.error(f"Query timeout after {max_execution_time} seconds")
+            athena_client.stop_query_execution(QueryExecutionId=query_execution_id)
+            raise TimeoutError(f"Query execution exceeded maximum time of {max_execution_time} seconds")
+
+        # A query that has already spent a long time queued or running is
+        # unlikely to finish in the next few hundred milliseconds
+        statistics = query_execution.get('Statistics', {})
+        observed_time = (statistics.get('QueryQueueTimeInMillis', 0)
+                         + statistics.get('EngineExecutionTimeInMillis', 0)) / 1000
+        interval = max(interval * settings.ATHENA_POLL_BACKOFF,
+                       observed_time * settings.ATHENA_POLL_TIME_FRACTION)
+        interval = min(interval, settings.ATHENA_POLL_MAX_INTERVAL)
+
+        time.sleep(max(0, min(interval, max_execution_time - elapsed)))
+
 def get_query_results(query_id):
     """
     Get paginated query results
     
+    Rows are yielded page by page as they are consumed, so the full result
+    set is never held in memory. The header row is skipped.
+    
     Args:
         query_id: Query execution ID
         
-    Returns:
-        List of result rows
+    Yields:
+        Result rows as tuples of column values (None for NULL values)
         
     Raises:
         AthenaQueryError: For any errors getting results
@@ -141,17 +394,30 @@ def get_query_results(query_id):
         paginator = athena_client.get_paginator('get_query_results')
         page_iterator = paginator.paginate(QueryExecutionId=query_id)
         
-        all_rows = []
+        row_count = 0
         page_count = 0
+        header_skipped = False
         
-        for page in page_iterator:
+        pages = iter(page_iterator)
+        while True:
+            with metrics.timer('AthenaFetchTime'):
+                page = next(pages, None)
+            if page is None:
+                break
+            metrics.increment('AthenaApiCalls')
             page_count += 1
             rows = page.get('ResultSet', {}).get('Rows', [])
-            all_rows.extend(rows)
             logger.debug(f"Retrieved page {page_count} with {len(rows)} rows")
+
+            for row in rows:
+                if not header_skipped:
+                    header_skipped = True
+                    continue
+                row_count += 1
+                metrics.increment('AthenaResultRows')
+                yield tuple(cell.get('VarCharValue') for cell in row.get('Data', []))
         
-        logger.info(f"Retrieved total {len(all_rows)} rows in {page_count} pages")
-        return all_rows
+        logger.info(f"Retrieved total {row_count} rows in {page_count} pages")
         
     except ClientError as e:
         error_code = e.response['Error']['Code']
@@ -162,6 +428,91 @@ def get_query_results(query_id):
         logger.error(f"Unexpected error while getting results: {str(e)}", exc_info=True)
         raise AthenaQueryError(f"Unexpected error getting results: {str(e)}")
 
+def read_query_results_from_s3(output_location):
+    """
+    Stream query results from the CSV file Athena wrote to S3
+    
+    This avoids the GetQueryResults round trip per 1000 rows and the
+    per-cell JSON structure of its response.
+    
+    Args:
+        output_location: S3 URI of the result file (ResultConfiguration.OutputLocation)
+        
+    Yields:
+        Result rows as tuples of column values (None for NULL), without the header row
+        
+    Raises:
+        AthenaQueryError: For any errors reading the results
+    """
+    logger.info(f"Reading results from: {output_location}")
+    
+    try:
+        location = urlparse(output_location)
+        with metrics.timer('AthenaFetchTime'):
+            response = s3_client.get_object(Bucket=location.netloc, Key=location.path.lstrip('/'))
+        lines = codecs.iterdecode(response['Body'].iter_lines(), 'utf-8')
+        yield from parse_csv_results(lines)
+        
+    except ClientError as e:
+        error_code = e.response['Error']['Code']
+        error_message = e.response['Error']['Message']
+        logger.error(f"Failed to read query results: {error_code} - {error_message}", exc_info=True)
+        raise AthenaQueryError(f"Failed to read results: {error_code} - {error_message}")
+    except Exception as e:
+        logger.error(f"Unexpected error while reading results: {str(e)}", exc_info=True)
+        raise AthenaQueryError(f"Unexpected error reading results: {str(e)}")
+
+def parse_csv_results(lines):
+    """
+    Parse the lines of an Athena result CSV file
+    
+    Athena writes NULL as an empty field without quotes and an empty string as
+    "", so they are returned as None and '' like in GetQueryResults. A quoted
+    value may span several lines.
+    
+    Args:
+        lines: Iterable of CSV lines, starting with the header line
+        
+    Yields:
+        Result rows as tuples of column values, without the header row
+        
+    Raises:
+        AthenaQueryError: If the file ends within a quoted value
+    """
+    row_count = 0
+    header_skipped = False
+    record = None
+    for line in lines:
+        record = line if record is None else record + '\n' + line
+        row = _split_csv_record(record)
+        if row is None:
+            # The line ends within a quoted value
+            continue
+        record = None
+        if not header_skipped:
+            header_skipped = True
+            continue
+        row_count += 1
+        metrics.increment('AthenaResultRows')
+        yield row
+    if record is not None:
+        raise AthenaQueryError(f"Result file ends within a quoted value after {row_count} rows")
+    logger.info(f"Read total {row_count} rows")
+
+def _split_csv_record(record):
+    """Split a CSV record into its values, or return None if a quoted value is not closed"""
+    values = []
+    position = 0
+    while True:
+        match = CSV_FIELD.match(record, position)
+        if match is None:
+            return None
+        value, delimiter = match.groups()
+        values.append(None if value is None else value.replace('""', '"'))
+        if not delimiter:
+            return tuple(values)
+        position = match.end()
+
 class AthenaQueryError(Exception):
     """Custom exception for Athena query errors"""
     pass
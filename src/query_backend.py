@@ -0,0 +1,31 @@
+import logging
+
+import query_athena
+import query_local
+import settings
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+
+def get_backend():
+    """
+    Get the query backend selected with settings.QUERY_BACKEND
+
+    A backend is a module with the functions
+    run_query(query_string, year, month, checkpoint=None) and
+    run_range_query(query_string, start_period, end_period, checkpoint=None).
+    Both take the Athena SQL with {0} for the CUR table and return a generator
+    over the result rows as tuples of strings, with None for NULL values.
+
+    Returns:
+        query_athena for 'athena', query_local for 'local'
+
+    Raises:
+        ValueError: If settings.QUERY_BACKEND is not 'athena' or 'local'
+    """
+    if settings.QUERY_BACKEND == 'athena':
+        return query_athena
+    if settings.QUERY_BACKEND == 'local':
+        return query_local
+    raise ValueError(f"Unknown query backend: {settings.QUERY_BACKEND}")
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import time
+import logging
+from datetime import datetime, timedelta
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+
+class QueryResultCache:
+    """
+    Local file cache for Athena query results
+
+    Results are keyed by a hash of the rendered SQL and its billing period
+    parameters. Once every billing period of a query is closed, its CUR data
+    no longer changes and the cached result is kept indefinitely. Results
+    that include an open billing period expire after open_period_ttl seconds.
+    """
+
+    def __init__(self, directory, open_period_ttl=3600, close_days=5):
+        self.directory = directory
+        self.open_period_ttl = open_period_ttl
+        self.close_days = close_days
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, query_string, parameters):
+        """
+        Get cached result rows
+
+        Args:
+            query_string: Rendered SQL of the query
+            parameters: Billing period parameters of the query
+
+        Returns:
+            Generator over the cached rows, or None if there is no valid entry
+        """
+        path = self._path(query_string, parameters)
+        try:
+            modified = os.path.getmtime(path)
+        except OSError:
+            return None
+
+        if not self.is_closed(parameters) and time.time() - modified > self.open_period_ttl:
+            logger.info(f"Cached query result expired: {path}")
+            return None
+
+        logger.info(f"Using cached query result: {path}")
+        return self._read(path)
+
+    def store(self, query_string, parameters, rows):
+        """
+        Cache result rows while they are consumed
+
+        The entry is only created once all rows have been read, so a partially
+        consumed result is never cached.
+
+        Args:
+            query_string: Rendered SQL of the query
+            parameters: Billing period parameters of the query
+            rows: Iterable of result rows
+
+        Yields:
+            The rows of the result
+        """
+        path = self._path(query_string, parameters)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        completed = False
+        try:
+            with open(temp_path, 'w') as cache_file:
+                for row in rows:
+                    cache_file.write(json.dumps(row) + '\n')
+                    yield row
+            os.replace(temp_path, path)
+            completed = True
+            logger.info(f"Cached query result: {path}")
+        finally:
+            if not completed and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def is_closed(self, parameters):
+        """
+        Check whether all billing periods are closed
+
+        A billing period is treated as closed close_days after the month ends.
+
+        Args:
+            parameters: Billing periods (YYYY-MM)
+
+        Returns:
+            True if none of the billing periods can still change
+        """
+        for billing_period in parameters:
+            period_start = datetime.strptime(billing_period, '%Y-%m')
+            next_period_start = (period_start + timedelta(days=32)).replace(day=1)
+            if datetime.now() < next_period_start + timedelta(days=self.close_days):
+                return False
+        return True
+
+    def _path(self, query_string, parameters):
+        key = hashlib.sha256('\n'.join([query_string] + list(parameters)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f"{key}.jsonl")
+
+    def _read(self, path):
+        with open(path) as cache_file:
+            for line in cache_file:
+                yield tuple(json.loads(line))
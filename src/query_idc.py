@@ -1,21 +1,58 @@
 # Standard library imports
 import json
 import logging
+import math
+import threading
 import boto3
 import botocore.session
 from botocore.auth import SigV4Auth
 from botocore.awsrequest import AWSRequest
-from botocore.exceptions import BotoCoreError, ClientError
+from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException, Timeout
 
+import metrics
+import rate_limiter
 import settings
+from directory_snapshot import DirectorySnapshot
+from identity_cache import IdentityCache, open_identity_store
+from rate_limiter import ThrottlingError
 
 logger = logging.getLogger(__name__)
 
 session = boto3.Session()
 idc_client = session.client('identitystore')
 
+# Error codes of requests rejected whatever user they look up, e.g. for missing
+# permissions or invalid credentials
+ACCESS_ERROR_CODES = {
+    'AccessDeniedException',
+    'UnrecognizedClientException',
+    'InvalidSignatureException',
+    'IncompleteSignature',
+    'MissingAuthenticationToken',
+    'ExpiredTokenException'
+}
+
+# Signed Identity Store clients by region, shared by all lookups
+_identity_store_clients = {}
+_identity_store_clients_lock = threading.Lock()
+
+# Emails and cost centers rarely change, so they are cached across lookups and runs
+identity_cache = IdentityCache(
+    store=open_identity_store(session.client('dynamodb')),
+    ttl=settings.IDENTITY_CACHE_TTL,
+    max_size=settings.IDENTITY_CACHE_SIZE,
+    refresh=settings.IDENTITY_CACHE_REFRESH
+)
+
+# Snapshot of the whole directory, built on the first lookup that misses the cache
+directory_snapshot = None
+_snapshot_attempted = False
+_expected_subscribers = 0
+_snapshot_lock = threading.Lock()
+
 def look_up_user_email(resource_id):
     """
     Look up user email from IAM Identity Center using user ID
@@ -27,15 +64,24 @@ def look_up_user_email(resource_id):
         User's email address
         
     Raises:
+        IdentityStoreAccessError: If the request is rejected for its credentials or permissions
         Exception: If user lookup fails
     """
     
     try:
         primary_email = ''
         user_id = resource_id.split("/")[-1]
+
+        cached_email = identity_cache.get(_email_key(user_id))
+        if cached_email is not None:
+            return cached_email
+
         logger.info(f"Looking up email for user ID: {user_id}")
         
-        user_details = idc_client.describe_user(
+        metrics.increment('IdcApiCalls')
+        user_details = rate_limiter.call_with_retry(
+            rate_limiter.get_limiter('Idc'),
+            idc_client.describe_user,
             IdentityStoreId=settings.IDC_STORE_ID,
             UserId=user_id)
 
@@ -44,13 +90,19 @@ def look_up_user_email(resource_id):
                 primary_email = email["Value"]
                 break
         
+        identity_cache.set(_email_key(user_id), primary_email)
         return primary_email
 
     except ClientError as e:
         error_code = e.response['Error']['Code']
         error_message = e.response['Error']['Message']
         logger.error(f"AWS error looking up user {user_id}: {error_code} - {error_message}", exc_info=True)
+        if error_code in ACCESS_ERROR_CODES:
+            raise IdentityStoreAccessError(f"DescribeUser rejected: {error_code} - {error_message}")
         raise Exception(f"Failed to look up user: {error_message}")
+    except NoCredentialsError as e:
+        logger.error(f"No credentials to look up user {user_id}: {str(e)}")
+        raise IdentityStoreAccessError(f"Failed to get AWS credentials: {str(e)}")
     except Exception as e:
         logger.error(f"Unexpected error looking up user {user_id}: {str(e)}", exc_info=True)
         raise Exception(f"Failed to look up user: {str(e)}")
@@ -73,80 +125,180 @@ def fetch_user_data(identity_store_id, resource_id, region):
         ValueError: If input parameters are invalid
     """
     logger.info(f"Fetching user data for resource_id: {resource_id} from store: {identity_store_id}")
+
+    if not resource_id:
+        logger.error("Invalid input parameters: resource_id is required")
+        raise ValueError("identity_store_id, resource_id, and region are required")
+
+    user_id = resource_id.split("/")[-1]
+    logger.info(f"Extracted user_id: {user_id}")
+    return fetch_users_data(identity_store_id, [user_id], region)
+
+
+def fetch_users_data(identity_store_id, user_ids, region):
+    """
+    Fetch data for several users from IAM Identity Center in a single signed
+    DescribeUsers request
+    
+    Args:
+        identity_store_id: The ID of the identity store
+        user_ids: List of user IDs to fetch
+        region: AWS region
+        
+    Returns:
+        Response object containing user data
+        
+    Raises:
+        UserDataFetchError: If user data fetch fails
+        ValueError: If input parameters are invalid
+    """
+    logger.debug(f"Fetching user data for {len(user_ids) if user_ids else 0} users from store: {identity_store_id}")
     
     try:
         # Validate input parameters
-        if not identity_store_id or not resource_id or not region:
-            raise ValueError("identity_store_id, resource_id, and region are required")
+        if not identity_store_id or not user_ids or not region:
+            raise ValueError("identity_store_id, user_ids, and region are required")
             
-        # Create session and extract user_id
-        session = botocore.session.Session()
-        user_id = resource_id.split("/")[-1]
-        logger.info(f"Extracted user_id: {user_id}")
-        
-        # Create SigV4 auth
-        try:
-            credentials = session.get_credentials()
-            if not credentials:
-                raise UserDataFetchError("Failed to get AWS credentials")
-                
-            sigv4 = SigV4Auth(credentials, 'identitystore', region)
-        except BotoCoreError as e:
-            logger.error(f"Failed to initialize authentication: {str(e)}", exc_info=True)
-            raise UserDataFetchError(f"Authentication initialization failed: {str(e)}")
-            
-        # Prepare request
-        endpoint = f'https://up.sso.{region}.amazonaws.com/identitystore/'
         request_data = {
             "IdentityStoreId": identity_store_id,
-            "UserIds": [user_id]
+            "UserIds": list(user_ids)
             }
+        response = get_identity_store_client(region).post('AWSIdentityStoreService.DescribeUsers', request_data)
+        logger.debug(f"Successfully fetched user data for {len(user_ids)} users")
+        return response
+            
+    except ValueError as e:
+        logger.error(f"Invalid input parameters: {str(e)}", exc_info=True)
+        raise
+    except UserDataFetchError:
+        logger.error("Failed to fetch user data", exc_info=True)
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error fetching user data: {str(e)}", exc_info=True)
+        raise UserDataFetchError(f"Unexpected error: {str(e)}")
+
+
+def get_identity_store_client(region):
+    """
+    Get the shared signed HTTP client for the Identity Store endpoint of a region
+    
+    Args:
+        region: AWS region
+        
+    Returns:
+        IdentityStoreHttpClient
+    """
+    with _identity_store_clients_lock:
+        if region not in _identity_store_clients:
+            _identity_store_clients[region] = IdentityStoreHttpClient(
+                region,
+                endpoint_url=settings.IDC_ENDPOINT_URL,
+                pool_size=max(settings.IDC_CONCURRENCY, 10)
+            )
+        return _identity_store_clients[region]
+
+
+class IdentityStoreHttpClient:
+    """
+    Long-lived SigV4 signed HTTP client for the Identity Store endpoint
+
+    Connections are kept alive in a pool sized for the IDC concurrency, and
+    credentials are resolved once and refreshed by botocore when they expire,
+    instead of a new session and TLS handshake per request. Requests share the
+    Identity Store rate limiter and throttled requests are retried.
+    """
+
+    def __init__(self, region, endpoint_url=None, pool_size=10, timeout=30):
+        self.region = region
+        self.endpoint = endpoint_url or f'https://up.sso.{region}.amazonaws.com/identitystore/'
+        self.timeout = timeout
+        self._session = botocore.session.Session()
+        self._credentials = None
+        self._lock = threading.Lock()
+
+        self._http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._http.mount('https://', adapter)
+        self._http.mount('http://', adapter)
+
+    def post(self, target, request_data):
+        """
+        Send a signed request to the Identity Store endpoint
+        
+        Args:
+            target: X-Amz-Target of the operation, e.g. AWSIdentityStoreService.DescribeUsers
+            request_data: JSON serializable request body
+            
+        Returns:
+            Response object
+            
+        Raises:
+            IdentityStoreAccessError: If there are no credentials, or the
+                request is rejected for its credentials or permissions
+            UserDataFetchError: If signing or the HTTP request fails, or the
+                request is still throttled after the retries
+        """
+        try:
+            return rate_limiter.call_with_retry(rate_limiter.get_limiter('Idc'), self._send, target, request_data)
+        except ThrottlingError as e:
+            raise UserDataFetchError(f"Request throttled: {str(e)}")
+
+    def _send(self, target, request_data):
         data = json.dumps(request_data)
         headers = {
             'Content-Type': 'application/x-amz-json-1.1',
-            'X-Amz-Target': 'AWSIdentityStoreService.DescribeUsers'
+            'X-Amz-Target': target
         }
-        
+
         # Create and sign request
         try:
-            request = AWSRequest(method='POST', url=endpoint, data=data, headers=headers)
+            sigv4 = SigV4Auth(self._get_credentials(), 'identitystore', self.region)
+            request = AWSRequest(method='POST', url=self.endpoint, data=data, headers=headers)
             sigv4.add_auth(request)
             prepped = request.prepare()
+        except UserDataFetchError:
+            raise
         except Exception as e:
             logger.error(f"Failed to prepare request: {str(e)}", exc_info=True)
             raise UserDataFetchError(f"Request preparation failed: {str(e)}")
-            
+
         # Make HTTP request
         try:
-            logger.info("Sending request to identity store")
-            response = requests.post(
+            logger.debug("Sending request to identity store")
+            metrics.increment('IdcApiCalls')
+            response = self._http.post(
                 prepped.url,
                 headers=prepped.headers,
                 data=data,
-                timeout=30
+                timeout=self.timeout
             )
+            if _is_throttled(response):
+                raise ThrottlingError(f"{target} throttled with HTTP {response.status_code}")
+            if _is_access_denied(response):
+                raise IdentityStoreAccessError(f"{target} rejected with HTTP {response.status_code}: {response.text}")
             response.raise_for_status()
-            
-            logger.info(f"Successfully fetched user data for user_id: {user_id}")
             return response
-            
+
         except Timeout:
-            logger.error("Request timed out after 30 seconds", exc_info=True)
+            logger.error(f"Request timed out after {self.timeout} seconds", exc_info=True)
             raise UserDataFetchError("Request timed out")
         except RequestException as e:
             logger.error(f"HTTP request failed: {str(e)}", exc_info=True)
             raise UserDataFetchError(f"HTTP request failed: {str(e)}")
-            
-    except ValueError as e:
-        logger.error(f"Invalid input parameters: {str(e)}", exc_info=True)
-        raise
-    except UserDataFetchError:
-        logger.error("Failed to fetch user data", exc_info=True)
-        raise
-    except Exception as e:
-        logger.error(f"Unexpected error fetching user data: {str(e)}", exc_info=True)
-        raise UserDataFetchError(f"Unexpected error: {str(e)}")
 
+    def _get_credentials(self):
+        with self._lock:
+            if self._credentials is None:
+                try:
+                    self._credentials = self._session.get_credentials()
+                except BotoCoreError as e:
+                    logger.error(f"Failed to initialize authentication: {str(e)}", exc_info=True)
+                    raise IdentityStoreAccessError(f"Authentication initialization failed: {str(e)}")
+                if not self._credentials:
+                    raise IdentityStoreAccessError("Failed to get AWS credentials")
+
+        # Refreshable credentials renew themselves here when they are about to expire
+        return self._credentials.get_frozen_credentials()
 
 
 def look_up_cost_center(user_id, attribute_name):
@@ -158,30 +310,333 @@ def look_up_cost_center(user_id, attribute_name):
         attribute_name: Name of the attribute to look up
         
     Returns:
-        User's cost center or None if not found
+        User's cost center or '' if not set
+
+    Raises:
+        UserDataFetchError: If the lookup fails
     """
+    cache_key = _attribute_key(user_id.split("/")[-1], attribute_name)
+    cached_value = identity_cache.get(cache_key)
+    if cached_value is not None:
+        return cached_value
+
     logger.info(f"Looking up {attribute_name} for user ID: {user_id}")
     try:
-        userInfo = json.loads(fetch_user_data(settings.IDC_STORE_ID, user_id, 'us-east-1').text)
+        userInfo = json.loads(fetch_user_data(settings.IDC_STORE_ID, user_id, settings.IDC_REGION).text)
         
         # Safely navigate through the nested structure
-        value = (userInfo
-                .get('Users', [{}])[0]
-                .get('UserAttributes', {})
-                .get('enterprise', {})
-                .get('ComplexValue', {})
-                .get(attribute_name, {})
-                .get('StringValue'))
-        
-        return value if value is not None else ''
+        value = _get_attribute_value(userInfo.get('Users', [{}])[0], attribute_name)
+        identity_cache.set(cache_key, value)
+        return value
                 
     except (IndexError, AttributeError, json.JSONDecodeError) as e:
         logger.error(f"Error retrieving {attribute_name} for user {user_id}: {str(e)}")
+        raise UserDataFetchError(f"Invalid DescribeUsers response for user {user_id}: {str(e)}")
+
+def look_up_users(resource_ids, attribute_name):
+    """
+    Look up email and cost center for many users from IAM Identity Center
+    
+    User IDs are sent to DescribeUsers in chunks of settings.IDC_BATCH_SIZE and
+    both values are read from the same response, instead of one describe_user
+    call and one DescribeUsers call per user.
+    
+    Args:
+        resource_ids: Resource IDs (or user IDs) of the users to look up
+        attribute_name: Name of the enterprise attribute holding the cost center
+        
+    Returns:
+        Dict mapping user ID to a dict with 'email' and 'cost_center'. Users that
+        are not returned by IAM Identity Center are logged and left out.
+        
+    Raises:
+        UserDataFetchError: If a DescribeUsers request fails
+    """
+    user_ids = list(dict.fromkeys(resource_id.split("/")[-1] for resource_id in resource_ids))
+    users = {}
+
+    # Serve users with both values cached without calling IAM Identity Center
+    cached = identity_cache.get_many(
+        [_email_key(user_id) for user_id in user_ids]
+        + [_attribute_key(user_id, attribute_name) for user_id in user_ids]
+    )
+    for user_id in user_ids:
+        email = cached.get(_email_key(user_id))
+        cost_center = cached.get(_attribute_key(user_id, attribute_name))
+        if email is not None and cost_center is not None:
+            users[user_id] = {'email': email, 'cost_center': cost_center}
+    user_ids = [user_id for user_id in user_ids if user_id not in users]
+
+    # Then users in the directory snapshot, the others fall back to DescribeUsers
+    snapshot = get_directory_snapshot(attribute_name) if user_ids else None
+    if snapshot is not None:
+        found = {}
+        for user_id in user_ids:
+            user = snapshot.get(user_id)
+            if user is not None:
+                users[user_id] = user
+                found[_email_key(user_id)] = user['email']
+                found[_attribute_key(user_id, attribute_name)] = user['cost_center']
+        identity_cache.set_many(found)
+        metrics.increment('IdcSnapshotHits', len(found) // 2)
+        user_ids = [user_id for user_id in user_ids if user_id not in users]
+        if user_ids:
+            logger.info(f"{len(user_ids)} users are not in the directory snapshot, looking them up")
+
+    for start in range(0, len(user_ids), settings.IDC_BATCH_SIZE):
+        chunk = user_ids[start:start + settings.IDC_BATCH_SIZE]
+        chunk_ids = set(chunk)
+        logger.info(f"Looking up {len(chunk)} users in IAM Identity Center")
+
+        response = fetch_users_data(settings.IDC_STORE_ID, chunk, settings.IDC_REGION)
+        try:
+            user_infos = json.loads(response.text).get('Users', [])
+        except (AttributeError, json.JSONDecodeError) as e:
+            logger.error(f"Invalid DescribeUsers response for {len(chunk)} users: {str(e)}")
+            raise UserDataFetchError(f"Invalid DescribeUsers response: {str(e)}")
+
+        for user_info in user_infos:
+            user_id = user_info.get('UserId')
+            if user_id not in chunk_ids:
+                continue
+
+            email = _get_primary_email(user_info)
+            if email is None:
+                # The email is not part of the DescribeUsers payload for this user
+                email = look_up_user_email(user_id)
+
+            users[user_id] = {
+                'email': email,
+                'cost_center': _get_attribute_value(user_info, attribute_name)
+            }
+
+        found = {}
+        for user_id in chunk:
+            if user_id not in users:
+                logger.warning(f"User {user_id} was not returned by IAM Identity Center")
+                continue
+            found[_email_key(user_id)] = users[user_id]['email']
+            found[_attribute_key(user_id, attribute_name)] = users[user_id]['cost_center']
+        identity_cache.set_many(found)
+
+    return users
+
+
+def plan_user_resolution(subscriber_count):
+    """
+    Set the number of subscribers to resolve, which decides the 'auto' resolution mode
+
+    Args:
+        subscriber_count: Number of users with a subscription in the billing period
+    """
+    global _expected_subscribers
+    with _snapshot_lock:
+        _expected_subscribers = max(_expected_subscribers, subscriber_count)
+
+
+def get_directory_snapshot(attribute_name):
+    """
+    Get the directory snapshot, building it on the first call
+
+    With settings.IDC_RESOLUTION_MODE 'point' there is no snapshot. Otherwise a
+    saved snapshot is loaded from settings.IDC_SNAPSHOT_PATH, or the directory
+    is listed. In 'auto' mode listing stops once it has taken as many requests
+    as the point lookups of the planned subscribers would, and the users listed
+    so far are still used. The subscribers that were not listed are then looked
+    up as well, so a directory with many more users than subscribers takes up to
+    twice the requests of 'point'. If listing fails in 'auto' mode, point
+    lookups are used.
+
+    Args:
+        attribute_name: Name of the enterprise attribute holding the cost center
+
+    Returns:
+        DirectorySnapshot or None
+
+    Raises:
+        UserDataFetchError: If listing the directory fails in 'snapshot' mode
+    """
+    global directory_snapshot, _snapshot_attempted
+    mode = settings.IDC_RESOLUTION_MODE
+    if mode == 'point':
+        return None
+
+    with _snapshot_lock:
+        if _snapshot_attempted:
+            return directory_snapshot
+        _snapshot_attempted = True
+
+        if settings.IDC_SNAPSHOT_PATH and not identity_cache.refresh:
+            directory_snapshot = DirectorySnapshot.load(
+                settings.IDC_SNAPSHOT_PATH, settings.IDC_STORE_ID, attribute_name, settings.IDC_SNAPSHOT_TTL)
+            if directory_snapshot is not None:
+                return directory_snapshot
+
+        max_pages = None
+        if mode == 'auto':
+            max_pages = max(1, math.ceil(_expected_subscribers / settings.IDC_BATCH_SIZE))
+        try:
+            directory_snapshot = list_directory(settings.IDC_STORE_ID, attribute_name,
+                                                settings.IDC_REGION, max_pages)
+        except UserDataFetchError as e:
+            if mode == 'snapshot':
+                raise
+            logger.warning(f"Listing the directory failed, using point lookups: {str(e)}")
+            return None
+
+        if not directory_snapshot.complete:
+            logger.info(f"Directory has more than {len(directory_snapshot)} users, "
+                        f"point lookups are cheaper for the other subscribers")
+        elif settings.IDC_SNAPSHOT_PATH:
+            directory_snapshot.save(settings.IDC_SNAPSHOT_PATH)
+        return directory_snapshot
+
+
+def list_directory(identity_store_id, attribute_name, region, max_pages=None):
+    """
+    List the users of an identity store into a DirectorySnapshot
+    
+    Pages through the signed SearchUsers operation without filters, which
+    returns the same user attributes as DescribeUsers. The ListUsers
+    operation of the public API does not return enterprise attributes.
+    
+    Args:
+        identity_store_id: The ID of the identity store
+        attribute_name: Name of the enterprise attribute holding the cost center
+        region: AWS region
+        max_pages: Stop after this many pages (default: list all users)
+        
+    Returns:
+        DirectorySnapshot, complete if all pages were listed
+        
+    Raises:
+        UserDataFetchError: If a request fails
+    """
+    snapshot = DirectorySnapshot(identity_store_id, attribute_name)
+    request_data = {
+        "IdentityStoreId": identity_store_id,
+        "MaxResults": settings.IDC_SNAPSHOT_PAGE_SIZE
+        }
+    pages = 0
+    with metrics.timer('IdcSnapshotTime'):
+        while max_pages is None or pages < max_pages:
+            response = get_identity_store_client(region).post('AWSIdentityStoreService.SearchUsers', request_data)
+            pages += 1
+            try:
+                page = json.loads(response.text)
+            except (AttributeError, json.JSONDecodeError) as e:
+                raise UserDataFetchError(f"Invalid SearchUsers response: {str(e)}")
+
+            for user_info in page.get('Users', []):
+                email = _get_primary_email(user_info)
+                if user_info.get('UserId') and email is not None:
+                    snapshot.add(user_info['UserId'], email, _get_attribute_value(user_info, attribute_name))
+
+            if not page.get('NextToken'):
+                snapshot.complete = True
+                break
+            request_data['NextToken'] = page['NextToken']
+
+    logger.info(f"Listed {len(snapshot)} users in {pages} pages of the directory")
+    return snapshot
+
+
+def _is_throttled(response):
+    """
+    Check whether an Identity Store response rejects the request for its rate
+
+    The endpoint answers throttled requests with HTTP 429 or with HTTP 400 and
+    a ThrottlingException __type.
+    """
+    if response.status_code == 429:
+        return True
+    if response.status_code != 400:
+        return False
+    try:
+        error_type = response.json().get('__type', '')
+    except (AttributeError, ValueError):
+        return False
+    return error_type.split('#')[-1] in rate_limiter.THROTTLING_ERROR_CODES
+
+
+def _is_access_denied(response):
+    """
+    Check whether an Identity Store response rejects the request for its credentials or permissions
+
+    The endpoint answers these requests with HTTP 401 or 403, or with HTTP 400
+    and one of ACCESS_ERROR_CODES as __type.
+    """
+    if response.status_code in (401, 403):
+        return True
+    if response.status_code != 400:
+        return False
+    try:
+        error_type = response.json().get('__type', '')
+    except (AttributeError, ValueError):
+        return False
+    return error_type.split('#')[-1] in ACCESS_ERROR_CODES
+
+
+def _email_key(user_id):
+    return f"email:{user_id}"
+
+
+def _attribute_key(user_id, attribute_name):
+    return f"attribute:{attribute_name}:{user_id}"
+
+
+def _get_primary_email(user_info):
+    """
+    Read the primary email from a DescribeUsers user entry
+    
+    Args:
+        user_info: One entry of the 'Users' list
+        
+    Returns:
+        Primary email, '' if the user has no primary email, or None if the entry
+        carries no email information at all
+    """
+    if 'Emails' in user_info:
+        for email in user_info['Emails'] or []:
+            if email.get('Primary'):
+                return email.get('Value', '')
         return ''
-    except Exception as e:
-        logger.error(f"Unexpected error looking up {attribute_name} for user {user_id}: {str(e)}")
-        return ''
+
+    emails = user_info.get('UserAttributes', {}).get('emails')
+    if emails is None:
+        return None
+
+    for email in emails.get('ComplexListValue', []):
+        value = email.get('ComplexValue', {})
+        if value.get('primary', {}).get('BooleanValue'):
+            return value.get('value', {}).get('StringValue', '')
+    return ''
+
+
+def _get_attribute_value(user_info, attribute_name):
+    """
+    Read an enterprise attribute from a DescribeUsers user entry
+    
+    Args:
+        user_info: One entry of the 'Users' list
+        attribute_name: Name of the enterprise attribute
+        
+    Returns:
+        Attribute value or '' if not set
+    """
+    value = (user_info
+            .get('UserAttributes', {})
+            .get('enterprise', {})
+            .get('ComplexValue', {})
+            .get(attribute_name, {})
+            .get('StringValue'))
+
+    return value if value is not None else ''
 
 class UserDataFetchError(Exception):
     """Custom exception for user data fetch errors"""
+    pass
+
+class IdentityStoreAccessError(UserDataFetchError):
+    """Custom exception for requests rejected whatever user they look up, e.g. for missing permissions"""
     pass
\ No newline at end of file
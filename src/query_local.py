@@ -0,0 +1,180 @@
+import glob
+import os
+import time
+import logging
+
+import metrics
+import settings
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# Rows fetched from DuckDB at a time
+FETCH_SIZE = 10000
+
+
+def run_query(query_string, year, month, checkpoint=None):
+    """
+    Run a query on the local CUR 2.0 Parquet files for one billing period
+
+    Same interface as query_athena.run_query, so the Athena SQL runs unchanged.
+
+    Args:
+        query_string: SQL query with positional parameters and {0} for the CUR table
+        year: Year value for query
+        month: Month value for query
+        checkpoint: Ignored, local queries are not worth resuming
+
+    Returns:
+        Generator over all result rows as tuples of column values, like Athena
+        returns them: strings, and None for NULL values
+
+    Raises:
+        LocalQueryError: If the files cannot be read or the query fails
+    """
+    billing_period = f"{year}-{int(month):02d}"
+    logger.info(f"Starting local query for billing period {billing_period}")
+    return run_local_query(query_string, [billing_period], billing_period, billing_period)
+
+
+def run_range_query(query_string, start_period, end_period, checkpoint=None):
+    """
+    Run a query on the local CUR 2.0 Parquet files for a range of billing periods
+
+    Args:
+        query_string: SQL query with start and end billing period parameters
+        start_period: First billing period (YYYY-MM)
+        end_period: Last billing period (YYYY-MM)
+        checkpoint: Ignored, local queries are not worth resuming
+
+    Returns:
+        Generator over all result rows, see run_query
+
+    Raises:
+        LocalQueryError: If the files cannot be read or the query fails
+    """
+    logger.info(f"Starting local query for billing periods {start_period} to {end_period}")
+    return run_local_query(query_string, [start_period, end_period], start_period, end_period)
+
+
+def run_local_query(query_string, parameters, start_period, end_period):
+    """
+    Run a query with DuckDB on the Parquet files of a range of billing periods
+
+    Only the files of the billing period partitions in the range are read, and
+    DuckDB only reads the columns and row groups the query needs.
+
+    Args:
+        query_string: SQL query with positional parameters and {0} for the CUR table
+        parameters: List of string values for the parameters
+        start_period: First billing period (YYYY-MM) of the files to read
+        end_period: Last billing period (YYYY-MM) of the files to read
+
+    Returns:
+        Generator over all result rows, see run_query
+
+    Raises:
+        LocalQueryError: If the files cannot be read or the query fails
+    """
+    files = find_files(settings.LOCAL_CUR_PATH, start_period, end_period)
+    if not files:
+        logger.warning(f"No CUR files for billing periods {start_period} to {end_period} in {settings.LOCAL_CUR_PATH}")
+        return iter(())
+
+    duckdb = _import_duckdb()
+    file_list = ', '.join("'" + path.replace("'", "''") + "'" for path in files)
+    rendered_query = query_string.format(f"read_parquet([{file_list}], hive_partitioning = true)")
+    logger.debug(f"Query string: {rendered_query}")
+
+    try:
+        connection = duckdb.connect()
+        start_time = time.monotonic()
+        cursor = connection.execute(rendered_query, parameters)
+        metrics.record('LocalQueryTime', time.monotonic() - start_time, 'Seconds')
+    except duckdb.Error as e:
+        logger.error(f"Local query failed: {str(e)}", exc_info=True)
+        raise LocalQueryError(f"Local query failed: {str(e)}")
+
+    logger.info(f"Local query on {len(files)} files completed")
+    return _fetch_rows(connection, cursor)
+
+
+def find_files(path, start_period, end_period):
+    """
+    List the Parquet files of a range of billing periods
+
+    CUR 2.0 data exports write the files of a billing period under a
+    BILLING_PERIOD=YYYY-MM directory, matched without regard to case. The
+    queries filter on the billing_period column of these directories, so
+    files outside of them cannot be queried.
+
+    Args:
+        path: Directory with the CUR 2.0 Parquet files
+        start_period: First billing period (YYYY-MM)
+        end_period: Last billing period (YYYY-MM)
+
+    Returns:
+        Sorted list of file paths
+
+    Raises:
+        LocalQueryError: If path is not a directory or has no billing period directories
+    """
+    if not path or not os.path.isdir(path):
+        raise LocalQueryError(f"LOCAL_CUR_PATH is not a directory: {path}")
+
+    partitions = {}
+    for directory, subdirectories, _ in os.walk(path):
+        for subdirectory in subdirectories:
+            name, _, value = subdirectory.partition('=')
+            if name.lower() == 'billing_period':
+                partitions[os.path.join(directory, subdirectory)] = value
+        # Partition directories are not nested
+        subdirectories[:] = [subdirectory for subdirectory in subdirectories
+                             if os.path.join(directory, subdirectory) not in partitions]
+
+    if not partitions:
+        raise LocalQueryError(f"No BILLING_PERIOD=YYYY-MM directories in {path}, copy the data/ prefix "
+                              f"of the CUR 2.0 data export with its partition directories")
+
+    files = []
+    for directory, billing_period in partitions.items():
+        if start_period <= billing_period <= end_period:
+            files.extend(glob.glob(os.path.join(directory, '**', '*.parquet'), recursive=True))
+    return sorted(files)
+
+
+def _fetch_rows(connection, cursor):
+    """Yield the result rows with their values as strings, closing the connection at the end"""
+    duckdb = _import_duckdb()
+    row_count = 0
+    try:
+        while True:
+            # DuckDB reads the files while the rows are fetched, so errors in the data show up here
+            try:
+                rows = cursor.fetchmany(FETCH_SIZE)
+            except duckdb.Error as e:
+                logger.error(f"Reading local query results failed: {str(e)}", exc_info=True)
+                raise LocalQueryError(f"Reading local query results failed: {str(e)}")
+            if not rows:
+                break
+            for row in rows:
+                row_count += 1
+                yield tuple(None if value is None else str(value) for value in row)
+    finally:
+        connection.close()
+    metrics.increment('LocalResultRows', row_count)
+    logger.info(f"Read total {row_count} rows")
+
+
+def _import_duckdb():
+    """Import DuckDB, which is only needed by the local backend"""
+    try:
+        import duckdb
+    except ImportError:
+        raise LocalQueryError("The local query backend needs DuckDB: pip install duckdb")
+    return duckdb
+
+
+class LocalQueryError(Exception):
+    """Custom exception for local query errors"""
+    pass
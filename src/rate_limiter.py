@@ -0,0 +1,218 @@
+import random
+import threading
+import time
+import logging
+
+from botocore.exceptions import ClientError
+
+import metrics
+import settings
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# Error codes AWS services use when a request is rejected for exceeding a rate
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'SlowDown'
+}
+
+# Rate limiters by service, shared by all threads
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket rate limiter that adapts its rate to throttling (AIMD)
+
+    Requests take a token from a bucket that refills at the current rate and
+    holds at most one second worth of tokens. On throttling the rate is
+    multiplied by decrease_factor, at most once per cooldown seconds so that a
+    burst of throttled requests in flight only counts once. After every
+    success_threshold consecutive successes the rate grows by increase_step,
+    up to max_rate. The limiter is safe to use from several threads.
+    """
+
+    def __init__(self, name, max_rate, min_rate=1.0, increase_step=1.0, decrease_factor=0.5,
+                 success_threshold=10, cooldown=1.0):
+        self.name = name
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.success_threshold = success_threshold
+        self.cooldown = cooldown
+        self.rate = max_rate
+        self.requests = 0
+        self.throttles = 0
+        self._tokens = max(1.0, max_rate)
+        self._updated = time.monotonic()
+        self._successes = 0
+        self._last_decrease = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a request fits in the current rate
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.requests += 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        """
+        Record a request that was not throttled
+        """
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.success_threshold:
+                self._successes = 0
+                self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self):
+        """
+        Record a throttled request and lower the rate
+        """
+        with self._lock:
+            self.throttles += 1
+            self._successes = 0
+            now = time.monotonic()
+            if self._last_decrease is None or now - self._last_decrease >= self.cooldown:
+                self._last_decrease = now
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                logger.info(f"{self.name} throttled, lowering rate to {self.rate:.1f} requests per second")
+        metrics.increment(f'{self.name}Throttles')
+
+    def stats(self):
+        """
+        Get the request and throttle counters
+
+        Returns:
+            Dict with the requests, throttles and the current rate
+        """
+        with self._lock:
+            return {'requests': self.requests, 'throttles': self.throttles, 'rate': self.rate}
+
+
+def get_limiter(name):
+    """
+    Get the shared rate limiter of a service
+
+    Args:
+        name: Service name, 'Idc' or 'Ddb'
+
+    Returns:
+        AdaptiveRateLimiter
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            max_rate = {'Idc': settings.IDC_MAX_RPS, 'Ddb': settings.DDB_MAX_RPS}[name]
+            _limiters[name] = AdaptiveRateLimiter(name, max_rate)
+        return _limiters[name]
+
+
+def call_with_retry(limiter, func, *args, **kwargs):
+    """
+    Call func within the rate of a limiter, retrying throttled calls
+
+    Throttled calls are retried with full jitter exponential backoff, up to
+    settings.THROTTLE_MAX_RETRIES times.
+
+    Args:
+        limiter: AdaptiveRateLimiter of the service
+        func: Function sending one request
+        *args: Positional arguments of func
+        **kwargs: Keyword arguments of func
+
+    Returns:
+        Return value of func
+
+    Raises:
+        Exception: The error of the last attempt if it is not throttling or
+            the retries are exhausted
+    """
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if not is_throttling_error(e):
+                raise
+            limiter.on_throttle()
+            attempt += 1
+            if attempt > settings.THROTTLE_MAX_RETRIES:
+                logger.error(f"{limiter.name} still throttled after {settings.THROTTLE_MAX_RETRIES} retries")
+                raise
+            delay = random.uniform(0, min(settings.THROTTLE_MAX_BACKOFF, settings.THROTTLE_BASE_BACKOFF * 2 ** attempt))
+            logger.debug(f"{limiter.name} request throttled, retrying in {delay:.2f} seconds")
+            time.sleep(delay)
+            continue
+
+        limiter.on_success()
+        return result
+
+
+def is_throttling_error(error):
+    """
+    Check whether an error means the request was throttled
+
+    Args:
+        error: Exception raised by a request
+
+    Returns:
+        True for ThrottlingError and ClientErrors with a throttling error code
+    """
+    if isinstance(error, ThrottlingError):
+        return True
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+    return False
+
+
+def summary():
+    """
+    Log and return the request and throttle counts of every service
+
+    Returns:
+        Dict of service name to the stats of its limiter
+    """
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+
+    stats = {}
+    for limiter in limiters:
+        stats[limiter.name] = limiter.stats()
+        logger.info(f"{limiter.name} requests: {stats[limiter.name]['requests']}, "
+                    f"throttles: {stats[limiter.name]['throttles']}, "
+                    f"final rate: {stats[limiter.name]['rate']:.1f} requests per second")
+    return stats
+
+
+def reset():
+    """
+    Drop all rate limiters, so they are created again from the settings
+    """
+    with _limiters_lock:
+        _limiters.clear()
+
+
+class ThrottlingError(Exception):
+    """Custom exception for throttled requests that are not raised as ClientError"""
+    pass
@@ -6,18 +6,135 @@ import os
 
 PROFILE_NAME=os.getenv('PROFILE_NAME')
 
+#'athena' runs the queries in Athena, 'local' runs them with DuckDB on CUR 2.0 Parquet files in LOCAL_CUR_PATH
+QUERY_BACKEND=os.getenv('QUERY_BACKEND', 'athena')
+LOCAL_CUR_PATH=os.getenv('LOCAL_CUR_PATH')
+
 #Athena variables
 DATABASE_NAME=os.getenv('DATABASE_NAME')
 ATHENA_TABLE_NAME=os.getenv('ATHENA_TABLE_NAME')
 WORK_GROUP=os.getenv('WORK_GROUP')
 RESULT_LOCATION=os.getenv('RESULT_LOCATION')
+#'combined' runs one scan for per-user costs and totals, 'separate' runs two queries
+ATHENA_QUERY_MODE=os.getenv('ATHENA_QUERY_MODE', 'combined')
+#'api' pages through GetQueryResults, 's3' streams the result CSV from RESULT_LOCATION
+ATHENA_RESULT_READER=os.getenv('ATHENA_RESULT_READER', 'api')
+#Local query result cache, enabled when QUERY_CACHE_DIR is set. Results of open
+#billing periods expire after QUERY_CACHE_OPEN_PERIOD_TTL seconds, a billing period
+#is closed QUERY_CACHE_CLOSE_DAYS days after the month ends
+QUERY_CACHE_DIR=os.getenv('QUERY_CACHE_DIR')
+QUERY_CACHE_OPEN_PERIOD_TTL=int(os.getenv('QUERY_CACHE_OPEN_PERIOD_TTL', '3600'))
+QUERY_CACHE_CLOSE_DAYS=int(os.getenv('QUERY_CACHE_CLOSE_DAYS', '5'))
+#Q Developer cost table materialized from the CUR table, queried instead of ATHENA_TABLE_NAME
+#when set. Billing periods that are new or restated in the CUR are refreshed before each run.
+#Data is stored as Parquet under MATERIALIZED_TABLE_LOCATION (default: RESULT_LOCATION/<table>/)
+MATERIALIZED_TABLE_NAME=os.getenv('MATERIALIZED_TABLE_NAME')
+MATERIALIZED_TABLE_LOCATION=os.getenv('MATERIALIZED_TABLE_LOCATION')
+#Athena query result reuse in minutes, 0 to disable
+ATHENA_RESULT_REUSE_MAX_AGE=int(os.getenv('ATHENA_RESULT_REUSE_MAX_AGE', '0'))
+#Query completion polling, in seconds
+ATHENA_QUERY_TIMEOUT=float(os.getenv('ATHENA_QUERY_TIMEOUT', '300'))
+ATHENA_POLL_MIN_INTERVAL=float(os.getenv('ATHENA_POLL_MIN_INTERVAL', '0.2'))
+ATHENA_POLL_MAX_INTERVAL=float(os.getenv('ATHENA_POLL_MAX_INTERVAL', '5'))
+ATHENA_POLL_BACKOFF=float(os.getenv('ATHENA_POLL_BACKOFF', '2'))
+#Fraction of the queue + execution time so far to wait before the next poll
+ATHENA_POLL_TIME_FRACTION=float(os.getenv('ATHENA_POLL_TIME_FRACTION', '0.1'))
+#Seconds a refresh of MATERIALIZED_TABLE_NAME holds the lock of its billing periods before other
+#runs take it over. A refresh lists the CUR in S3 and runs CREATE TABLE and INSERT INTO, each of
+#which can take up to ATHENA_QUERY_TIMEOUT
+MATERIALIZED_LOCK_TIMEOUT=float(os.getenv('MATERIALIZED_LOCK_TIMEOUT', str(2 * ATHENA_QUERY_TIMEOUT + 300)))
 
 #IDC Variables
 IDC_STORE_ID=os.getenv('IDC_STORE_ID')
 IDC_COST_CENTER_ATTRIBUTE = os.getenv('IDC_COST_CENTER_ATTRIBUTE_NAME')
+IDC_REGION=os.getenv('IDC_REGION', 'us-east-1')
+#Override of the Identity Store endpoint, e.g. a local stub
+IDC_ENDPOINT_URL=os.getenv('IDC_ENDPOINT_URL')
+#Number of user IDs sent in one DescribeUsers request
+IDC_BATCH_SIZE=int(os.getenv('IDC_BATCH_SIZE', '100'))
+#'sequential' or 'concurrent' resolution of users and DynamoDB writes
+PIPELINE_MODE=os.getenv('PIPELINE_MODE', 'sequential')
+#'point' looks up subscribers with DescribeUsers, 'snapshot' lists the whole directory
+#once and 'auto' lists at most as many pages as the point lookups take. 'auto' only pays
+#off when most users of the directory are subscribers, otherwise it takes up to twice
+#the requests of 'point'
+IDC_RESOLUTION_MODE=os.getenv('IDC_RESOLUTION_MODE', 'point')
+#Users per page when listing the directory
+IDC_SNAPSHOT_PAGE_SIZE=int(os.getenv('IDC_SNAPSHOT_PAGE_SIZE', '100'))
+#Directory snapshot saved to IDC_SNAPSHOT_PATH when set, reused for IDC_SNAPSHOT_TTL seconds
+IDC_SNAPSHOT_PATH=os.getenv('IDC_SNAPSHOT_PATH')
+IDC_SNAPSHOT_TTL=int(os.getenv('IDC_SNAPSHOT_TTL', '86400'))
+#Number of DescribeUsers requests in flight in the concurrent pipeline
+IDC_CONCURRENCY=int(os.getenv('IDC_CONCURRENCY', '8'))
+#Number of BatchWriteItem requests in flight in the concurrent pipeline
+DDB_WRITE_CONCURRENCY=int(os.getenv('DDB_WRITE_CONCURRENCY', '4'))
+#Persistent tier of the identity cache: 'none', 'sqlite' (the file IDENTITY_CACHE_PATH) or
+#'dynamodb' (items in DDB_STATE_TABLE_NAME, kept across the containers of AWS Batch jobs)
+IDENTITY_CACHE_PATH=os.getenv('IDENTITY_CACHE_PATH')
+IDENTITY_CACHE_STORE=os.getenv('IDENTITY_CACHE_STORE', 'sqlite' if IDENTITY_CACHE_PATH else 'none')
+IDENTITY_CACHE_TTL=int(os.getenv('IDENTITY_CACHE_TTL', '604800'))
+IDENTITY_CACHE_SIZE=int(os.getenv('IDENTITY_CACHE_SIZE', '50000'))
+IDENTITY_CACHE_REFRESH=os.getenv('IDENTITY_CACHE_REFRESH', 'false').lower() == 'true'
+#Requests per second sent to Identity Store, lowered on throttling and raised again after sustained success
+IDC_MAX_RPS=float(os.getenv('IDC_MAX_RPS', '20'))
 
 
 #DDB Variables
 DDB_TABLE_NAME=os.getenv('DDB_TABLE_NAME')
 DDB_PARTITION_KEY=os.getenv('DDB_PARTITION_KEY')
-DDB_SORT_KEY=os.getenv('DDB_SORT_KEY')
\ No newline at end of file
+DDB_SORT_KEY=os.getenv('DDB_SORT_KEY')
+#'overwrite' puts every item, 'incremental' only puts added or changed items
+DDB_WRITE_MODE=os.getenv('DDB_WRITE_MODE', 'overwrite')
+#Delete items of users no longer in the billing period (incremental mode only)
+DDB_DELETE_MISSING=os.getenv('DDB_DELETE_MISSING', 'false').lower() == 'true'
+#Index keyed on the sort key, used to read all items of a billing period
+DDB_PERIOD_INDEX_NAME=os.getenv('DDB_PERIOD_INDEX_NAME', 'time-period-index')
+#Write a COST_CENTER#<cost center> item per cost center and billing period with its totals.
+#The items share the table with the per-user items, stale ones are found through DDB_PERIOD_INDEX_NAME
+DDB_ROLLUP_ENABLED=os.getenv('DDB_ROLLUP_ENABLED', 'false').lower() == 'true'
+#Table of the bookkeeping items of the job (cached identities, checkpoints and locks), keyed on
+#DDB_STATE_PARTITION_KEY alone and expired through its expires_at TTL attribute. Kept out of
+#DDB_TABLE_NAME so the items stay out of its time period index and of the scans of BI tools
+DDB_STATE_TABLE_NAME=os.getenv('DDB_STATE_TABLE_NAME')
+DDB_STATE_PARTITION_KEY=os.getenv('DDB_STATE_PARTITION_KEY', 'pk')
+
+#Retries for items returned as UnprocessedItems by BatchWriteItem
+DDB_MAX_RETRIES=int(os.getenv('DDB_MAX_RETRIES', '8'))
+DDB_BASE_BACKOFF=float(os.getenv('DDB_BASE_BACKOFF', '0.05'))
+DDB_MAX_BACKOFF=float(os.getenv('DDB_MAX_BACKOFF', '5'))
+#BatchWriteItem requests per second, lowered on throttling and raised again after sustained success
+DDB_MAX_RPS=float(os.getenv('DDB_MAX_RPS', '50'))
+
+#Retries of throttled Identity Store and DynamoDB requests, with backoff in seconds
+THROTTLE_MAX_RETRIES=int(os.getenv('THROTTLE_MAX_RETRIES', '8'))
+THROTTLE_BASE_BACKOFF=float(os.getenv('THROTTLE_BASE_BACKOFF', '0.1'))
+THROTTLE_MAX_BACKOFF=float(os.getenv('THROTTLE_MAX_BACKOFF', '10'))
+
+#Per-user chargeback rows exported as Parquet files partitioned by billing period, to an
+#s3:// location or a local directory, when PARQUET_EXPORT_LOCATION is set
+PARQUET_EXPORT_LOCATION=os.getenv('PARQUET_EXPORT_LOCATION')
+PARQUET_EXPORT_COMPRESSION=os.getenv('PARQUET_EXPORT_COMPRESSION', 'snappy')
+PARQUET_EXPORT_ROW_GROUP_SIZE=int(os.getenv('PARQUET_EXPORT_ROW_GROUP_SIZE', '100000'))
+
+#Sharded runs as AWS Batch array jobs: each child processes the users whose hashed
+#user ID falls in its AWS_BATCH_JOB_ARRAY_INDEX, SHARD_COUNT is the array size
+SHARD_COUNT=int(os.getenv('SHARD_COUNT', '1'))
+SHARD_INDEX=int(os.getenv('AWS_BATCH_JOB_ARRAY_INDEX', '0'))
+#Shards share their Athena queries per run, the ID of the array job (AWS_BATCH_JOB_ID of a child is <parent>:<index>)
+SHARD_RUN_ID=os.getenv('AWS_BATCH_JOB_ID', '').split(':')[0]
+
+#Checkpoints of finished queries and written users, so a restarted run resumes:
+#'none', 'file' (JSON files in CHECKPOINT_DIR) or 'dynamodb' (items in DDB_STATE_TABLE_NAME)
+CHECKPOINT_STORE=os.getenv('CHECKPOINT_STORE', 'none')
+CHECKPOINT_DIR=os.getenv('CHECKPOINT_DIR', '.checkpoints')
+#Chunks of IDC_BATCH_SIZE users written between checkpoint saves
+CHECKPOINT_INTERVAL=int(os.getenv('CHECKPOINT_INTERVAL', '10'))
+#Older checkpoints are ignored, in seconds
+CHECKPOINT_MAX_AGE=int(os.getenv('CHECKPOINT_MAX_AGE', '86400'))
+
+#CloudWatch Embedded Metric Format metrics written to stdout at the end of a run
+METRICS_ENABLED=os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE=os.getenv('METRICS_NAMESPACE', 'QDeveloperCostAnalyzer')
+METRICS_SERVICE_NAME=os.getenv('METRICS_SERVICE_NAME', 'q-dev-cost-analyzer')
+#Write a cProfile profile of the whole run to this path
+PROFILE_OUTPUT=os.getenv('PROFILE_OUTPUT')
\ No newline at end of file
@@ -0,0 +1,138 @@
+import hashlib
+import logging
+
+import settings
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# Separates the cost center from the shard in the keys of partial rollup items
+ROLLUP_SHARD_SEPARATOR = '#SHARD#'
+
+
+def is_sharded():
+    """
+    Check whether this run processes one shard of the users
+
+    Returns:
+        True if settings.SHARD_COUNT is above 1
+    """
+    return settings.SHARD_COUNT > 1
+
+
+def shard_of(user_id, shard_count):
+    """
+    Get the shard of a user
+
+    The shard is derived from a SHA-1 hash of the user ID at the end of the
+    line_item_resource_id, so users spread evenly over the shards and stay in
+    the same shard across runs.
+
+    Args:
+        user_id: User ID
+        shard_count: Number of shards
+
+    Returns:
+        Shard index between 0 and shard_count - 1
+    """
+    digest = hashlib.sha1(user_id.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+
+def select_shard(user_costs):
+    """
+    Keep the users of the shard of this run
+
+    Args:
+        user_costs: Iterable of (resource_id, cost) tuples
+
+    Yields:
+        The (resource_id, cost) tuples of the users in shard settings.SHARD_INDEX
+    """
+    for resource_id, cost in user_costs:
+        if in_shard(resource_id.split("/")[-1]):
+            yield resource_id, cost
+
+
+def in_shard(user_id):
+    """
+    Check whether a user belongs to the shard of this run
+
+    Args:
+        user_id: User ID
+
+    Returns:
+        True if the user is in shard settings.SHARD_INDEX
+    """
+    return shard_of(user_id, settings.SHARD_COUNT) == settings.SHARD_INDEX
+
+
+def run_suffix():
+    """
+    Get the suffix that tells the checkpoints of the shards of a run apart
+
+    Returns:
+        '-shard-<index>-of-<count>' when sharded, otherwise ''
+    """
+    if not is_sharded():
+        return ''
+    return f"-shard-{settings.SHARD_INDEX}-of-{settings.SHARD_COUNT}"
+
+
+def shared_run_key(run_key):
+    """
+    Get the key under which the shards of a run share their queries
+
+    Children of one AWS Batch array job share the ID of the parent job, so a
+    new submission does not pick up the queries of an earlier one.
+
+    Args:
+        run_key: Name of the run, e.g. month-2025-01
+
+    Returns:
+        run_key with settings.SHARD_RUN_ID, or None when not sharded
+    """
+    if not is_sharded():
+        return None
+    if not settings.SHARD_RUN_ID:
+        return run_key
+    return f"{run_key}#{settings.SHARD_RUN_ID}"
+
+
+def rollup_suffix():
+    """
+    Get the suffix of the cost center rollup keys written by this run
+
+    Each shard only sees its own users, so sharded runs write partial rollups
+    that are summed up by the reader.
+
+    Returns:
+        '#SHARD#<index>-of-<count>' when sharded, otherwise ''
+    """
+    if not is_sharded():
+        return ''
+    return f"{ROLLUP_SHARD_SEPARATOR}{settings.SHARD_INDEX}-of-{settings.SHARD_COUNT}"
+
+
+def owns_rollup(key):
+    """
+    Check whether this run is responsible for removing a stale rollup item
+
+    An unsharded run owns all rollup items. A shard owns the partial rollups
+    with its own suffix, and shard 0 also owns the items of unsharded runs and
+    of runs with a different number of shards.
+
+    Args:
+        key: Partition key of a rollup item
+
+    Returns:
+        True if this run may delete the item
+    """
+    if not is_sharded():
+        return True
+    if key.endswith(rollup_suffix()):
+        return True
+    if settings.SHARD_INDEX != 0:
+        return False
+    _, separator, shard = key.rpartition(ROLLUP_SHARD_SEPARATOR)
+    return not separator or not shard.endswith(f"-of-{settings.SHARD_COUNT}")
@@ -0,0 +1,106 @@
+"""
+Shared setup of the tests
+
+The modules under src create their AWS clients at import time, so the tests
+run them with dummy credentials and the fakes from benchmarks/fakes.py.
+"""
+import importlib.util
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+os.environ.setdefault('METRICS_ENABLED', 'false')
+sys.path.insert(0, os.path.join(REPO_ROOT, 'src'))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'benchmarks'))
+
+import fakes  # noqa: E402
+import metrics  # noqa: E402
+import query_athena  # noqa: E402
+import query_idc  # noqa: E402
+import rate_limiter  # noqa: E402
+import settings  # noqa: E402
+from identity_cache import IdentityCache  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def main_module():
+    """The main script, whose file name is not a valid module name"""
+    path = os.path.join(REPO_ROOT, 'src', 'q-dev-subscription-cost-using-athena.py')
+    spec = importlib.util.spec_from_file_location('q_dev_subscription_cost', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeAws:
+    """The fakes a run of the main script talks to, see the fake_aws fixture"""
+
+    def __init__(self, cur, athena, idc_http, idc, ddb):
+        self.cur = cur
+        self.athena = athena
+        self.idc_http = idc_http
+        self.idc = idc
+        self.ddb = ddb
+
+    def user_items(self):
+        """Stored per-user items by (user ID, billing period), without rollups and bookkeeping items"""
+        return {key: item for key, item in self.ddb.items.items()
+                if key[1] == self.cur.billing_period and not key[0].startswith('COST_CENTER#')}
+
+
+@pytest.fixture
+def fake_aws(monkeypatch, main_module):
+    """
+    Factory pointing the AWS clients of all modules at fresh fakes for a SyntheticCur
+
+    Settings changed by the factory and by the test through monkeypatch are
+    restored after the test.
+    """
+    def create(users, idc_latency=0.0, ddb_latency=0.0, extra_users=0, **settings_overrides):
+        for name, value in {
+            'DATABASE_NAME': 'test',
+            'ATHENA_TABLE_NAME': 'cur',
+            'WORK_GROUP': 'primary',
+            'RESULT_LOCATION': 's3://fake-results/',
+            'IDC_STORE_ID': 'd-0000000000',
+            'IDC_COST_CENTER_ATTRIBUTE': 'costCenter',
+            'DDB_TABLE_NAME': 'test',
+            'DDB_PARTITION_KEY': 'user-guid',
+            'DDB_SORT_KEY': 'time-period',
+            'ATHENA_POLL_MIN_INTERVAL': 0.001,
+            'ATHENA_POLL_MAX_INTERVAL': 0.001,
+            'QUERY_CACHE_DIR': None,
+            'IDC_MAX_RPS': 100000.0,
+            'DDB_MAX_RPS': 100000.0,
+            **settings_overrides
+        }.items():
+            monkeypatch.setattr(settings, name, value)
+
+        cur = fakes.SyntheticCur(users)
+        athena = fakes.FakeAthenaClient(cur)
+        idc_http = fakes.FakeIdentityStoreHttp(cur, settings.IDC_COST_CENTER_ATTRIBUTE, extra_users=extra_users,
+                                               latency=idc_latency)
+        idc = fakes.FakeIdentityStoreClient(idc_http, latency=idc_latency)
+        ddb = fakes.FakeDynamoDBClient(settings.DDB_PARTITION_KEY, settings.DDB_SORT_KEY, latency=ddb_latency)
+
+        monkeypatch.setattr(query_athena, 'athena_client', athena)
+        monkeypatch.setattr(query_athena, 'query_cache', None)
+        monkeypatch.setattr(query_athena, 'prepared_statements', set())
+        monkeypatch.setattr(query_idc, 'idc_client', idc)
+        monkeypatch.setattr(query_idc, 'identity_cache', IdentityCache())
+        monkeypatch.setattr(query_idc, 'directory_snapshot', None)
+        monkeypatch.setattr(query_idc, '_snapshot_attempted', False)
+        monkeypatch.setattr(query_idc, '_expected_subscribers', 0)
+        monkeypatch.setattr(query_idc.get_identity_store_client(settings.IDC_REGION), '_http', idc_http)
+        monkeypatch.setattr(main_module, 'ddb_client', ddb)
+        metrics.reset()
+        rate_limiter.reset()
+        return FakeAws(cur, athena, idc_http, idc, ddb)
+
+    return create
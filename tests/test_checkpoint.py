@@ -0,0 +1,150 @@
+"""
+Tests of the checkpoints of a run
+"""
+import json
+import os
+import time
+
+import pytest
+
+import fakes
+import settings
+from checkpoint import Checkpoint, DynamoDBCheckpointStore, FileCheckpointStore, open_checkpoint, open_lock_store
+
+# Maximum size of a DynamoDB item
+MAX_ITEM_SIZE = 400 * 1024
+
+
+def failed_users(count):
+    return {f"arn:aws:sso::123456789012:user/d-0000000000/{index:08d}-0000-4000-8000-000000000000": 19.0 + index
+            for index in range(count)}
+
+
+def dynamodb_store(monkeypatch):
+    monkeypatch.setattr(settings, 'DDB_STATE_PARTITION_KEY', 'pk')
+    ddb = fakes.FakeDynamoDBClient('pk', None)
+    return ddb, DynamoDBCheckpointStore(ddb, 'state')
+
+
+def test_failed_users_are_saved_outside_the_checkpoint(monkeypatch):
+    ddb, store = dynamodb_store(monkeypatch)
+    checkpoint = Checkpoint(store, 'month-2025-01')
+    progress = checkpoint.period('2025-01')
+    progress['watermark'] = 'arn:aws:sso::123456789012:user/d-0000000000/ffffffff'
+    progress['failed_users'].update(failed_users(10000))
+    checkpoint.save()
+
+    sizes = [len(json.dumps(item)) for item in ddb.items.values()]
+    assert max(sizes) < MAX_ITEM_SIZE
+    assert len(json.dumps(ddb.items[('CHECKPOINT#month-2025-01', None)])) < 1024
+
+    resumed = Checkpoint(store, 'month-2025-01', store.load('month-2025-01'))
+    assert resumed.period('2025-01') == progress
+
+
+def test_only_changed_parts_are_written_again(monkeypatch):
+    ddb, store = dynamodb_store(monkeypatch)
+    checkpoint = Checkpoint(store, 'month-2025-01')
+    users = failed_users(5400)
+    checkpoint.period('2025-01')['failed_users'].update(users)
+    checkpoint.save()
+
+    # A user failing after the others only changes the last part
+    ddb.calls.clear()
+    checkpoint.period('2025-01')['failed_users'].update(failed_users(5401))
+    checkpoint.save()
+    assert ddb.calls['PutItem'] == 2
+
+    # Users resolved on retry remove the parts that are no longer needed
+    checkpoint.period('2025-01')['failed_users'].clear()
+    checkpoint.save()
+    assert set(ddb.items) == {('CHECKPOINT#month-2025-01', None)}
+    assert Checkpoint(store, 'month-2025-01', store.load('month-2025-01')).period('2025-01')['failed_users'] == {}
+
+
+def test_clear_removes_the_failed_users(monkeypatch):
+    ddb, store = dynamodb_store(monkeypatch)
+    checkpoint = Checkpoint(store, 'month-2025-01')
+    checkpoint.period('2025-01')['failed_users'].update(failed_users(2500))
+    checkpoint.save()
+
+    resumed = Checkpoint(store, 'month-2025-01', store.load('month-2025-01'))
+    resumed.clear()
+    assert ddb.items == {}
+
+
+def test_checkpoints_with_inline_failed_users_are_resumed(monkeypatch):
+    _, store = dynamodb_store(monkeypatch)
+    users = failed_users(10)
+    store.save('month-2025-01', {'created': 0, 'query_ids': {}, 'periods': {
+        '2025-01': {'watermark': None, 'failed_users': users, 'rollups': {}}
+    }})
+
+    checkpoint = Checkpoint(store, 'month-2025-01', store.load('month-2025-01'))
+    assert checkpoint.period('2025-01')['failed_users'] == users
+
+
+def test_missing_failed_users_start_the_period_over(monkeypatch):
+    ddb, store = dynamodb_store(monkeypatch)
+    checkpoint = Checkpoint(store, 'month-2025-01')
+    progress = checkpoint.period('2025-01')
+    progress['watermark'] = 'arn:aws:sso::123456789012:user/d-0000000000/ffffffff'
+    progress['failed_users'].update(failed_users(1500))
+    checkpoint.save()
+    del ddb.items[('CHECKPOINT#month-2025-01#FAILED#2025-01#1', None)]
+
+    resumed = Checkpoint(store, 'month-2025-01', store.load('month-2025-01'))
+    assert resumed.period('2025-01') == {'watermark': None, 'failed_users': {}, 'rollups': {}}
+
+
+def test_items_expire_with_the_table_ttl(monkeypatch):
+    ddb, store = dynamodb_store(monkeypatch)
+    monkeypatch.setattr(settings, 'CHECKPOINT_MAX_AGE', 3600)
+    checkpoint = Checkpoint(store, 'month-2025-01-shard-0-of-2', shared_run_key='month-2025-01#run')
+    checkpoint.period('2025-01')['failed_users'].update(failed_users(10))
+    checkpoint.shared_query('query', lambda: 'execution-id')
+    checkpoint.save()
+
+    assert ('QUERY#month-2025-01#run:query', None) in ddb.items
+    now = time.time()
+    for item in ddb.items.values():
+        assert now < int(item['expires_at']['N']) <= now + 3600
+
+
+def test_file_store_removes_expired_queries(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, 'CHECKPOINT_MAX_AGE', 3600)
+    store = FileCheckpointStore(str(tmp_path))
+    store.claim('month-2025-01#old:query')
+    store.claim('month-2025-01#new:query')
+    old_path = store._shared_path('month-2025-01#old:query')
+    os.utime(old_path, (time.time() - 7200, time.time() - 7200))
+
+    FileCheckpointStore(str(tmp_path))
+    assert not os.path.exists(old_path)
+    assert os.path.exists(store._shared_path('month-2025-01#new:query'))
+
+
+def test_sharded_runs_need_a_checkpoint_store(monkeypatch):
+    monkeypatch.setattr(settings, 'CHECKPOINT_STORE', 'none')
+    monkeypatch.setattr(settings, 'SHARD_COUNT', 4)
+
+    with pytest.raises(ValueError, match='CHECKPOINT_STORE'):
+        open_checkpoint('month-2025-01', None)
+
+    monkeypatch.setattr(settings, 'SHARD_COUNT', 1)
+    assert open_checkpoint('month-2025-01', None) is None
+
+
+def test_dynamodb_stores_need_the_state_table(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, 'DDB_STATE_TABLE_NAME', None)
+    monkeypatch.setattr(settings, 'CHECKPOINT_DIR', str(tmp_path))
+    monkeypatch.setattr(settings, 'CHECKPOINT_STORE', 'dynamodb')
+    with pytest.raises(ValueError, match='DDB_STATE_TABLE_NAME'):
+        open_lock_store(None)
+
+    # Without checkpoints the locks fall back to local files
+    monkeypatch.setattr(settings, 'CHECKPOINT_STORE', 'none')
+    assert isinstance(open_lock_store(None), FileCheckpointStore)
+
+    monkeypatch.setattr(settings, 'DDB_STATE_TABLE_NAME', 'state')
+    assert open_lock_store(None).table_name == 'state'
@@ -0,0 +1,105 @@
+"""
+Tests of the re-driving of UnprocessedItems by the batch writer
+"""
+import pytest
+
+import ddb_writer
+import fakes
+import rate_limiter
+import settings
+from ddb_writer import BatchWriter
+
+
+class PartialDynamoDBClient(fakes.FakeDynamoDBClient):
+    """
+    FakeDynamoDBClient processing only the first half of each batch, and never
+    the items in poisoned
+    """
+
+    def __init__(self, *args, poisoned=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.poisoned = set(poisoned)
+        self.batch_sizes = []
+
+    def batch_write_item(self, RequestItems):
+        processed = {}
+        unprocessed = {}
+        for table_name, requests in RequestItems.items():
+            self.batch_sizes.append(len(requests))
+            writable = [request for request in requests if self._request_key(request) not in self.poisoned]
+            processed[table_name] = writable[:max(1, len(writable) // 2)]
+            unprocessed[table_name] = [request for request in requests if request not in processed[table_name]]
+            if not unprocessed[table_name]:
+                del unprocessed[table_name]
+        super().batch_write_item(processed)
+        return {'UnprocessedItems': unprocessed}
+
+    def _request_key(self, request):
+        return self._key(request.get('PutRequest', {}).get('Item') or request['DeleteRequest']['Key'])[0]
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    monkeypatch.setattr(settings, 'DDB_MAX_RPS', 100000.0)
+    monkeypatch.setattr(settings, 'DDB_MAX_RETRIES', 8)
+    monkeypatch.setattr(settings, 'DDB_BASE_BACKOFF', 0.05)
+    monkeypatch.setattr(settings, 'DDB_MAX_BACKOFF', 1.0)
+    rate_limiter.reset()
+    # Full jitter with its upper bound, without sleeping
+    monkeypatch.setattr(ddb_writer.random, 'uniform', lambda low, high: high)
+    slept = []
+    monkeypatch.setattr(ddb_writer.time, 'sleep', slept.append)
+    return slept
+
+
+def item(index):
+    return {'user-guid': {'S': f"user-{index:03d}"}, 'time-period': {'S': '2025-01'}}
+
+
+def test_unprocessed_items_are_written_eventually(delays):
+    ddb = PartialDynamoDBClient('user-guid', 'time-period')
+    writer = BatchWriter(ddb, 'test')
+    for index in range(60):
+        writer.put(item(index))
+    stats = writer.close()
+
+    assert len(ddb.items) == 60
+    assert stats['written'] == 60 and stats['failed'] == 0
+    assert stats['retried'] > 0
+    assert max(ddb.batch_sizes) <= ddb_writer.MAX_BATCH_SIZE
+
+
+def test_backoff_grows_up_to_the_maximum(delays):
+    ddb = PartialDynamoDBClient('user-guid', 'time-period')
+    writer = BatchWriter(ddb, 'test')
+    for index in range(25):
+        writer.put(item(index))
+    writer.close()
+
+    # 25 items take 5 retries when half of each batch is processed
+    assert delays == [0.1, 0.2, 0.4, 0.8, 1.0]
+
+
+def test_items_that_never_succeed_are_reported(delays):
+    ddb = PartialDynamoDBClient('user-guid', 'time-period', poisoned={'user-003', 'user-007'})
+    writer = BatchWriter(ddb, 'test')
+    for index in range(10):
+        writer.put(item(index))
+    writer.delete({'user-guid': {'S': 'user-003'}, 'time-period': {'S': '2025-01'}})
+    stats = writer.close()
+
+    assert stats['failed'] == 3
+    assert stats['written'] == 8 and stats['removed'] == 0
+    assert set(key for key, _ in ddb.items) == {f"user-{index:03d}" for index in range(10)} - {'user-003', 'user-007'}
+    assert len(delays) == settings.DDB_MAX_RETRIES
+
+
+def test_concurrent_batches_are_redriven(delays):
+    ddb = PartialDynamoDBClient('user-guid', 'time-period', poisoned={'user-042'})
+    writer = BatchWriter(ddb, 'test', concurrency=4)
+    for index in range(100):
+        writer.put(item(index))
+    stats = writer.close()
+
+    assert len(ddb.items) == 99
+    assert stats['written'] == 99 and stats['failed'] == 1
@@ -0,0 +1,82 @@
+"""
+Tests of the tiers of identity_cache.IdentityCache
+"""
+import pytest
+
+import fakes
+import settings
+from identity_cache import DynamoDBIdentityStore, IdentityCache, SQLiteIdentityStore, open_identity_store
+
+
+@pytest.fixture
+def ddb(monkeypatch):
+    monkeypatch.setattr(settings, 'DDB_STATE_PARTITION_KEY', 'pk')
+    return fakes.FakeDynamoDBClient('pk', None)
+
+
+def test_dynamodb_tier_serves_a_new_process(ddb):
+    first_run = IdentityCache(store=DynamoDBIdentityStore(ddb, 'table'))
+    first_run.set_many({f"email:{index}": f"user{index}@example.com" for index in range(150)})
+    first_run.close()
+
+    second_run = IdentityCache(store=DynamoDBIdentityStore(ddb, 'table'))
+    found = second_run.get_many([f"email:{index}" for index in range(200)])
+
+    assert found == {f"email:{index}": f"user{index}@example.com" for index in range(150)}
+    assert second_run.persistent_hits == 150
+    assert second_run.misses == 50
+    # 150 keys are written in 6 batches and 200 keys read in 2
+    assert ddb.calls['BatchWriteItem'] == 6
+    assert ddb.calls['BatchGetItem'] == 2
+
+    second_run.get_many(['email:0'])
+    assert second_run.memory_hits == 1
+    assert ddb.calls['BatchGetItem'] == 2
+
+
+def test_dynamodb_tier_items_are_keyed_on_the_partition_key(ddb):
+    IdentityCache(store=DynamoDBIdentityStore(ddb, 'state')).set('email:1', 'user1@example.com')
+
+    item, = ddb.items.values()
+    assert set(item) == {'pk', 'value', 'expires_at'}
+    assert item['pk'] == {'S': 'IDENTITY#email:1'}
+
+
+def test_dynamodb_tier_needs_the_state_table(monkeypatch):
+    monkeypatch.setattr(settings, 'IDENTITY_CACHE_STORE', 'dynamodb')
+    monkeypatch.setattr(settings, 'DDB_STATE_TABLE_NAME', None)
+    with pytest.raises(ValueError, match='DDB_STATE_TABLE_NAME'):
+        open_identity_store(None)
+
+    monkeypatch.setattr(settings, 'DDB_STATE_TABLE_NAME', 'state')
+    assert isinstance(open_identity_store(None), DynamoDBIdentityStore)
+
+
+def test_expired_entries_are_misses(ddb):
+    IdentityCache(store=DynamoDBIdentityStore(ddb, 'table'), ttl=-10).set('email:1', 'user1@example.com')
+
+    cache = IdentityCache(store=DynamoDBIdentityStore(ddb, 'table'))
+    assert cache.get('email:1') is None
+    assert cache.misses == 1
+
+
+def test_refresh_ignores_cached_values(ddb):
+    IdentityCache(store=DynamoDBIdentityStore(ddb, 'table')).set('email:1', 'user1@example.com')
+
+    cache = IdentityCache(store=DynamoDBIdentityStore(ddb, 'table'), refresh=True)
+    assert cache.get('email:1') is None
+    cache.set('email:1', 'new@example.com')
+
+    assert IdentityCache(store=DynamoDBIdentityStore(ddb, 'table')).get('email:1') == 'new@example.com'
+
+
+def test_sqlite_tier_serves_a_new_process(tmp_path):
+    path = str(tmp_path / 'identities.db')
+    first_run = IdentityCache(store=SQLiteIdentityStore(path))
+    first_run.set('attribute:costCenter:1', 'CC-001')
+    first_run.close()
+
+    second_run = IdentityCache(store=SQLiteIdentityStore(path))
+    assert second_run.get('attribute:costCenter:1') == 'CC-001'
+    assert second_run.persistent_hits == 1
+    second_run.close()
@@ -0,0 +1,183 @@
+"""
+Tests of the locking of materialized table refreshes and of the detection of stale billing periods
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import materialized_table
+import query_athena
+import settings
+from checkpoint import FileCheckpointStore
+
+
+class FakeTable:
+    """Billing periods of a materialized table, refreshed by slow INSERT INTO statements"""
+
+    def __init__(self):
+        self.materialized = set()
+        self.deleted = []
+        self.inserts = []
+        self._lock = threading.Lock()
+
+    def is_stale(self, period, source_location):
+        return period not in self.materialized
+
+    def delete_partition(self, period):
+        with self._lock:
+            self.deleted.append(period)
+            self.materialized.discard(period)
+
+    def run_statement(self, query_string):
+        time.sleep(0.2)
+        periods = [period for period in ('2025-01', '2025-02', '2025-03') if f"'{period}'" in query_string]
+        with self._lock:
+            self.inserts.append(periods)
+            self.materialized.update(periods)
+
+
+@pytest.fixture
+def table(monkeypatch):
+    fake = FakeTable()
+    monkeypatch.setattr(settings, 'MATERIALIZED_TABLE_NAME', 'q_developer_cost')
+    monkeypatch.setattr(settings, 'ATHENA_POLL_MAX_INTERVAL', 0.01)
+    monkeypatch.setattr(materialized_table, 'create_table', lambda: None)
+    monkeypatch.setattr(materialized_table, 'get_source_location', lambda: 's3://cur/')
+    monkeypatch.setattr(materialized_table, 'is_stale', fake.is_stale)
+    monkeypatch.setattr(materialized_table, 'delete_partition', fake.delete_partition)
+    monkeypatch.setattr(materialized_table, 'mark_refreshed', lambda period: None)
+    monkeypatch.setattr(query_athena, 'run_statement', fake.run_statement)
+    return fake
+
+
+def refresh_concurrently(ranges, lock_store):
+    errors = []
+
+    def run(start_period, end_period):
+        try:
+            materialized_table.refresh(start_period, end_period, lock_store)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=period_range) for period_range in ranges]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_overlapping_runs_refresh_a_period_once(table, tmp_path):
+    refresh_concurrently([('2025-01', '2025-01')] * 4, FileCheckpointStore(str(tmp_path)))
+
+    assert table.inserts == [['2025-01']]
+    assert table.deleted == ['2025-01']
+
+
+def test_overlapping_ranges_refresh_each_period_once(table, tmp_path):
+    refresh_concurrently([('2025-01', '2025-03'), ('2025-02', '2025-02'), ('2025-02', '2025-03')],
+                         FileCheckpointStore(str(tmp_path)))
+
+    assert sorted(table.deleted) == ['2025-01', '2025-02', '2025-03']
+    assert sorted(period for periods in table.inserts for period in periods) == ['2025-01', '2025-02', '2025-03']
+
+
+def test_locks_of_dead_runs_are_taken_over(table, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'MATERIALIZED_LOCK_TIMEOUT', 600)
+    store = FileCheckpointStore(str(tmp_path))
+    key = materialized_table._lock_key('2025-01')
+    store.claim(key)
+    os.utime(store._shared_path(key), (time.time() - 900, time.time() - 900))
+
+    materialized_table.refresh('2025-01', '2025-01', store)
+    assert table.inserts == [['2025-01']]
+    # Released for the next run
+    assert store.claim(key)
+
+
+def test_locks_are_released_when_the_refresh_fails(table, tmp_path, monkeypatch):
+    store = FileCheckpointStore(str(tmp_path))
+
+    def fail(query_string):
+        raise query_athena.AthenaQueryError('INSERT INTO failed')
+
+    monkeypatch.setattr(query_athena, 'run_statement', fail)
+    with pytest.raises(query_athena.AthenaQueryError):
+        materialized_table.refresh('2025-01', '2025-02', store)
+
+    assert store.claim(materialized_table._lock_key('2025-01'))
+    assert store.claim(materialized_table._lock_key('2025-02'))
+
+
+class FakeBucket:
+    """S3 stand-in for the objects of the CUR and the materialized table, modified on a fake clock"""
+
+    def __init__(self):
+        self.objects = {}
+        self.now = datetime(2025, 2, 1, tzinfo=timezone.utc)
+
+    def write(self, key):
+        self.now += timedelta(minutes=1)
+        self.objects[key] = self.now
+
+    def put_object(self, Bucket, Key, Body):
+        self.write(Key)
+
+    def delete_objects(self, Bucket, Delete):
+        for key in Delete['Objects']:
+            self.objects.pop(key['Key'], None)
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter=None):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        if Delimiter is None:
+            yield {'Contents': [{'Key': key, 'LastModified': self.objects[key]} for key in keys]}
+            return
+        prefixes = sorted({Prefix + key[len(Prefix):].split(Delimiter)[0] + Delimiter
+                           for key in keys if Delimiter in key[len(Prefix):]})
+        yield {'CommonPrefixes': [{'Prefix': prefix} for prefix in prefixes]}
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    """Materialized table on a FakeBucket whose INSERT INTO writes the periods with rows in rows"""
+    bucket = FakeBucket()
+    bucket.rows = {'2025-01'}
+    bucket.statements = []
+
+    def run_statement(query_string):
+        bucket.statements.append(query_string)
+        for period in bucket.rows:
+            if f"'{period}'" in query_string:
+                bucket.write(f"q_developer_cost/billing_period={period}/part-0.parquet")
+
+    monkeypatch.setattr(settings, 'MATERIALIZED_TABLE_NAME', 'q_developer_cost')
+    monkeypatch.setattr(settings, 'MATERIALIZED_TABLE_LOCATION', 's3://results/q_developer_cost/')
+    monkeypatch.setattr(materialized_table, 's3_client', bucket)
+    monkeypatch.setattr(materialized_table, 'create_table', lambda: None)
+    monkeypatch.setattr(materialized_table, 'get_source_location', lambda: 's3://results/cur/')
+    monkeypatch.setattr(query_athena, 'run_statement', run_statement)
+    for period in ('2025-01', '2025-02'):
+        bucket.write(f"cur/BILLING_PERIOD={period}/cur-00001.snappy.parquet")
+    return bucket
+
+
+def test_periods_are_refreshed_once(bucket):
+    assert materialized_table.refresh_periods(['2025-01', '2025-02']) == ['2025-01', '2025-02']
+    # 2025-02 has no Q Developer rows, its marker dates the refresh
+    assert materialized_table.refresh_periods(['2025-01', '2025-02']) == []
+    assert len(bucket.statements) == 1
+    assert 'q_developer_cost/billing_period=2025-02/_refreshed' in bucket.objects
+
+
+def test_restated_periods_are_refreshed(bucket):
+    materialized_table.refresh_periods(['2025-01', '2025-02'])
+    bucket.write('cur/BILLING_PERIOD=2025-02/cur-00002.snappy.parquet')
+
+    assert materialized_table.refresh_periods(['2025-01', '2025-02']) == ['2025-02']
+    assert materialized_table.refresh_periods(['2025-01', '2025-02']) == []
@@ -0,0 +1,101 @@
+"""
+Tests of the Parquet export of the per-user chargeback rows
+"""
+import os
+
+import pytest
+
+import settings
+from parquet_export import ParquetExport
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+USERS = 500
+
+
+def read_partition(location, period='2025-01'):
+    """Rows of the files in the partition of a billing period, by file name"""
+    directory = os.path.join(location, f"billing_period={period}")
+    return {name: pq.read_table(os.path.join(directory, name)).to_pylist() for name in sorted(os.listdir(directory))}
+
+
+def export_users(location, users, period='2025-01'):
+    export = ParquetExport(location, period)
+    for index in range(users):
+        export.add(f"user-{index:04d}", f"user{index}@example.com", f"CC-{index % 3}", 19.0 + index)
+    export.publish()
+    return export
+
+
+def test_rows_are_published_to_the_partition(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'PARQUET_EXPORT_ROW_GROUP_SIZE', 100)
+    export_users(str(tmp_path), 250)
+
+    files = read_partition(str(tmp_path))
+    assert list(files) == ['part.parquet']
+    assert files['part.parquet'][0] == {'user_id': 'user-0000', 'email': 'user0@example.com',
+                                        'cost_center': 'CC-0', 'cost': 19.0}
+    assert len(files['part.parquet']) == 250
+    metadata = pq.ParquetFile(os.path.join(str(tmp_path), 'billing_period=2025-01', 'part.parquet')).metadata
+    assert metadata.num_row_groups == 3
+
+
+def test_publish_replaces_the_file_of_earlier_runs(tmp_path, monkeypatch):
+    export_users(str(tmp_path), 20)
+    # Left by an earlier run with 2 shards
+    monkeypatch.setattr(settings, 'SHARD_COUNT', 2)
+    monkeypatch.setattr(settings, 'SHARD_INDEX', 1)
+    export_users(str(tmp_path), 5)
+    assert list(read_partition(str(tmp_path))) == ['part-shard-1-of-2.parquet', 'part.parquet']
+
+    monkeypatch.setattr(settings, 'SHARD_COUNT', 1)
+    monkeypatch.setattr(settings, 'SHARD_INDEX', 0)
+    export_users(str(tmp_path), 10)
+
+    files = read_partition(str(tmp_path))
+    assert list(files) == ['part.parquet']
+    assert len(files['part.parquet']) == 10
+    # Other billing periods are left alone
+    export_users(str(tmp_path), 3, period='2025-02')
+    assert len(read_partition(str(tmp_path))['part.parquet']) == 10
+
+
+def test_discarded_export_leaves_the_published_file(tmp_path):
+    export_users(str(tmp_path), 20)
+    export = ParquetExport(str(tmp_path), '2025-01')
+    export.add('user-0000', 'user0@example.com', 'CC-0', 1.0)
+    export.discard()
+
+    assert len(read_partition(str(tmp_path))['part.parquet']) == 20
+
+
+def test_resumed_run_exports_every_user_once(main_module, fake_aws, monkeypatch, tmp_path):
+    location = str(tmp_path / 'export')
+    aws = fake_aws(USERS, PARQUET_EXPORT_LOCATION=location, CHECKPOINT_STORE='file',
+                   CHECKPOINT_DIR=str(tmp_path / 'checkpoints'), CHECKPOINT_INTERVAL=1)
+    year, month = aws.cur.billing_period.split('-')
+
+    # The job dies after writing some of the users
+    batch_write_item = aws.ddb.batch_write_item
+
+    def crashing_batch_write_item(**kwargs):
+        if aws.ddb.calls['BatchWriteItem'] >= 8:
+            raise RuntimeError('Container stopped')
+        return batch_write_item(**kwargs)
+
+    monkeypatch.setattr(aws.ddb, 'batch_write_item', crashing_batch_write_item)
+    with pytest.raises(Exception):
+        main_module.get_q_dev_cost_per_month(year, month)
+    written_before = len(aws.user_items())
+    assert 0 < written_before < USERS
+    assert not os.path.exists(location)
+
+    # The retry resumes after the watermark and exports the users written before from DynamoDB
+    monkeypatch.setattr(aws.ddb, 'batch_write_item', batch_write_item)
+    main_module.get_q_dev_cost_per_month(year, month)
+
+    rows = read_partition(location, aws.cur.billing_period)['part.parquet']
+    assert len(rows) == USERS
+    assert {row['user_id'] for row in rows} == {user_id for user_id, _ in aws.user_items()}
+    assert all(float(aws.user_items()[row['user_id'], aws.cur.billing_period]['cost']['N']) == row['cost']
+               for row in rows)
@@ -0,0 +1,71 @@
+"""
+Tests of the concurrent pipeline of save_cost_per_user against latency-injecting fakes
+"""
+import settings
+
+USERS = 1200
+# A DescribeUsers request of 100 users is slower than a BatchWriteItem of 25 items
+IDC_LATENCY = 0.05
+DDB_LATENCY = 0.01
+
+
+def run_month(main_module, fake_aws, monkeypatch, pipeline, idc_concurrency=8, write_concurrency=4,
+              idc_latency=IDC_LATENCY, ddb_latency=DDB_LATENCY):
+    aws = fake_aws(USERS, idc_latency=idc_latency, ddb_latency=ddb_latency)
+    monkeypatch.setattr(settings, 'PIPELINE_MODE', pipeline)
+    monkeypatch.setattr(settings, 'IDC_RESOLUTION_MODE', 'point')
+    monkeypatch.setattr(settings, 'IDC_CONCURRENCY', idc_concurrency)
+    monkeypatch.setattr(settings, 'DDB_WRITE_CONCURRENCY', write_concurrency)
+    year, month = aws.cur.billing_period.split('-')
+
+    # Writes sent while a lookup is in flight
+    aws.overlapping_writes = 0
+    batch_write_item = aws.ddb.batch_write_item
+
+    def watched_batch_write_item(**kwargs):
+        if aws.idc_http.in_flight['DescribeUsers']:
+            aws.overlapping_writes += 1
+        return batch_write_item(**kwargs)
+
+    monkeypatch.setattr(aws.ddb, 'batch_write_item', watched_batch_write_item)
+    main_module.get_q_dev_cost_per_month(year, month)
+
+    assert len(aws.user_items()) == USERS
+    return aws
+
+
+def test_concurrent_pipeline_writes_the_same_items(main_module, fake_aws, monkeypatch):
+    sequential = run_month(main_module, fake_aws, monkeypatch, 'sequential')
+    concurrent = run_month(main_module, fake_aws, monkeypatch, 'concurrent')
+
+    assert concurrent.ddb.items == sequential.ddb.items
+    assert concurrent.idc_http.calls == sequential.idc_http.calls
+
+
+def test_sequential_pipeline_sends_one_request_at_a_time(main_module, fake_aws, monkeypatch):
+    aws = run_month(main_module, fake_aws, monkeypatch, 'sequential')
+
+    assert aws.idc_http.max_in_flight['DescribeUsers'] == 1
+    assert aws.ddb.max_in_flight['BatchWriteItem'] == 1
+    assert aws.overlapping_writes == 0
+
+
+def test_lookups_run_idc_concurrency_at_a_time(main_module, fake_aws, monkeypatch):
+    for concurrency in (1, 2, 4, 8):
+        aws = run_month(main_module, fake_aws, monkeypatch, 'concurrent', idc_concurrency=concurrency)
+
+        assert aws.idc_http.max_in_flight['DescribeUsers'] == concurrency
+        # Writes overlap the lookups even with a single lookup in flight
+        assert aws.overlapping_writes > 0
+
+
+def test_batches_of_a_chunk_are_written_in_parallel(main_module, fake_aws, monkeypatch, tmp_path):
+    # With a checkpoint every chunk is flushed before its watermark is saved
+    monkeypatch.setattr(settings, 'CHECKPOINT_STORE', 'file')
+    monkeypatch.setattr(settings, 'CHECKPOINT_DIR', str(tmp_path))
+    for concurrency in (1, 4):
+        aws = run_month(main_module, fake_aws, monkeypatch, 'concurrent',
+                        write_concurrency=concurrency, idc_latency=0.005, ddb_latency=0.02)
+
+        # A chunk of IDC_BATCH_SIZE users fills 4 batches
+        assert aws.ddb.max_in_flight['BatchWriteItem'] == concurrency
@@ -0,0 +1,201 @@
+"""
+Tests of the adaptive completion polling of query_athena.wait_for_query and
+of the creation of prepared statements
+
+The queries run on a fake Athena client whose query states follow a fake
+clock, which wait_for_query also sleeps on, so the tests take no real time.
+"""
+import pytest
+from botocore.exceptions import ClientError
+
+import fakes
+import query_athena
+import settings
+
+
+class FakeClock:
+    """Monotonic clock that only moves when slept on"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class ClockedAthenaClient(fakes.FakeAthenaClient):
+    """
+    FakeAthenaClient whose queries are queued and then run for a number of seconds on a FakeClock
+
+    Every status check takes call_latency seconds on the clock.
+    """
+
+    def __init__(self, clock, call_latency=0.05, **kwargs):
+        super().__init__(fakes.SyntheticCur(0), **kwargs)
+        self.clock = clock
+        self.call_latency = call_latency
+
+    def add_query(self, queue_seconds, run_seconds, final_state='SUCCEEDED'):
+        execution_id = f"query-{len(self.executions) + 1}"
+        self.executions[execution_id] = {
+            'started': self.clock.now,
+            'queue_seconds': queue_seconds,
+            'run_seconds': run_seconds,
+            'final_state': final_state
+        }
+        return execution_id
+
+    def finished_at(self, execution_id):
+        execution = self.executions[execution_id]
+        return execution['started'] + execution['queue_seconds'] + execution['run_seconds']
+
+    def get_query_execution(self, QueryExecutionId):
+        self._call('GetQueryExecution')
+        self.clock.sleep(self.call_latency)
+        execution = self.executions[QueryExecutionId]
+        elapsed = self.clock.now - execution['started']
+        queue_time = min(elapsed, execution['queue_seconds'])
+        execution_time = max(0.0, elapsed - execution['queue_seconds'])
+        if elapsed < execution['queue_seconds']:
+            state = 'QUEUED'
+        elif execution_time < execution['run_seconds']:
+            state = 'RUNNING'
+        else:
+            state = execution['final_state']
+            execution_time = execution['run_seconds']
+        return {'QueryExecution': {
+            'QueryExecutionId': QueryExecutionId,
+            'Status': {'State': state, 'StateChangeReason': 'Query exhausted resources'},
+            'Statistics': {
+                'QueryQueueTimeInMillis': int(queue_time * 1000),
+                'EngineExecutionTimeInMillis': int(execution_time * 1000)
+            }
+        }}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(query_athena, 'time', clock)
+    monkeypatch.setattr(settings, 'ATHENA_QUERY_TIMEOUT', 300.0)
+    monkeypatch.setattr(settings, 'ATHENA_POLL_MIN_INTERVAL', 0.2)
+    monkeypatch.setattr(settings, 'ATHENA_POLL_MAX_INTERVAL', 5.0)
+    monkeypatch.setattr(settings, 'ATHENA_POLL_BACKOFF', 2.0)
+    monkeypatch.setattr(settings, 'ATHENA_POLL_TIME_FRACTION', 0.1)
+    return clock
+
+
+@pytest.fixture
+def athena(monkeypatch, clock):
+    athena = ClockedAthenaClient(clock)
+    monkeypatch.setattr(query_athena, 'athena_client', athena)
+    return athena
+
+
+def wait(athena, clock, queue_seconds, run_seconds):
+    """Wait for a query and return the number of status checks and the delay after it finished"""
+    execution_id = athena.add_query(queue_seconds, run_seconds)
+    query_execution = query_athena.wait_for_query(execution_id)
+    assert query_execution['Status']['State'] == 'SUCCEEDED'
+    return athena.calls['GetQueryExecution'], clock.now - athena.finished_at(execution_id)
+
+
+def test_fast_query_returns_before_a_fixed_five_second_poll(athena, clock):
+    polls, latency = wait(athena, clock, queue_seconds=0.1, run_seconds=1.5)
+
+    assert polls <= 4
+    assert 0 <= latency <= 1.6
+    assert clock.now < 5
+
+
+def test_slow_query_backs_off_to_the_maximum_interval(athena, clock):
+    polls, latency = wait(athena, clock, queue_seconds=0.5, run_seconds=120)
+
+    # Polling at the minimum interval would take 600 status checks
+    assert polls <= 30
+    assert 0 <= latency <= settings.ATHENA_POLL_MAX_INTERVAL
+
+
+def test_queued_query_backs_off_on_its_queue_time(athena, clock):
+    polls, latency = wait(athena, clock, queue_seconds=60, run_seconds=2)
+
+    assert polls <= 20
+    assert 0 <= latency <= settings.ATHENA_POLL_MAX_INTERVAL
+
+
+def test_interval_grows_with_reported_execution_time(athena, clock, monkeypatch):
+    # Without the backoff, only the execution time reported by Athena raises the interval
+    monkeypatch.setattr(settings, 'ATHENA_POLL_BACKOFF', 1.0)
+    monkeypatch.setattr(settings, 'ATHENA_POLL_MAX_INTERVAL', 30.0)
+
+    polls, _ = wait(athena, clock, queue_seconds=0, run_seconds=200)
+
+    # Polling at the minimum interval would take 1000 status checks
+    assert polls <= 60
+
+
+def test_deadline_stops_the_query(athena, clock, monkeypatch):
+    monkeypatch.setattr(settings, 'ATHENA_QUERY_TIMEOUT', 30.0)
+    execution_id = athena.add_query(queue_seconds=0, run_seconds=3600)
+
+    with pytest.raises(TimeoutError):
+        query_athena.wait_for_query(execution_id)
+
+    assert athena.calls['StopQueryExecution'] == 1
+    assert 30 <= clock.now <= 31
+
+
+def test_failed_query_raises(athena, clock):
+    execution_id = athena.add_query(queue_seconds=0, run_seconds=1, final_state='FAILED')
+
+    with pytest.raises(query_athena.AthenaQueryError, match='exhausted resources'):
+        query_athena.wait_for_query(execution_id)
+
+
+class RacingAthenaClient(fakes.FakeAthenaClient):
+    """FakeAthenaClient whose statements are created by another job between the get and the create"""
+
+    def __init__(self, create_error):
+        super().__init__(fakes.SyntheticCur(0))
+        self.create_error = create_error
+
+    def create_prepared_statement(self, StatementName, WorkGroup, QueryStatement):
+        self._call('CreatePreparedStatement')
+        if self.create_error == 'InvalidRequestException':
+            self.statements[StatementName] = QueryStatement
+            raise fakes.client_error('InvalidRequestException', 'CreatePreparedStatement',
+                                     f"Prepared statement {StatementName} already exists in WorkGroup primary")
+        raise fakes.client_error(self.create_error, 'CreatePreparedStatement', 'Not authorized')
+
+
+@pytest.fixture
+def prepare(monkeypatch):
+    monkeypatch.setattr(query_athena, 'prepared_statements', set())
+
+    def prepare(create_error):
+        athena = RacingAthenaClient(create_error)
+        monkeypatch.setattr(query_athena, 'athena_client', athena)
+        return athena
+
+    return prepare
+
+
+def test_statement_created_by_another_job_is_used(prepare):
+    athena = prepare('InvalidRequestException')
+    statement_name = query_athena.get_prepared_statement('SELECT 1')
+
+    assert statement_name in athena.statements
+    assert athena.calls['GetPreparedStatement'] == 2
+
+
+def test_other_create_errors_are_raised(prepare):
+    athena = prepare('AccessDeniedException')
+    with pytest.raises(ClientError) as error:
+        query_athena.get_prepared_statement('SELECT 1')
+
+    assert error.value.response['Error']['Code'] == 'AccessDeniedException'
+    assert athena.calls['GetPreparedStatement'] == 1
+    assert query_athena.prepared_statements == set()
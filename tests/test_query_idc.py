@@ -0,0 +1,74 @@
+"""
+Tests of the IAM Identity Center resolution modes against a shuffled fake directory
+"""
+import pytest
+
+import fakes
+import query_idc
+import settings
+
+USERS = 500
+
+
+def resolve_month(main_module, fake_aws, monkeypatch, mode, extra_users):
+    aws = fake_aws(USERS, extra_users=extra_users)
+    monkeypatch.setattr(settings, 'IDC_RESOLUTION_MODE', mode)
+    year, month = aws.cur.billing_period.split('-')
+    main_module.get_q_dev_cost_per_month(year, month)
+    assert len(aws.user_items()) == USERS
+    return aws
+
+
+def test_modes_store_the_same_users(main_module, fake_aws, monkeypatch):
+    point = resolve_month(main_module, fake_aws, monkeypatch, 'point', USERS)
+    auto = resolve_month(main_module, fake_aws, monkeypatch, 'auto', USERS)
+    snapshot = resolve_month(main_module, fake_aws, monkeypatch, 'snapshot', USERS)
+
+    assert auto.user_items() == point.user_items()
+    assert snapshot.user_items() == point.user_items()
+
+
+def test_auto_mode_takes_at_most_twice_the_point_requests(main_module, fake_aws, monkeypatch):
+    for extra_users in (0, USERS, 10 * USERS):
+        point = resolve_month(main_module, fake_aws, monkeypatch, 'point', extra_users)
+        auto = resolve_month(main_module, fake_aws, monkeypatch, 'auto', extra_users)
+
+        point_requests = sum(point.idc_http.calls.values())
+        auto_requests = sum(auto.idc_http.calls.values())
+        assert point.idc_http.calls['SearchUsers'] == 0
+        assert auto_requests <= 2 * point_requests
+        if extra_users == 0:
+            # The whole directory fits in the listing budget
+            assert auto.idc_http.calls['DescribeUsers'] == 0
+
+
+def test_missing_users_do_not_stop_the_run(main_module, fake_aws):
+    aws = fake_aws(USERS)
+    missing = set(aws.cur.user_ids[:5])
+    aws.idc_http.user_ids -= missing
+    year, month = aws.cur.billing_period.split('-')
+
+    with pytest.raises(main_module.UserResolutionError, match='5 users'):
+        main_module.get_q_dev_cost_per_month(year, month)
+    assert {user_id for user_id, _ in aws.user_items()} == set(aws.cur.user_ids) - missing
+
+
+def test_missing_store_id_stops_the_run(main_module, fake_aws):
+    aws = fake_aws(USERS, IDC_STORE_ID='')
+    year, month = aws.cur.billing_period.split('-')
+
+    with pytest.raises(ValueError):
+        main_module.get_q_dev_cost_per_month(year, month)
+    assert aws.user_items() == {}
+
+
+@pytest.mark.parametrize('pipeline', ['sequential', 'concurrent'])
+def test_rejected_requests_stop_the_run(main_module, fake_aws, monkeypatch, pipeline):
+    aws = fake_aws(USERS, PIPELINE_MODE=pipeline)
+    monkeypatch.setattr(aws.idc_http, 'post', lambda *args, **kwargs: fakes.FakeResponse(
+        {'__type': 'AccessDeniedException', 'Message': 'Not authorized'}, 403))
+    year, month = aws.cur.billing_period.split('-')
+
+    with pytest.raises(query_idc.IdentityStoreAccessError):
+        main_module.get_q_dev_cost_per_month(year, month)
+    assert aws.user_items() == {}
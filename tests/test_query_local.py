@@ -0,0 +1,95 @@
+"""
+Tests of the local query backend on CUR 2.0 Parquet files written from a SyntheticCur
+"""
+import os
+
+import pytest
+
+import fakes
+import query_local
+import settings
+
+pytest.importorskip('duckdb')
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+USERS = 300
+
+
+def write_cur(path, cur, files=2):
+    """
+    Write the line items of a SyntheticCur like a CUR 2.0 data export
+
+    Every user gets a usage line item, in one of several files, next to line
+    items of other services and operations that the queries must leave out.
+    The SyntheticCur has no tax, since a tax line item would also be grouped as
+    a user without resource ID, unlike in the fake results.
+    """
+    directory = os.path.join(path, f"BILLING_PERIOD={cur.billing_period}")
+    os.makedirs(directory)
+    rows = [('AmazonQ', 'number-q-dev-subscriptions', resource_id, 'Usage', cost)
+            for resource_id, cost in cur.user_costs]
+    rows.append(('AmazonEC2', 'RunInstances', 'i-0123456789abcdef0', 'Usage', 42.0))
+    rows.append(('AmazonQ', 'number-q-business-subscriptions', cur.user_costs[0][0], 'Usage', 19.0))
+    columns = ['line_item_product_code', 'line_item_operation', 'line_item_resource_id',
+               'line_item_line_item_type', 'line_item_unblended_cost']
+    for index in range(files):
+        part = rows[index::files]
+        table = pa.table({name: [row[position] for row in part] for position, name in enumerate(columns)})
+        pq.write_table(table, os.path.join(directory, f"{cur.billing_period}-{index:05d}.snappy.parquet"))
+
+
+@pytest.fixture
+def cur_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'cur')
+    os.makedirs(path)
+    monkeypatch.setattr(settings, 'LOCAL_CUR_PATH', path)
+    return path
+
+
+def test_local_backend_writes_the_items_of_athena(main_module, fake_aws, cur_path):
+    cur = fakes.SyntheticCur(USERS, tax_rate=0)
+    athena_run = fake_aws(USERS)
+    athena_run.athena.cur = cur
+    main_module.get_q_dev_cost_per_month(*cur.billing_period.split('-'))
+
+    local_run = fake_aws(USERS, QUERY_BACKEND='local')
+    write_cur(cur_path, cur)
+    # Another billing period that the month must not read
+    write_cur(cur_path, fakes.SyntheticCur(USERS // 2, billing_period='2024-12', tax_rate=0, seed=1))
+    main_module.get_q_dev_cost_per_month(*cur.billing_period.split('-'))
+
+    assert local_run.athena.calls['StartQueryExecution'] == 0
+    assert len(local_run.user_items()) == USERS
+    assert local_run.ddb.items == athena_run.ddb.items
+
+
+def test_local_subscription_costs_match_athena(main_module, cur_path):
+    cur = fakes.SyntheticCur(USERS, tax_rate=0)
+    write_cur(cur_path, cur)
+    rows = list(query_local.run_query(main_module.SUBSCRIPTION_COST_QUERY, '2025', '01'))
+
+    assert [(resource_id, float(cost)) for resource_id, cost in rows] == [
+        (resource_id, float(cost)) for resource_id, cost in cur.subscription_cost_rows[1:]]
+
+
+def test_files_outside_billing_period_directories_are_refused(cur_path):
+    pq.write_table(pa.table({'line_item_unblended_cost': [19.0]}), os.path.join(cur_path, 'cur.parquet'))
+
+    with pytest.raises(query_local.LocalQueryError, match='BILLING_PERIOD'):
+        query_local.run_query('SELECT * FROM {0} WHERE billing_period=?', '2025', '01')
+
+
+def test_errors_while_fetching_rows_are_local_query_errors(cur_path):
+    directory = os.path.join(cur_path, 'BILLING_PERIOD=2025-01')
+    os.makedirs(directory)
+    # DuckDB streams the rows, so the value that cannot be cast is only read after the query started
+    for index in range(3):
+        values = [str(value) for value in range(100000)] + (['not a number'] if index == 2 else [])
+        pq.write_table(pa.table({'line_item_resource_id': values}), os.path.join(directory, f"part-{index}.parquet"))
+
+    rows = query_local.run_query("SELECT CAST(line_item_resource_id AS INTEGER) FROM {0} WHERE billing_period=?",
+                                 '2025', '01')
+    with pytest.raises(query_local.LocalQueryError, match='results'):
+        list(rows)
+
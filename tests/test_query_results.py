@@ -0,0 +1,66 @@
+"""
+Tests of the readers of Athena query results: GetQueryResults pages and the result CSV file in S3
+"""
+import pytest
+
+import fakes
+import query_athena
+
+HEADER = ('line_item_resource_id', 'email', 'cost')
+ROWS = [
+    HEADER,
+    ('user-1', 'user1@example.com', '19.0'),
+    # NULL and the empty string
+    ('user-2', None, '19.0'),
+    ('user-3', '', None),
+    ('user-4', 'say "hi", bye', '-3.5'),
+    ('user-5', 'two\nlines', ''),
+    (None, None, None),
+]
+
+
+@pytest.fixture
+def athena(monkeypatch):
+    athena = fakes.FakeAthenaClient(fakes.SyntheticCur(0), page_size=2)
+    athena.executions['query-1'] = {'rows': ROWS, 'polls': 0, 'output_location': 's3://fake-results/query-1.csv'}
+    monkeypatch.setattr(query_athena, 'athena_client', athena)
+    return athena
+
+
+def test_s3_reader_returns_the_rows_of_the_api_reader(athena, monkeypatch):
+    s3 = fakes.FakeS3Client(athena)
+    monkeypatch.setattr(query_athena, 's3_client', s3)
+    api_rows = list(query_athena.get_query_results('query-1'))
+    s3_rows = list(query_athena.read_query_results_from_s3('s3://fake-results/query-1.csv'))
+
+    assert s3_rows == api_rows == ROWS[1:]
+    assert s3.calls['GetObject'] == 1
+
+
+def test_null_and_empty_strings_are_told_apart():
+    lines = ['"a","b","c"', '"x",,""', ',"",']
+
+    assert list(query_athena.parse_csv_results(lines)) == [('x', None, ''), (None, '', None)]
+
+
+def test_header_only_file_has_no_rows():
+    assert list(query_athena.parse_csv_results(['"a","b"'])) == []
+
+
+def test_truncated_file_raises():
+    with pytest.raises(query_athena.AthenaQueryError):
+        list(query_athena.parse_csv_results(['"a","b"', '"x","unterminated']))
+
+
+def test_months_read_from_s3_write_the_same_items(main_module, fake_aws, monkeypatch):
+    api_run = fake_aws(300)
+    main_module.get_q_dev_cost_per_month(*api_run.cur.billing_period.split('-'))
+
+    s3_run = fake_aws(300, ATHENA_RESULT_READER='s3')
+    s3 = fakes.FakeS3Client(s3_run.athena)
+    monkeypatch.setattr(query_athena, 's3_client', s3)
+    main_module.get_q_dev_cost_per_month(*s3_run.cur.billing_period.split('-'))
+
+    assert s3_run.ddb.items == api_run.ddb.items
+    assert s3_run.athena.calls['GetQueryResults'] == 0
+    assert s3.calls['GetObject'] == s3_run.athena.calls['StartQueryExecution']
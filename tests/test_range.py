@@ -0,0 +1,77 @@
+"""
+Tests of the range mode, which computes several billing periods from one query
+"""
+import math
+from collections import Counter
+
+import pytest
+
+import fakes
+import settings
+
+PERIODS = ['2025-01', '2025-02', '2025-03']
+# The same users subscribe every month, with more of them each month
+USERS = {'2025-01': 250, '2025-02': 300, '2025-03': 350}
+
+
+class RangeCur:
+    """Range query results of several SyntheticCurs, ordered like RANGE_COST_BREAKDOWN_QUERY"""
+
+    def __init__(self, curs):
+        rows = [cur.range_cost_breakdown_rows for cur in curs]
+        self.range_cost_breakdown_rows = [rows[0][0]] + [
+            row for row_group in ('3', '2', '1') for period_rows in rows
+            for row in period_rows[1:] if row[-1] == row_group]
+
+
+def month_curs():
+    return {period: fakes.SyntheticCur(USERS[period], billing_period=period) for period in PERIODS}
+
+
+def run_months(main_module, fake_aws):
+    """Run one job per month, returning the items and the API calls of all jobs"""
+    curs = month_curs()
+    items = {}
+    athena_calls = Counter()
+    idc_calls = Counter()
+    for period in PERIODS:
+        aws = fake_aws(max(USERS.values()))
+        aws.athena.cur = curs[period]
+        main_module.get_q_dev_cost_per_month(*period.split('-'))
+        items.update(aws.ddb.items)
+        athena_calls.update(aws.athena.calls)
+        idc_calls.update(aws.idc_http.calls)
+    return items, athena_calls, idc_calls
+
+
+def run_range(main_module, fake_aws):
+    aws = fake_aws(max(USERS.values()))
+    aws.athena.cur = RangeCur(month_curs().values())
+    main_module.get_q_dev_cost_for_range(PERIODS[0], PERIODS[-1])
+    return aws
+
+
+@pytest.mark.parametrize('pipeline', ['sequential', 'concurrent'])
+def test_range_writes_the_items_of_each_month(main_module, fake_aws, monkeypatch, pipeline):
+    monkeypatch.setattr(settings, 'PIPELINE_MODE', pipeline)
+    month_items, _, _ = run_months(main_module, fake_aws)
+    range_run = run_range(main_module, fake_aws)
+
+    assert range_run.ddb.items == month_items
+    assert {period for _, period in range_run.ddb.items} == set(PERIODS)
+    assert len(range_run.ddb.items) == sum(USERS.values())
+
+
+def test_range_runs_one_query_and_resolves_each_user_once(main_module, fake_aws):
+    _, month_athena_calls, month_idc_calls = run_months(main_module, fake_aws)
+    range_run = run_range(main_module, fake_aws)
+
+    assert range_run.athena.calls['StartQueryExecution'] == 1
+    assert month_athena_calls['StartQueryExecution'] == len(PERIODS)
+    # Users of the earlier months are already resolved when a later month is written
+    assert range_run.idc_http.calls['DescribeUsers'] == (
+        math.ceil(USERS['2025-01'] / settings.IDC_BATCH_SIZE)
+        + sum(math.ceil((USERS[period] - USERS[previous]) / settings.IDC_BATCH_SIZE)
+              for previous, period in zip(PERIODS, PERIODS[1:])))
+    assert month_idc_calls['DescribeUsers'] == sum(math.ceil(USERS[period] / settings.IDC_BATCH_SIZE)
+                                                   for period in PERIODS)
@@ -0,0 +1,103 @@
+"""
+Tests of the adaptive rate limiter and the retries of throttled calls
+"""
+import time
+
+import pytest
+
+import fakes
+import rate_limiter
+import settings
+from rate_limiter import AdaptiveRateLimiter, ThrottlingError
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(settings, 'THROTTLE_MAX_RETRIES', 3)
+    monkeypatch.setattr(settings, 'THROTTLE_BASE_BACKOFF', 0.001)
+    monkeypatch.setattr(settings, 'THROTTLE_MAX_BACKOFF', 0.001)
+
+
+def throttled_calls(count, result='done'):
+    calls = []
+
+    def call():
+        calls.append(time.monotonic())
+        if len(calls) <= count:
+            raise fakes.client_error('ThrottlingException', 'DescribeUsers', 'Rate exceeded')
+        return result
+
+    return call, calls
+
+
+def test_rate_is_halved_once_per_cooldown():
+    limiter = AdaptiveRateLimiter('Test', 100, cooldown=60)
+    for _ in range(5):
+        limiter.on_throttle()
+
+    assert limiter.rate == 50
+    assert limiter.stats()['throttles'] == 5
+
+
+def test_rate_grows_back_after_successes():
+    limiter = AdaptiveRateLimiter('Test', 100, success_threshold=10, increase_step=5, cooldown=0)
+    limiter.on_throttle()
+    for _ in range(20):
+        limiter.on_success()
+    assert limiter.rate == 60
+
+    for _ in range(200):
+        limiter.on_success()
+    assert limiter.rate == 100
+
+
+def test_rate_is_enforced():
+    limiter = AdaptiveRateLimiter('Test', 50)
+    # The bucket holds one second worth of tokens
+    for _ in range(50):
+        limiter.acquire()
+
+    start = time.monotonic()
+    for _ in range(10):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.15
+
+
+def test_throttled_calls_are_retried():
+    limiter = AdaptiveRateLimiter('Test', 1000)
+    call, calls = throttled_calls(2)
+
+    assert rate_limiter.call_with_retry(limiter, call) == 'done'
+    assert len(calls) == 3
+    assert limiter.throttles == 2
+
+
+def test_retries_are_limited():
+    limiter = AdaptiveRateLimiter('Test', 1000)
+    call, calls = throttled_calls(10)
+
+    with pytest.raises(Exception) as error:
+        rate_limiter.call_with_retry(limiter, call)
+    assert rate_limiter.is_throttling_error(error.value)
+    assert len(calls) == settings.THROTTLE_MAX_RETRIES + 1
+
+
+def test_other_errors_are_not_retried():
+    limiter = AdaptiveRateLimiter('Test', 1000)
+    calls = []
+
+    def call():
+        calls.append(1)
+        raise fakes.client_error('AccessDeniedException', 'DescribeUsers', 'Not authorized')
+
+    with pytest.raises(Exception):
+        rate_limiter.call_with_retry(limiter, call)
+    assert len(calls) == 1
+    assert limiter.throttles == 0
+
+
+def test_throttling_errors():
+    assert rate_limiter.is_throttling_error(ThrottlingError('HTTP 429'))
+    assert rate_limiter.is_throttling_error(fakes.client_error('SlowDown', 'PutObject'))
+    assert not rate_limiter.is_throttling_error(fakes.client_error('ValidationException', 'Query'))
+    assert not rate_limiter.is_throttling_error(ValueError('invalid'))
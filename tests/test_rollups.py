@@ -0,0 +1,58 @@
+"""
+Tests of the cost center rollup items
+"""
+import settings
+from ddb_writer import ROLLUP_PREFIX
+
+USERS = 300
+
+
+def run_month(main_module, aws):
+    year, month = aws.cur.billing_period.split('-')
+    main_module.get_q_dev_cost_per_month(year, month)
+
+
+def rollup_keys(aws):
+    return {key for key, period in aws.ddb.items
+            if period == aws.cur.billing_period and key.startswith(ROLLUP_PREFIX)}
+
+
+def add_stale_rollup(aws):
+    key = ROLLUP_PREFIX + 'CC-GONE'
+    aws.ddb.items[(key, aws.cur.billing_period)] = {
+        settings.DDB_PARTITION_KEY: {'S': key},
+        settings.DDB_SORT_KEY: {'S': aws.cur.billing_period}
+    }
+    return key
+
+
+def test_rollups_are_off_by_default(main_module, fake_aws):
+    aws = fake_aws(USERS, DDB_ROLLUP_ENABLED=False)
+    run_month(main_module, aws)
+
+    assert rollup_keys(aws) == set()
+    assert aws.ddb.calls['Query'] == 0
+
+
+def test_stale_rollups_are_removed(main_module, fake_aws):
+    aws = fake_aws(USERS, DDB_ROLLUP_ENABLED=True)
+    stale_key = add_stale_rollup(aws)
+    run_month(main_module, aws)
+
+    keys = rollup_keys(aws)
+    assert keys and stale_key not in keys
+    assert sum(int(aws.ddb.items[(key, aws.cur.billing_period)]['user_count']['N']) for key in keys) == USERS
+
+
+def test_rollups_are_written_without_the_period_index(main_module, fake_aws):
+    aws = fake_aws(USERS, DDB_ROLLUP_ENABLED=True)
+    aws.ddb.indexes = set()
+    stale_key = add_stale_rollup(aws)
+    run_month(main_module, aws)
+
+    keys = rollup_keys(aws)
+    assert len(aws.user_items()) == USERS
+    # Without the index the stale item cannot be found
+    assert stale_key in keys
+    assert sum(int(aws.ddb.items[(key, aws.cur.billing_period)]['user_count']['N'])
+               for key in keys - {stale_key}) == USERS
@@ -0,0 +1,92 @@
+"""
+Tests of sharded runs, whose shards each write a part of the users like the children of an AWS Batch array job
+"""
+import math
+from collections import Counter
+
+import pytest
+
+import fakes
+import settings
+import sharding
+from ddb_writer import ROLLUP_PREFIX
+
+USERS = 500
+SHARD_COUNT = 4
+
+
+def run_shards(main_module, aws, monkeypatch, tmp_path):
+    """Run the shards one after the other, each writing to its own fake table"""
+    monkeypatch.setattr(settings, 'CHECKPOINT_STORE', 'file')
+    monkeypatch.setattr(settings, 'CHECKPOINT_DIR', str(tmp_path))
+    monkeypatch.setattr(settings, 'SHARD_COUNT', SHARD_COUNT)
+    monkeypatch.setattr(settings, 'SHARD_RUN_ID', 'array-job')
+    shard_items = []
+    for shard_index in range(SHARD_COUNT):
+        monkeypatch.setattr(settings, 'SHARD_INDEX', shard_index)
+        ddb = fakes.FakeDynamoDBClient(settings.DDB_PARTITION_KEY, settings.DDB_SORT_KEY)
+        monkeypatch.setattr(main_module, 'ddb_client', ddb)
+        main_module.get_q_dev_cost_per_month(*aws.cur.billing_period.split('-'))
+        shard_items.append(ddb.items)
+    return shard_items
+
+
+def user_items(items):
+    return {key: item for key, item in items.items() if not key[0].startswith(ROLLUP_PREFIX)}
+
+
+def rollup_totals(items):
+    """Cost and users per cost center, with the partial rollups of the shards added up"""
+    cost = Counter()
+    users = Counter()
+    for (key, _), item in items.items():
+        if key.startswith(ROLLUP_PREFIX):
+            cost_center = key.split(sharding.ROLLUP_SHARD_SEPARATOR)[0]
+            cost[cost_center] += float(item['cost']['N'])
+            users[cost_center] += int(item['user_count']['N'])
+    return cost, users
+
+
+@pytest.fixture
+def runs(main_module, fake_aws, monkeypatch, tmp_path):
+    unsharded = fake_aws(USERS, DDB_ROLLUP_ENABLED=True)
+    main_module.get_q_dev_cost_per_month(*unsharded.cur.billing_period.split('-'))
+
+    sharded = fake_aws(USERS, DDB_ROLLUP_ENABLED=True)
+    return unsharded, sharded, run_shards(main_module, sharded, monkeypatch, tmp_path)
+
+
+def test_shards_write_disjoint_parts_of_the_users(runs):
+    unsharded, _, shard_items = runs
+    shard_users = [set(user_items(items)) for items in shard_items]
+
+    assert sum(len(users) for users in shard_users) == USERS
+    assert set().union(*shard_users) == set(unsharded.user_items())
+    # Hashing spreads the users evenly
+    assert all(len(users) > USERS / SHARD_COUNT / 2 for users in shard_users)
+
+
+def test_shards_allocate_the_totals_of_all_users(runs):
+    unsharded, _, shard_items = runs
+    merged = {key: item for items in shard_items for key, item in user_items(items).items()}
+
+    assert merged == unsharded.user_items()
+    assert math.isclose(sum(float(item['cost']['N']) for item in merged.values()),
+                        sum(float(item['cost']['N']) for item in unsharded.user_items().values()))
+
+
+def test_partial_rollups_add_up_to_the_totals(runs):
+    unsharded, _, shard_items = runs
+    merged = {key: item for items in shard_items for key, item in items.items()}
+    cost, users = rollup_totals(merged)
+    unsharded_cost, unsharded_users = rollup_totals(unsharded.ddb.items)
+
+    assert users == unsharded_users
+    assert cost.keys() == unsharded_cost.keys()
+    assert all(math.isclose(cost[key], unsharded_cost[key]) for key in cost)
+
+
+def test_shards_share_one_execution_of_each_query(runs):
+    unsharded, sharded, _ = runs
+
+    assert sharded.athena.calls['StartQueryExecution'] == unsharded.athena.calls['StartQueryExecution']